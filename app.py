@@ -18,19 +18,35 @@ st.write("수학 변형 문제 생성기 - 수학 내신 대비, 오답 노트,
 
 from PIL import Image
 import io
+import ast
+import math
 import os
 import json
 import re
 import base64
+import copy
+import functools
+import builtins
 import textwrap
 import time
+import random
+from email.utils import parsedate_to_datetime
 from datetime import datetime
 import requests
-import urllib3
 import matplotlib
 import tempfile
 import zipfile
+import multiprocessing
+import queue
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, FIRST_COMPLETED, as_completed, wait
+from concurrent.futures.process import BrokenProcessPool
 import csv
+import sqlite3
+import hashlib
+import logging
+import atexit
+import threading
+from collections import OrderedDict
 try:
     import fitz # PyMuPDF
 except ImportError:
@@ -38,13 +54,21 @@ except ImportError:
     st.info("💡 **해결 방법:** GitHub 저장소의 `app.py`와 **같은 위치**에 `requirements.txt` 파일이 있는지 확인해주세요.")
     st.stop()
 from fpdf import FPDF
+from fpdf.fonts import SubsetMap
+from fontTools import ttLib
+import fpdf.image_parsing as fpdf_image_parsing
 matplotlib.use('Agg')
 import matplotlib.pyplot as plt
 import matplotlib.font_manager as fm
+from matplotlib.figure import Figure
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+from matplotlib.font_manager import FontProperties
+from matplotlib.mathtext import math_to_image
 import numpy as np
 from requests.adapters import HTTPAdapter
-from urllib3.util.retry import Retry
-urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
+from streamlit.runtime.scriptrunner import add_script_run_ctx, get_script_run_ctx
+import render_worker
+logger = logging.getLogger(__name__)
 # =========================================================================
 # 1. Initialization & Configuration
 # =========================================================================
@@ -88,9 +112,9 @@ def setup_fonts():
     return font_ready
 setup_fonts()
 default_session = {
-    'curriculum_text': "", 'base_ref_text': "", 'generated_data': None,
+    'curriculum_text': "", 'generated_data': None,
     'valid_model_name': None,
-    'generated_figure': None, 'history': [],
+    'generated_figure': None, 'history': [], 'history_version': 0, 'export_cache': {},
     'api_key': "", 'style_img': None,
     'bg_image_file': None,
     'grade': "Middle 1", 'difficulty': "Maintain", 'prob_type': "Any", 'creativity': 0.4,
@@ -136,7 +160,9 @@ UI_TEXT = {
         "theme_apply": "테마 적용", "data_warn": "이 작업은 되돌릴 수 없습니다.",
         "data_clear": "모든 기록 삭제",
         "export_mode_integrated": "통합본 (문제+해설)", "export_mode_problem": "문제만",
-        "export_mode_solution": "해설만"
+        "export_mode_solution": "해설만", "native_text": "🔤 텍스트 PDF (경량/검색 가능)",
+        "twin_count": "생성 개수", "stream_mode": "실시간 표시", "stream_draft": "초안 미리보기",
+        "force_fresh": "새로 생성 (캐시 무시)", "fast_mode": "⚡ 빠른 모드 (1회 호출)"
     },
     "English": {
         "guide_btn": "📖 Guide", "api_btn": "🔑 API Settings", "options_btn": "📝 Options",
@@ -174,7 +200,9 @@ UI_TEXT = {
         "theme_apply": "Apply Theme", "data_warn": "This action cannot be undone.",
         "data_clear": "Clear All History",
         "export_mode_integrated": "Integrated", "export_mode_problem": "Problem Only",
-        "export_mode_solution": "Solution Only"
+        "export_mode_solution": "Solution Only", "native_text": "🔤 Text PDF (compact, searchable)",
+        "twin_count": "Number of twins", "stream_mode": "Live preview", "stream_draft": "Draft preview",
+        "force_fresh": "Force fresh (skip cache)", "fast_mode": "⚡ Fast mode (single call)"
     }
 }
 def T(key):
@@ -302,47 +330,216 @@ def display_bottom_ad():
 # =========================================================================
 # 3. Utilities & Logic
 # =========================================================================
-def load_reference_materials():
-    if not os.path.exists(REF_DIR_PATH):
-        try:
-            os.makedirs(REF_DIR_PATH)
-        except:
-            pass
-        return "", 0
-    combined_text = ""
-    file_count = 0
+REF_MAX_PDF_PAGES = int(os.environ.get("REF_MAX_PDF_PAGES", "50"))
+REF_INDEX_PATH = os.environ.get("REF_INDEX_PATH", os.path.join(tempfile.gettempdir(), "math_twin_cache", "references.json"))
+REF_EXTRACT_WORKERS = int(os.environ.get("REF_EXTRACT_WORKERS", "0")) or min(4, os.cpu_count() or 1)
+def _extract_reference_file(file_path):
+    # 참고자료 한 파일의 텍스트 (실패 시 None)
     try:
-        files = os.listdir(REF_DIR_PATH)
-        for filename in files:
-            file_path = os.path.join(REF_DIR_PATH, filename)
-            if filename.lower().endswith('.pdf'):
-                try:
-                    with fitz.open(file_path) as doc:
-                        max_p = min(doc.page_count, 50)
-                        for i in range(max_p):
-                            combined_text += doc.load_page(i).get_text() + "\n"
-                    file_count += 1
-                except:
-                    pass
-            elif filename.lower().endswith('.txt'):
-                try:
-                    with open(file_path, 'r', encoding='utf-8') as f:
-                        combined_text += f.read() + "\n"
-                    file_count += 1
-                except:
-                    pass
+        if file_path.lower().endswith('.pdf'):
+            with fitz.open(file_path) as doc:
+                return "\n".join(doc.load_page(i).get_text() for i in range(min(doc.page_count, REF_MAX_PDF_PAGES)))
+        with open(file_path, 'r', encoding='utf-8') as f:
+            return f.read()
     except:
-        pass
-    return combined_text, file_count
+        return None
+class ReferenceLibrary:
+    # references/ 텍스트를 프로세스당 한 번만 추출해 모든 세션이 같은 (읽기 전용) 문자열을 공유
+    # 파일별 (mtime, size) 지문과 추출 결과를 디스크에 저장해 바뀐 파일만 다시 추출한다
+    def __init__(self, ref_dir=REF_DIR_PATH, index_path=REF_INDEX_PATH):
+        self.ref_dir = ref_dir
+        self.index_path = index_path
+        self._lock = threading.Lock()
+        self._files = None
+        self._snapshot = (None, "", 0)
+    def scan(self):
+        fingerprints = {}
+        try:
+            with os.scandir(self.ref_dir) as it:
+                for entry in it:
+                    if entry.is_file() and entry.name.lower().endswith(('.pdf', '.txt')):
+                        info = entry.stat()
+                        fingerprints[entry.name] = [info.st_mtime_ns, info.st_size]
+        except FileNotFoundError:
+            try:
+                os.makedirs(self.ref_dir)
+            except:
+                pass
+        except OSError:
+            pass
+        return fingerprints
+    def _load_store(self):
+        if not self.index_path:
+            return {}
+        try:
+            with open(self.index_path, encoding="utf-8") as f:
+                store = json.load(f)
+            return store if store.get("dir") == os.path.abspath(self.ref_dir) else {}
+        except (OSError, ValueError):
+            return {}
+    def _save_store(self):
+        if not self.index_path:
+            return
+        try:
+            os.makedirs(os.path.dirname(self.index_path) or ".", exist_ok=True)
+            tmp_path = f"{self.index_path}.{os.getpid()}.tmp"
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                json.dump({"dir": os.path.abspath(self.ref_dir), "files": self._files}, f, ensure_ascii=False)
+            os.replace(tmp_path, self.index_path)
+        except OSError:
+            pass
+    def _extract(self, names):
+        # 바뀐 파일만 스레드 풀로 추출 (파일 I/O 와 fitz 위주라 프로세스 풀을 띄울 필요가 없다)
+        paths = [os.path.join(self.ref_dir, name) for name in names]
+        if len(paths) > 1 and REF_EXTRACT_WORKERS > 1:
+            with ThreadPoolExecutor(max_workers=min(REF_EXTRACT_WORKERS, len(paths))) as pool:
+                return list(pool.map(_extract_reference_file, paths))
+        return [_extract_reference_file(p) for p in paths]
+    def load(self):
+        # -> (text, file_count); 디렉터리가 바뀌지 않았으면 기존 문자열을 그대로 돌려준다
+        fingerprints = self.scan()
+        snapshot = self._snapshot
+        if fingerprints == snapshot[0]:
+            return snapshot[1], snapshot[2]
+        with self._lock:
+            snapshot = self._snapshot
+            if fingerprints == snapshot[0]:
+                return snapshot[1], snapshot[2]
+            if self._files is None:
+                self._files = self._load_store().get("files", {})
+            files = {name: entry for name, entry in self._files.items() if name in fingerprints and entry.get("fp") == fingerprints[name]}
+            changed = sorted(name for name in fingerprints if name not in files)
+            for name, text in zip(changed, self._extract(changed)):
+                files[name] = {"fp": fingerprints[name], "text": text}
+            dirty = bool(changed) or len(files) != len(self._files)
+            self._files = files
+            texts = [files[name]["text"] for name in sorted(files) if files[name]["text"] is not None]
+            text = "\n".join(texts) + "\n" if texts else ""
+            self._snapshot = (fingerprints, text, len(texts))
+            if dirty:
+                self._save_store()
+            return text, len(texts)
+@st.cache_resource
+def get_reference_library(ref_dir=REF_DIR_PATH, index_path=REF_INDEX_PATH):
+    # 프로세스당 하나: 재실행/세션마다 인덱스 JSON 을 다시 읽지 않고 같은 텍스트를 공유한다
+    return ReferenceLibrary(ref_dir, index_path)
+REFERENCE_LIBRARY = get_reference_library()
+def load_reference_materials():
+    return REFERENCE_LIBRARY.load()
 def check_files():
     if not os.path.exists(FONT_PATH):
         pass
-    if not st.session_state['base_ref_text']:
-        text, count = load_reference_materials()
-        if count > 0:
-            st.session_state['base_ref_text'] = text
-            st.toast(f"📚 Loaded {count} reference files!", icon="🟣")
+    text, count = load_reference_materials()
+    if count > 0 and st.session_state.get('ref_loaded_count') != count:
+        st.session_state['ref_loaded_count'] = count
+        st.toast(f"📚 Loaded {count} reference files!", icon="🟣")
     return True
+CURRICULUM_TOKEN_BUDGET = int(os.environ.get("CURRICULUM_TOKEN_BUDGET", "1500"))
+CURRICULUM_CHUNK_CHARS = int(os.environ.get("CURRICULUM_CHUNK_CHARS", "600"))
+# 성취기준 코드의 학년군 접두어 (예: [9수학02-04])
+GRADE_STANDARD_CODES = {
+    "Elementary 3": "4", "Elementary 4": "4", "Elementary 5": "6", "Elementary 6": "6",
+    "Middle 1": "9", "Middle 2": "9", "Middle 3": "9", "High 1": "10", "High 2": "12", "High 3": "12"
+}
+def estimate_tokens(text):
+    # 한글 1자 ~ 0.75 토큰, 영문 4자 ~ 1 토큰 정도로 근사
+    return len(text.encode("utf-8")) // 4 + 1
+class CurriculumIndex:
+    # 교육과정/참고자료 텍스트를 청크로 나눠 BM25 로 검색 (NumPy, 역색인은 term 별 CSC 배열)
+    K1 = 1.2
+    B = 0.75
+    WORD_RE = re.compile(r"\d+|[a-z]+|[가-힣]+")
+    CODE_RE = re.compile(r"\[(\d+)[가-힣]+")
+    def __init__(self, texts, chunk_chars=CURRICULUM_CHUNK_CHARS):
+        self.chunks = []
+        for text in texts:
+            self.chunks.extend(self.split(text or "", chunk_chars))
+        self.vocab = {}
+        doc_ids, term_ids = [], []
+        lengths = np.zeros(len(self.chunks), dtype=np.float32)
+        for d, chunk in enumerate(self.chunks):
+            tokens = self.tokenize(chunk)
+            lengths[d] = len(tokens)
+            for tok in tokens:
+                term_ids.append(self.vocab.setdefault(tok, len(self.vocab)))
+                doc_ids.append(d)
+        self.lengths = lengths
+        self.avg_length = float(lengths.mean()) if len(lengths) else 0.0
+        # (term, doc) 쌍별 tf 를 term 순으로 정렬해 postings 를 연속 구간으로 저장
+        pairs = np.array(term_ids, dtype=np.int64) * max(1, len(self.chunks)) + np.array(doc_ids, dtype=np.int64)
+        pairs, tf = np.unique(pairs, return_counts=True)
+        self.post_docs = (pairs % max(1, len(self.chunks))).astype(np.int32)
+        self.post_tf = tf.astype(np.float32)
+        self.term_ptr = np.searchsorted(pairs // max(1, len(self.chunks)), np.arange(len(self.vocab) + 1))
+        df = np.diff(self.term_ptr).astype(np.float32)
+        self.idf = np.log(1.0 + (len(self.chunks) - df + 0.5) / (df + 0.5))
+    @staticmethod
+    def split(text, chunk_chars):
+        # 줄 단위로 모아 chunk_chars 이하의 청크를 만든다 (긴 줄은 잘라서)
+        chunks, current, size = [], [], 0
+        for line in text.splitlines():
+            line = line.strip()
+            while len(line) > chunk_chars:
+                chunks.append(line[:chunk_chars])
+                line = line[chunk_chars:]
+            if not line:
+                continue
+            if size + len(line) > chunk_chars and current:
+                chunks.append("\n".join(current))
+                current, size = [], 0
+            current.append(line)
+            size += len(line) + 1
+        if current:
+            chunks.append("\n".join(current))
+        return chunks
+    @classmethod
+    def tokenize(cls, text):
+        text = text.lower()
+        tokens = [f"code:{m}" for m in cls.CODE_RE.findall(text)]
+        for word in cls.WORD_RE.findall(text):
+            tokens.append(word)
+            # 한글은 조사가 붙으므로 2-gram 도 색인
+            if len(word) > 2 and "가" <= word[0] <= "힣":
+                tokens.extend(word[i:i + 2] for i in range(len(word) - 1))
+        return tokens
+    def scores(self, query):
+        scores = np.zeros(len(self.chunks), dtype=np.float32)
+        norm = self.K1 * (1 - self.B + self.B * self.lengths / max(self.avg_length, 1.0))
+        for tok in set(self.tokenize(query)):
+            t = self.vocab.get(tok)
+            if t is None:
+                continue
+            lo, hi = self.term_ptr[t], self.term_ptr[t + 1]
+            docs, tf = self.post_docs[lo:hi], self.post_tf[lo:hi]
+            scores[docs] += self.idf[t] * tf * (self.K1 + 1) / (tf + norm[docs])
+        return scores
+    def select(self, query, token_budget=CURRICULUM_TOKEN_BUDGET):
+        # 관련도 순으로 예산 안에서 청크를 고르고 원래 순서대로 이어 붙인다 (매칭이 없으면 앞부분)
+        if not self.chunks:
+            return ""
+        scores = self.scores(query)
+        order = np.argsort(-scores, kind="stable") if scores.max() > 0 else np.arange(len(self.chunks))
+        picked, used = [], 0
+        for d in order:
+            cost = estimate_tokens(self.chunks[d])
+            if used + cost > token_budget:
+                if picked:
+                    break
+                continue
+            picked.append(d)
+            used += cost
+        return "\n...\n".join(self.chunks[d] for d in sorted(picked))
+@st.cache_resource(max_entries=16, show_spinner=False)
+def curriculum_index(*texts):
+    # 재실행마다 모듈이 새로 실행되어도 색인은 프로세스 전역으로 유지
+    return CurriculumIndex(texts)
+def select_curriculum_context(texts, query, token_budget=CURRICULUM_TOKEN_BUDGET):
+    texts = tuple(t for t in texts if t and t.strip())
+    if not texts:
+        return ""
+    if sum(estimate_tokens(t) for t in texts) <= token_budget:
+        return "\n".join(t.strip() for t in texts)
+    return curriculum_index(*texts).select(query, token_budget)
 def extract_text_safe(uploaded_file):
     text_content = ""
     try:
@@ -393,12 +590,341 @@ def clean_python_code(code):
     code = re.sub(r'\\\s*\n', ' ', code)
     code = code.replace('plt.show()', '# plt.show() removed')
     return code
+FIGURE_MAX_ARRAY = int(os.environ.get("FIGURE_MAX_ARRAY", "4000000"))
+FIGURE_MAX_LINSPACE = int(os.environ.get("FIGURE_MAX_LINSPACE", "2000"))
+FIGURE_MAX_LOOP_ITERATIONS = int(os.environ.get("FIGURE_MAX_LOOP_ITERATIONS", "1000000"))
+class DrawingCodeValidator(ast.NodeTransformer):
+    # drawing_code 사전 검사: import/호출 화이트리스트 + 배열 크기/반복 횟수 정적 추정 (linspace 는 잘라내고 나머지는 거부)
+    ALLOWED_MODULES = ('numpy', 'math', 'cmath', 'fractions', 'decimal', 'itertools', 'random', 'statistics', 'matplotlib', 'mpl_toolkits')
+    SAFE_BUILTINS = {
+        'range', 'len', 'abs', 'min', 'max', 'sum', 'round', 'int', 'float', 'str', 'bool', 'complex', 'list', 'tuple', 'dict', 'set',
+        'zip', 'enumerate', 'sorted', 'reversed', 'map', 'filter', 'print', 'isinstance', 'pow', 'divmod', 'any', 'all', 'format',
+        'iter', 'next', 'slice', 'frozenset', 'chr', 'ord', 'hasattr', 'Exception', 'ValueError', 'ZeroDivisionError', 'True', 'False', 'None',
+        'TypeError', 'IndexError', 'KeyError', 'ArithmeticError', 'OverflowError', 'RuntimeError', 'StopIteration', 'NotImplementedError',
+        'object', 'super', 'property', 'staticmethod', 'classmethod', 'callable', 'repr'
+    }
+    BLOCKED_ATTRS = {
+        'os', 'sys', 'subprocess', 'ctypes', 'ctypeslib', 'f2py', 'load', 'save', 'savez', 'savez_compressed', 'savetxt', 'loadtxt',
+        'genfromtxt', 'fromfile', 'tofile', 'memmap', 'DataSource', 'system', 'popen', 'lib', 'testing', 'distutils', 'fromregex',
+        'open_memmap', 'dump', 'dumps', 'loads', 'savefig', 'imsave', 'imread', 'print_figure', 'addfont', 'rc_file', 'open', 'file'
+    }
+    # matplotlib 에서 허용하는 하위 모듈/속성 (image, animation, backends 등 파일 입출력 경로는 제외)
+    MATPLOTLIB_MEMBERS = {
+        'pyplot', 'patches', 'colors', 'ticker', 'lines', 'collections', 'path', 'transforms', 'cm', 'colormaps', 'text', 'markers',
+        'gridspec', 'patheffects', 'style', 'dates', 'axes', 'figure', 'legend', 'rcParams', 'rc', 'rcdefaults', 'use', 'interactive'
+    }
+    # 객체 메서드 호출은 그림/배열/기본 자료형 클래스에 실제로 있는 공개 메서드만 허용 (파일 쓰기 메서드 제외)
+    METHOD_CLASSES = (
+        'matplotlib.axes.Axes', 'matplotlib.figure.Figure', 'matplotlib.axis.XAxis', 'matplotlib.spines.Spine', 'matplotlib.lines.Line2D',
+        'matplotlib.text.Annotation', 'matplotlib.patches.FancyArrowPatch', 'matplotlib.patches.Polygon', 'matplotlib.patches.Ellipse',
+        'matplotlib.patches.Rectangle', 'matplotlib.patches.Wedge', 'matplotlib.collections.PathCollection', 'matplotlib.collections.PolyCollection',
+        'matplotlib.legend.Legend', 'matplotlib.colorbar.Colorbar', 'matplotlib.image.AxesImage', 'matplotlib.contour.QuadContourSet',
+        'matplotlib.container.BarContainer', 'matplotlib.ticker.MaxNLocator', 'matplotlib.ticker.FuncFormatter', 'matplotlib.colors.Colormap',
+        'matplotlib.transforms.Bbox', 'matplotlib.path.Path', 'mpl_toolkits.mplot3d.axes3d.Axes3D', 'numpy.ndarray', 'numpy.random.Generator',
+        'random.Random', 'fractions.Fraction', 'builtins.list', 'builtins.dict', 'builtins.str', 'builtins.set', 'builtins.tuple',
+        'builtins.complex', 'builtins.float', 'builtins.int'
+    )
+    LOOP_GUARD = '__loop_guard__'
+    # 샌드박스의 pyplot 대체 객체에서 아무 일도 하지 않는 호출
+    SHIM_NOOPS = {'matplotlib.pyplot.savefig'}
+    def __init__(self):
+        self.aliases = {'np': 'numpy', 'plt': 'matplotlib.pyplot'}
+        self.scalars = {}
+        self.sizes = {}
+        self.loop_factor = 1
+        self.iterations = 0
+        self.clamped = []
+        self.guarded = 0
+    @staticmethod
+    @functools.lru_cache(maxsize=1)
+    def allowed_methods():
+        import importlib
+        methods = set()
+        for path in DrawingCodeValidator.METHOD_CLASSES:
+            module, _, name = path.rpartition('.')
+            try:
+                cls = getattr(importlib.import_module(module), name)
+            except (ImportError, AttributeError):
+                continue
+            methods.update(m for m in dir(cls) if not m.startswith('_'))
+        return frozenset(methods - DrawingCodeValidator.BLOCKED_ATTRS)
+    @staticmethod
+    def bindings(tree):
+        # (이름, import 여부) - 조건문 안이나 도달 불가능한 코드의 바인딩도 모두 포함
+        # (클래스 본문의 메서드 이름은 클래스 네임스페이스에만 묶이므로 제외)
+        methods = {id(n) for c in ast.walk(tree) if isinstance(c, ast.ClassDef) for n in c.body if isinstance(n, (ast.FunctionDef, ast.AsyncFunctionDef))}
+        for node in ast.walk(tree):
+            if isinstance(node, (ast.FunctionDef, ast.AsyncFunctionDef, ast.ClassDef)):
+                if id(node) not in methods:
+                    yield node.name, False
+            elif isinstance(node, ast.Name) and isinstance(node.ctx, (ast.Store, ast.Del)):
+                yield node.id, False
+            elif isinstance(node, ast.arg):
+                yield node.arg, False
+            elif isinstance(node, ast.ExceptHandler) and node.name:
+                yield node.name, False
+            elif isinstance(node, (ast.Global, ast.Nonlocal)):
+                for name in node.names:
+                    yield name, False
+            elif isinstance(node, (ast.Import, ast.ImportFrom)):
+                for alias in node.names:
+                    yield alias.asname or alias.name.split('.')[0], True
+    @staticmethod
+    def check(code):
+        # -> (ok, message, 실행할 코드)
+        code = clean_python_code(code)
+        try:
+            tree = ast.parse(code)
+        except SyntaxError as e:
+            return False, f"Syntax Error: {e.msg} (line {e.lineno})", code
+        validator = DrawingCodeValidator()
+        try:
+            bindings = list(DrawingCodeValidator.bindings(tree))
+            modules = set(validator.aliases) | {name for name, is_import in bindings if is_import}
+            for name, is_import in bindings:
+                validator._check_binding(name, is_import, modules)
+            tree = validator.visit(tree)
+        except ValueError as e:
+            return False, f"Rejected: {e}", code
+        if validator.clamped or validator.guarded:
+            code = ast.unparse(ast.fix_missing_locations(tree))
+        if validator.clamped:
+            return True, "Clamped: " + ", ".join(validator.clamped), code
+        return True, "Safe", code
+    def _check_binding(self, name, is_import, modules):
+        # 내장 함수/차단 이름/모듈 별칭을 가리는 바인딩은 실행 여부와 관계없이 거부
+        if name.startswith('__') or name in self.BLOCKED_ATTRS:
+            raise ValueError(f"binding {name}")
+        if hasattr(builtins, name) and name not in self.SAFE_BUILTINS:
+            raise ValueError(f"binding shadows builtin {name}")
+        if not is_import and name in modules:
+            raise ValueError(f"binding shadows module alias {name}")
+    def _check_module_path(self, qualname):
+        if qualname in self.SHIM_NOOPS:
+            return
+        parts = qualname.split('.')
+        if parts[0] not in self.ALLOWED_MODULES or any(p in self.BLOCKED_ATTRS or p.startswith('_') for p in parts):
+            raise ValueError(f"call {qualname}")
+        if parts[0] == 'matplotlib' and len(parts) > 1 and parts[1] not in self.MATPLOTLIB_MEMBERS:
+            raise ValueError(f"matplotlib.{parts[1]}")
+    def _guard(self, iterable):
+        # 반복 횟수를 정적으로 알 수 없는 루프는 실행 중 횟수/시간 제한 래퍼를 거친다
+        self.guarded += 1
+        return ast.Call(func=ast.Name(id=self.LOOP_GUARD, ctx=ast.Load()), args=[iterable] if iterable is not None else [], keywords=[])
+    def _qualname(self, node):
+        parts = []
+        while isinstance(node, ast.Attribute):
+            parts.append(node.attr)
+            node = node.value
+        if not isinstance(node, ast.Name):
+            return None
+        parts.append(self.aliases.get(node.id, node.id))
+        return ".".join(reversed(parts))
+    def _number(self, node):
+        if isinstance(node, ast.Constant) and isinstance(node.value, (int, float)) and not isinstance(node.value, bool):
+            return node.value
+        if isinstance(node, ast.Name):
+            return self.scalars.get(node.id)
+        if isinstance(node, ast.Attribute) and self._qualname(node) in ('numpy.pi', 'math.pi', 'numpy.e', 'math.e'):
+            return math.pi if node.attr == 'pi' else math.e
+        if isinstance(node, ast.UnaryOp) and isinstance(node.op, (ast.USub, ast.UAdd)):
+            val = self._number(node.operand)
+            return None if val is None else (-val if isinstance(node.op, ast.USub) else val)
+        if isinstance(node, ast.BinOp):
+            left, right = self._number(node.left), self._number(node.right)
+            if left is None or right is None:
+                return None
+            try:
+                if isinstance(node.op, ast.Pow):
+                    return float('inf') if abs(right) > 64 and abs(left) > 1 else left ** right
+                ops = {ast.Add: lambda a, b: a + b, ast.Sub: lambda a, b: a - b, ast.Mult: lambda a, b: a * b,
+                       ast.Div: lambda a, b: a / b, ast.FloorDiv: lambda a, b: a // b, ast.Mod: lambda a, b: a % b}
+                return ops[type(node.op)](left, right) if type(node.op) in ops else None
+            except:
+                return None
+        if isinstance(node, ast.Call) and isinstance(node.func, ast.Name) and node.func.id in ('int', 'float', 'abs', 'round') and len(node.args) == 1:
+            val = self._number(node.args[0])
+            try:
+                return None if val is None else {'int': int, 'float': float, 'abs': abs, 'round': round}[node.func.id](val)
+            except:
+                return None
+        return None
+    def _shape_size(self, node):
+        if isinstance(node, (ast.Tuple, ast.List)):
+            total = 1
+            for elt in node.elts:
+                n = self._number(elt)
+                if n is None:
+                    return None
+                total *= max(0, n)
+            return total
+        return self._number(node)
+    def _array_size(self, node):
+        if isinstance(node, ast.Name):
+            return self.sizes.get(node.id)
+        if isinstance(node, ast.BinOp):
+            sizes = [s for s in (self._array_size(node.left), self._array_size(node.right)) if s is not None]
+            return max(sizes) if sizes else None
+        if isinstance(node, ast.Call) and isinstance(node.func, (ast.Name, ast.Attribute)):
+            name = self._qualname(node.func) or ""
+            if name.startswith('numpy.') and name.split('.')[-1] in ('sin', 'cos', 'tan', 'exp', 'log', 'sqrt', 'abs', 'array', 'asarray'):
+                return self._array_size(node.args[0]) if node.args else None
+            return self._creation_size(node, name)
+        return None
+    def _creation_size(self, node, name):
+        kw = {k.arg: k.value for k in node.keywords if k.arg}
+        func = name.split('.')[-1] if name.startswith('numpy.') else None
+        if func == 'linspace':
+            num = kw.get('num', node.args[2] if len(node.args) > 2 else None)
+            return 50 if num is None else self._number(num)
+        if func == 'arange':
+            nums = [self._number(a) for a in node.args[:3]]
+            if 'step' in kw:
+                nums = (nums + [0])[:2] + [self._number(kw['step'])]
+            if not nums or any(n is None for n in nums):
+                return None
+            start, stop, step = (0, nums[0], 1) if len(nums) == 1 else (nums[0], nums[1], nums[2] if len(nums) > 2 else 1)
+            if step == 0:
+                raise ValueError("np.arange step is 0")
+            return max(0, math.ceil((stop - start) / step)) if math.isfinite((stop - start) / step) else float('inf')
+        if func == 'meshgrid':
+            total = 1
+            for arg in node.args:
+                size = self._array_size(arg)
+                if size is None:
+                    return None
+                total *= size
+            return total
+        if func in ('zeros', 'ones', 'empty', 'full', 'zeros_like', 'ones_like'):
+            if func.endswith('_like'):
+                return self._array_size(node.args[0]) if node.args else None
+            return self._shape_size(node.args[0]) if node.args else self._shape_size(kw.get('shape'))
+        if name in ('numpy.random.rand', 'numpy.random.randn'):
+            return self._shape_size(ast.Tuple(elts=list(node.args))) if node.args else 1
+        if name.startswith('numpy.random.') and 'size' in kw:
+            return self._shape_size(kw['size'])
+        return None
+    def _trip_count(self, node):
+        if isinstance(node, ast.Call) and isinstance(node.func, ast.Name) and node.func.id == 'range':
+            nums = [self._number(a) for a in node.args]
+            if not nums or any(n is None for n in nums):
+                return None
+            start, stop, step = (0, nums[0], 1) if len(nums) == 1 else (nums[0], nums[1], nums[2] if len(nums) > 2 else 1)
+            if step == 0:
+                raise ValueError("range step is 0")
+            return max(0, math.ceil((stop - start) / step)) if math.isfinite((stop - start) / step) else float('inf')
+        if isinstance(node, (ast.List, ast.Tuple, ast.Set)):
+            return len(node.elts)
+        return self._array_size(node)
+    def _enter_loop(self, trips):
+        factor = self.loop_factor * (trips if trips is not None else 1)
+        self.iterations += factor
+        if self.iterations > FIGURE_MAX_LOOP_ITERATIONS:
+            raise ValueError(f"estimated {int(min(self.iterations, 1e18))} loop iterations (limit {FIGURE_MAX_LOOP_ITERATIONS})")
+        previous, self.loop_factor = self.loop_factor, factor
+        return previous
+    def visit_Import(self, node):
+        for alias in node.names:
+            if alias.name.split('.')[0] not in self.ALLOWED_MODULES:
+                raise ValueError(f"import {alias.name}")
+            self._check_module_path(alias.name)
+            self.aliases[alias.asname or alias.name.split('.')[0]] = alias.name if alias.asname else alias.name.split('.')[0]
+        return node
+    def visit_ImportFrom(self, node):
+        if node.level or not node.module or node.module.split('.')[0] not in self.ALLOWED_MODULES:
+            raise ValueError(f"from {node.module} import")
+        for alias in node.names:
+            if alias.name == '*' or alias.name in self.BLOCKED_ATTRS:
+                raise ValueError(f"from {node.module} import {alias.name}")
+            self._check_module_path(f"{node.module}.{alias.name}")
+            self.aliases[alias.asname or alias.name] = f"{node.module}.{alias.name}"
+        return node
+    def visit_Name(self, node):
+        if node.id.startswith('__'):
+            raise ValueError(f"name {node.id}")
+        if node.id not in self.aliases and node.id not in self.SAFE_BUILTINS and hasattr(builtins, node.id):
+            raise ValueError(f"builtin {node.id}")
+        return node
+    def visit_Attribute(self, node):
+        if node.attr.startswith('__') or (node.attr in self.BLOCKED_ATTRS and self._qualname(node) not in self.SHIM_NOOPS):
+            raise ValueError(f"attribute {node.attr}")
+        self.generic_visit(node)
+        return node
+    def visit_Call(self, node):
+        self.generic_visit(node)
+        name = self._qualname(node.func) if isinstance(node.func, (ast.Name, ast.Attribute)) else None
+        root = node.func
+        while isinstance(root, ast.Attribute):
+            root = root.value
+        if isinstance(root, ast.Name) and root.id in self.aliases and name:
+            self._check_module_path(name)
+        elif isinstance(node.func, ast.Attribute) and node.func.attr not in self.allowed_methods():
+            raise ValueError(f"method {node.func.attr}")
+        if name == 'numpy.linspace':
+            num_node = next((k.value for k in node.keywords if k.arg == 'num'), node.args[2] if len(node.args) > 2 else None)
+            num = self._number(num_node) if num_node is not None else 50
+            if num is not None and num > FIGURE_MAX_LINSPACE:
+                clamp = ast.Constant(FIGURE_MAX_LINSPACE)
+                if len(node.args) > 2:
+                    node.args[2] = clamp
+                else:
+                    for k in node.keywords:
+                        if k.arg == 'num':
+                            k.value = clamp
+                self.clamped.append(f"linspace num {num:g} -> {FIGURE_MAX_LINSPACE}")
+        size = self._creation_size(node, name) if name else None
+        if size is not None and size > FIGURE_MAX_ARRAY:
+            raise ValueError(f"{name.split('.')[-1]} with ~{size:g} elements (limit {FIGURE_MAX_ARRAY})")
+        return node
+    def visit_Assign(self, node):
+        self.generic_visit(node)
+        number = self._number(node.value)
+        size = self._array_size(node.value)
+        for target in node.targets:
+            names = [target] if isinstance(target, ast.Name) else [t for t in getattr(target, 'elts', []) if isinstance(t, ast.Name)]
+            for t in names:
+                self.scalars.pop(t.id, None)
+                self.sizes.pop(t.id, None)
+                if number is not None and isinstance(target, ast.Name):
+                    self.scalars[t.id] = number
+                if size is not None:
+                    self.sizes[t.id] = size
+        return node
+    def visit_For(self, node):
+        self.visit(node.iter)
+        trips = self._trip_count(node.iter)
+        if trips is None:
+            node.iter = self._guard(node.iter)
+        previous = self._enter_loop(trips)
+        for child in node.body + node.orelse:
+            self.visit(child)
+        self.loop_factor = previous
+        return node
+    def visit_While(self, node):
+        if isinstance(node.test, ast.Constant) and node.test.value and not any(isinstance(n, (ast.Break, ast.Return)) for n in ast.walk(node)):
+            raise ValueError("infinite while loop")
+        self.generic_visit(node)
+        node.body.insert(0, ast.Expr(self._guard(None)))
+        return node
+    def _visit_comprehension(self, node):
+        previous = self.loop_factor
+        for gen in node.generators:
+            self.visit(gen.iter)
+            trips = self._trip_count(gen.iter)
+            if trips is None:
+                gen.iter = self._guard(gen.iter)
+            self._enter_loop(trips)
+            for cond in gen.ifs:
+                self.visit(cond)
+        for field in ('elt', 'key', 'value'):
+            if getattr(node, field, None) is not None:
+                self.visit(getattr(node, field))
+        self.loop_factor = previous
+        return node
+    visit_ListComp = visit_SetComp = visit_DictComp = visit_GeneratorExp = _visit_comprehension
 def validate_python_code(code):
-    dangerous = ['import os', 'import sys', 'import subprocess', 'open(', 'exec(', 'eval(', '__import__', 'globals', 'locals', 'urllib', 'requests', 'socket']
-    for kw in dangerous:
-        if kw in code:
-            return False, f"Security Risk: {kw}"
-    return True, "Safe"
+    ok, message, _ = DrawingCodeValidator.check(code)
+    return ok, message
 def split_long_latex(text, limit=80):
     if not text:
         return ""
@@ -419,16 +945,176 @@ def split_long_latex(text, limit=80):
         return content
     processed = re.sub(r'\$[^\$]{' + str(limit) + r',}\$', replacer, text, flags=re.DOTALL)
     return processed
+def bump_history_version():
+    st.session_state['history_version'] = st.session_state.get('history_version', 0) + 1
+def content_digest(obj):
+    return hashlib.sha256(json.dumps(obj, sort_keys=True, ensure_ascii=False, default=str).encode("utf-8")).hexdigest()
+def image_digest(image):
+    if image is None:
+        return None
+    return hashlib.sha256(image.tobytes() + str((image.mode, image.size)).encode("utf-8")).hexdigest()
+def is_api_error(text):
+    text = str(text or "")
+    return not text or text.startswith(("⚠️", "Error ", "Network Error"))
+RESPONSE_REQUIRED_KEYS = ("problem", "hint", "answer", "solution", "concept", "achievement_standard", "drawing_code")
+def is_complete_response(text, required_keys=RESPONSE_REQUIRED_KEYS):
+    # 영구 캐시에 넣어도 되는 응답인지: API 오류가 아니고, 끝까지 파싱되는 JSON 객체이며 필수 키(와 문제 본문)가 있을 것
+    if is_api_error(text):
+        return False
+    match = re.search(r"\{.*\}", str(text), re.DOTALL)
+    try:
+        data = json.loads(match.group(0)) if match else None
+    except ValueError:
+        return False
+    if not isinstance(data, dict) or any(k not in data for k in required_keys):
+        return False
+    return "problem" not in required_keys or bool(str(data["problem"] or "").strip())
+RESPONSE_CACHE_PATH = os.environ.get("RESPONSE_CACHE_PATH", os.path.join(tempfile.gettempdir(), "math_twin_cache", "responses.sqlite3"))
+RESPONSE_CACHE_TTL = float(os.environ.get("RESPONSE_CACHE_TTL", str(7 * 24 * 3600)))
+RESPONSE_CACHE_MAX_BYTES = int(os.environ.get("RESPONSE_CACHE_MAX_BYTES", str(64 * 1024 * 1024)))
+class ResponseCache:
+    # Gemini 응답 영구 캐시 (sqlite): TTL 만료 + 전체 크기 초과 시 오래 안 쓴 항목부터 삭제
+    def __init__(self, path=RESPONSE_CACHE_PATH, ttl=RESPONSE_CACHE_TTL, max_bytes=RESPONSE_CACHE_MAX_BYTES):
+        self.path = path
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self._conn = None
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+    def _connect(self):
+        if self._conn is None:
+            os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+            conn = sqlite3.connect(self.path, timeout=5, check_same_thread=False)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("CREATE TABLE IF NOT EXISTS responses (key TEXT PRIMARY KEY, value TEXT, created REAL, accessed REAL, size INTEGER)")
+            conn.execute("CREATE INDEX IF NOT EXISTS responses_accessed ON responses(accessed)")
+            conn.commit()
+            self._conn = conn
+        return self._conn
+    def get(self, key):
+        if not self.path:
+            return None
+        try:
+            with self._lock:
+                conn = self._connect()
+                row = conn.execute("SELECT value, created FROM responses WHERE key = ?", (key,)).fetchone()
+                now = time.time()
+                if row is not None and now - row[1] > self.ttl:
+                    conn.execute("DELETE FROM responses WHERE key = ?", (key,))
+                    conn.commit()
+                    row = None
+                if row is None:
+                    self.misses += 1
+                    return None
+                conn.execute("UPDATE responses SET accessed = ? WHERE key = ?", (now, key))
+                conn.commit()
+                self.hits += 1
+                return row[0]
+        except sqlite3.Error as e:
+            logger.warning("Response cache read failed: %s", e)
+            return None
+    def put(self, key, value):
+        if not self.path:
+            return
+        try:
+            with self._lock:
+                conn = self._connect()
+                now = time.time()
+                conn.execute("INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?)", (key, value, now, now, len(value.encode("utf-8"))))
+                conn.execute("DELETE FROM responses WHERE created < ?", (now - self.ttl,))
+                total = conn.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0]
+                for old_key, size in conn.execute("SELECT key, size FROM responses ORDER BY accessed").fetchall():
+                    if total <= self.max_bytes:
+                        break
+                    conn.execute("DELETE FROM responses WHERE key = ?", (old_key,))
+                    total -= size
+                conn.commit()
+        except sqlite3.Error as e:
+            logger.warning("Response cache write failed: %s", e)
+    def stats(self):
+        total = self.hits + self.misses
+        return {"hits": self.hits, "misses": self.misses, "hit_rate": self.hits / total if total else 0.0}
+RESPONSE_CACHE = ResponseCache()
+def lazy_export(kind, key, builder):
+    # 다운로드 버튼을 눌렀을 때만 생성하고, key(히스토리 버전/내용 해시)가 같으면 이전 결과를 재사용
+    # (지연 콜백은 스크립트 스레드 밖에서 실행되므로 세션 딕셔너리를 미리 잡아 둔다)
+    cache = st.session_state['export_cache']
+    # st.download_button 은 bytes/BytesIO 만 받으므로 파일 객체 결과는 bytes 로 읽어 저장한다
+    def produce():
+        entry = cache.get(kind)
+        if entry is None or entry[0] != key:
+            value = builder()
+            if hasattr(value, 'read'):
+                with value:
+                    value.seek(0)
+                    value = value.read()
+            entry = (key, value)
+            cache[kind] = entry
+        return entry[1]
+    return produce
 def get_base64_of_bin_file(bin_file):
     data = bin_file.read()
     return base64.b64encode(data).decode()
+class StreamInterrupted(Exception):
+    pass
+class PartialJSONParser:
+    # 스트리밍 중인 JSON 객체에서 값이 완성된 최상위 문자열 필드를 바로 꺼낸다
+    def __init__(self):
+        self.buffer = ""
+        self.pos = 0
+        self.depth = 0
+        self.in_string = False
+        self.escape = False
+        self.string_start = 0
+        self.key = None
+        self.expect_value = False
+        self.fields = {}
+    def feed(self, chunk):
+        # -> 이번 조각으로 새로 완성된 {필드: 값}
+        self.buffer += chunk
+        completed = {}
+        buf = self.buffer
+        for i in range(self.pos, len(buf)):
+            c = buf[i]
+            if self.in_string:
+                if self.escape:
+                    self.escape = False
+                elif c == '\\':
+                    self.escape = True
+                elif c == '"':
+                    self.in_string = False
+                    if self.depth == 1:
+                        try:
+                            value = json.loads(buf[self.string_start:i + 1])
+                        except:
+                            value = None
+                        if self.expect_value and self.key is not None:
+                            self.fields[self.key] = completed[self.key] = value
+                            self.key = None
+                            self.expect_value = False
+                        else:
+                            self.key = value
+            elif c == '"':
+                self.in_string = True
+                self.string_start = i
+            elif c in '{[':
+                self.depth += 1
+            elif c in '}]':
+                self.depth -= 1
+            elif c == ':' and self.depth == 1:
+                self.expect_value = True
+            elif c == ',' and self.depth == 1:
+                self.key = None
+                self.expect_value = False
+        self.pos = len(buf)
+        return completed
 def parse_gemini_json_response(text):
     try:
         match = re.search(r"\{.*\}", text, re.DOTALL)
         cleaned_text = match.group(0) if match else re.sub(r"```(json)?", "", text).replace("```", "").strip()
         data = json.loads(cleaned_text)
-        required_keys = ["problem", "hint", "answer", "solution", "concept", "achievement_standard", "drawing_code"]
-        for key in required_keys:
+        for key in RESPONSE_REQUIRED_KEYS:
             if key not in data:
                 data[key] = ""
             else:
@@ -483,62 +1169,838 @@ def parse_gemini_json_response(text):
 # =========================================================================
 # 4. PDF Generator
 # =========================================================================
-class PDFGenerator:
+TEXT_FONT_FAMILY = ['NanumGothic', 'DejaVu Sans']
+class FigurePyplot:
+    # drawing_code 용 pyplot 대체 객체: 전역 pyplot 상태 대신 하나의 Figure 에만 그린다
+    _AXES_SETTERS = {
+        'xlim': ('get_xlim', 'set_xlim'), 'ylim': ('get_ylim', 'set_ylim'),
+        'xlabel': ('get_xlabel', 'set_xlabel'), 'ylabel': ('get_ylabel', 'set_ylabel'),
+        'title': ('get_title', 'set_title'), 'xticks': ('get_xticks', 'set_xticks'),
+        'yticks': ('get_yticks', 'set_yticks'), 'xscale': ('get_xscale', 'set_xscale'),
+        'yscale': ('get_yscale', 'set_yscale')
+    }
+    _NOOPS = {'show', 'close', 'clf', 'cla', 'ion', 'ioff', 'draw', 'pause', 'savefig', 'switch_backend'}
+    # 전역 스타일/rc 를 바꾸는 호출은 아무 일도 하지 않는 객체로 대신한다 (plt.style.use(...), with plt.style.context(...): 등)
+    _NAMESPACE_NOOPS = {'style', 'rc', 'rc_context', 'rcdefaults', 'xkcd'}
+    def __init__(self, fig):
+        self._fig = fig
+    def figure(self, *args, figsize=None, **kwargs):
+        if figsize:
+            self._fig.set_size_inches(figsize)
+        return self._fig
+    def gcf(self):
+        return self._fig
+    def gca(self):
+        return self._fig.gca()
+    def subplots(self, nrows=1, ncols=1, figsize=None, **kwargs):
+        self._fig.clear()
+        if figsize:
+            self._fig.set_size_inches(figsize)
+        kwargs.pop('num', None)
+        return self._fig, self._fig.subplots(nrows, ncols, **kwargs)
+    def subplot(self, *args, **kwargs):
+        return self._fig.add_subplot(*(args or (1, 1, 1)), **kwargs)
+    def axes(self, rect=None, **kwargs):
+        if rect is None:
+            return self._fig.gca()
+        return self._fig.add_axes(rect, **kwargs)
+    def tight_layout(self, **kwargs):
+        self._fig.tight_layout(**kwargs)
+    def suptitle(self, *args, **kwargs):
+        return self._fig.suptitle(*args, **kwargs)
+    def subplots_adjust(self, **kwargs):
+        self._fig.subplots_adjust(**kwargs)
+    def figtext(self, *args, **kwargs):
+        return self._fig.text(*args, **kwargs)
+    def colorbar(self, mappable=None, **kwargs):
+        return self._fig.colorbar(mappable, ax=kwargs.pop('ax', self._fig.gca()), **kwargs)
+    def setp(self, obj, *args, **kwargs):
+        return matplotlib.artist.setp(obj, *args, **kwargs)
+    def box(self, on=None):
+        ax = self._fig.gca()
+        ax.set_frame_on(not ax.get_frame_on() if on is None else on)
+    def __getattr__(self, name):
+        if name == 'rcParams':
+            # 전역 rcParams 쓰기가 다른 세션에 새지 않도록 사본을 준다
+            self.rcParams = matplotlib.rcParams.copy()
+            return self.rcParams
+        if name in FigurePyplot._NOOPS:
+            return lambda *args, **kwargs: None
+        if name in FigurePyplot._NAMESPACE_NOOPS:
+            return _PyplotNoop(f"pyplot.{name}")
+        if name in FigurePyplot._AXES_SETTERS:
+            getter, setter = FigurePyplot._AXES_SETTERS[name]
+            def accessor(*args, **kwargs):
+                ax = self._fig.gca()
+                if not args and not kwargs:
+                    return getattr(ax, getter)()
+                return getattr(ax, setter)(*args, **kwargs)
+            return accessor
+        if hasattr(matplotlib.axes.Axes, name) and not name.startswith('_'):
+            return getattr(self._fig.gca(), name)
+        attr = getattr(plt, name)
+        if isinstance(attr, type) or not callable(attr) or name in ('get_cmap', 'cycler'):
+            return attr
+        # 대체 객체가 지원하지 않는 pyplot 함수는 그림을 망치지 않도록 무시한다
+        return _PyplotNoop(f"pyplot.{name}")
+class _PyplotNoop:
+    # 호출/속성 접근/with 문 모두 아무 일도 하지 않는 객체
+    def __init__(self, name):
+        self._name = name
+        logger.info("Drawing code: %s ignored", name)
+    def __call__(self, *args, **kwargs):
+        return self
+    def __getattr__(self, name):
+        if name.startswith('__'):
+            raise AttributeError(name)
+        return _PyplotNoop(f"{self._name}.{name}")
+    def __enter__(self):
+        return self
+    def __exit__(self, *exc):
+        return False
+    def __iter__(self):
+        return iter(())
+class _MatplotlibProxy:
+    def __init__(self, pyplot_shim):
+        self.pyplot = pyplot_shim
+    def __getattr__(self, name):
+        if name in ('use', 'rc', 'rcdefaults', 'interactive'):
+            return lambda *args, **kwargs: None
+        if name in ('style', 'rc_context'):
+            return _PyplotNoop(f"matplotlib.{name}")
+        if name == 'rcParams':
+            return self.pyplot.rcParams
+        return getattr(matplotlib, name)
+class RenderEngine:
+    # 세션(스레드)마다 독립된 Figure/Agg 캔버스를 사용해 전역 pyplot 상태를 건드리지 않는다
+    @staticmethod
+    def new_figure(figsize=None):
+        fig = Figure(figsize=figsize)
+        FigureCanvasAgg(fig)
+        return fig
+    @staticmethod
+    @functools.lru_cache(maxsize=16)
+    def text_font(size=12):
+        return FontProperties(family=TEXT_FONT_FAMILY, size=size, math_fontfamily='cm')
+    @staticmethod
+    def figure_to_png(fig, dpi='figure', pad_inches=0.1):
+        buf = io.BytesIO()
+        fig.savefig(buf, format='png', bbox_inches='tight', dpi=dpi, pad_inches=pad_inches)
+        return buf.getvalue()
     @staticmethod
-    def render_text_to_image(text, width_inch=8.0):
+    def wrap_text(text, width=50):
+        math_matches = []
+        def protect(m):
+            math_matches.append(m.group(0))
+            return f"__M_{len(math_matches)-1}__"
+        protected_text = re.sub(r'\$.*?\$', protect, text, flags=re.DOTALL)
+        wrapped_lines = []
+        for line in protected_text.split('\n'):
+            if not line.strip():
+                wrapped_lines.append("")
+                continue
+            lines = textwrap.wrap(line, width=width, break_long_words=False, break_on_hyphens=False)
+            wrapped_lines.extend(lines)
+        final_lines = []
+        for line in wrapped_lines:
+            restored = re.sub(r'__M_(\d+)__', lambda m: math_matches[int(m.group(1))], line)
+            final_lines.append(restored)
+        return final_lines
+    @staticmethod
+    def render_text(text, width_inch=8.0, dpi=300):
         try:
             if not text or not text.strip():
                 return None
-            plt.rcParams['font.family'] = ['NanumGothic', 'DejaVu Sans']
-            plt.rcParams['mathtext.fontset'] = 'cm'
-            plt.rcParams['axes.unicode_minus'] = False
-            plt.clf()
-            plt.close('all')
             text = normalize_latex_text(text)
-            math_matches = []
-            def protect(m):
-                math_matches.append(m.group(0))
-                return f"__M_{len(math_matches)-1}__"
-            protected_text = re.sub(r'\$.*?\$', protect, text, flags=re.DOTALL)
-            wrapped_lines = []
-            for line in protected_text.split('\n'):
-                if not line.strip():
-                    wrapped_lines.append("")
-                    continue
-                lines = textwrap.wrap(line, width=50, break_long_words=False, break_on_hyphens=False)
-                wrapped_lines.extend(lines)
-            final_lines = []
-            for line in wrapped_lines:
-                restored = re.sub(r'__M_(\d+)__', lambda m: math_matches[int(m.group(1))], line)
-                final_lines.append(restored)
+            final_lines = RenderEngine.wrap_text(text)
             wrapped_text = '\n'.join(final_lines)
             height = max(1.0, len(final_lines) * 0.6) + 0.5
-            fig = plt.figure(figsize=(width_inch, height))
+            font = RenderEngine.text_font(12)
+            fig = RenderEngine.new_figure(figsize=(width_inch, height))
             fig.patch.set_facecolor('white')
             try:
-                plt.text(0.01, 0.98, wrapped_text, va='top', ha='left', fontsize=12)
-                plt.axis('off')
-                buf = io.BytesIO()
-                plt.savefig(buf, format='png', bbox_inches='tight', dpi=300, pad_inches=0.1)
-                buf.seek(0)
-                plt.close()
-                return buf
+                ax = fig.add_subplot()
+                ax.text(0.01, 0.98, wrapped_text, va='top', ha='left', fontproperties=font)
+                ax.axis('off')
+                return io.BytesIO(RenderEngine.figure_to_png(fig, dpi=dpi))
             except:
-                plt.clf()
+                fig.clear()
+                ax = fig.add_subplot()
                 clean_text = text.replace('$', '')
-                plt.text(0.01, 0.98, clean_text, va='top', ha='left', fontsize=12)
-                plt.axis('off')
-                buf = io.BytesIO()
-                plt.savefig(buf, format='png', bbox_inches='tight', dpi=300, pad_inches=0.1)
-                buf.seek(0)
-                plt.close()
-                return buf
+                ax.text(0.01, 0.98, clean_text, va='top', ha='left', fontproperties=font)
+                ax.axis('off')
+                return io.BytesIO(RenderEngine.figure_to_png(fig, dpi=dpi))
         except:
             return None
+    @staticmethod
+    def render_formula(tex, fontsize=12, dpi=300):
+        buf = io.BytesIO()
+        depth = math_to_image(tex, buf, prop=RenderEngine.text_font(fontsize), dpi=dpi, format='png')
+        return buf.getvalue(), depth
+    @staticmethod
+    def drawing_namespace(fig):
+        shim = FigurePyplot(fig)
+        mpl_proxy = _MatplotlibProxy(shim)
+        real_import = builtins.__import__
+        def guarded_import(name, globals=None, locals=None, fromlist=(), level=0):
+            if name == 'matplotlib.pyplot' and fromlist:
+                return shim
+            if name in ('matplotlib', 'matplotlib.pyplot'):
+                return mpl_proxy
+            if level or name.split('.')[0] not in DrawingCodeValidator.ALLOWED_MODULES:
+                raise ImportError(f"import of {name} is not allowed in drawing code")
+            return real_import(name, globals, locals, fromlist, level)
+        # 검증기가 허용한 내장 함수만 노출 (class 정의에 필요한 __build_class__ 포함)
+        env_builtins = {name: getattr(builtins, name) for name in DrawingCodeValidator.SAFE_BUILTINS if hasattr(builtins, name)}
+        env_builtins['__import__'] = guarded_import
+        env_builtins['__build_class__'] = builtins.__build_class__
+        return {'__builtins__': env_builtins, '__name__': '__drawing__', 'plt': shim, 'np': np,
+                DrawingCodeValidator.LOOP_GUARD: RenderEngine.loop_guard()}
+    @staticmethod
+    def loop_guard(max_iterations=None, timeout=None):
+        # 검증기가 반복 횟수를 모르는 루프에 끼워 넣는 카운터 (while 본문 첫 줄 / for 의 iterable 래퍼)
+        max_iterations = max_iterations or FIGURE_MAX_LOOP_ITERATIONS
+        deadline = time.monotonic() + (timeout or FIGURE_TIMEOUT)
+        count = [0]
+        def tick():
+            count[0] += 1
+            if count[0] > max_iterations:
+                raise RuntimeError(f"loop limit exceeded ({max_iterations} iterations)")
+            if count[0] % 1024 == 0 and time.monotonic() > deadline:
+                raise RuntimeError("loop time limit exceeded")
+        def guard(iterable=None):
+            if iterable is None:
+                return tick()
+            def counted():
+                for item in iterable:
+                    tick()
+                    yield item
+            return counted()
+        return guard
+    @staticmethod
+    def run_drawing_code(code):
+        code = clean_python_code(code)
+        fig = RenderEngine.new_figure()
+        exec(code, RenderEngine.drawing_namespace(fig))
+        return fig
+RENDER_CACHE_SIZE = int(os.environ.get("RENDER_CACHE_SIZE", "512"))
+RENDER_CACHE_DIR = os.environ.get("RENDER_CACHE_DIR", "")
+class RenderCache:
+    # 렌더링된 텍스트 이미지(PNG bytes) LRU 캐시 + 선택적 디스크 계층
+    def __init__(self, max_items=RENDER_CACHE_SIZE, disk_dir=RENDER_CACHE_DIR or None):
+        self.max_items = max_items
+        self.disk_dir = disk_dir
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.saved_seconds = 0.0
+        self._cost = {}
+        if self.disk_dir:
+            try:
+                os.makedirs(self.disk_dir, exist_ok=True)
+            except:
+                self.disk_dir = None
+    @staticmethod
+    def make_key(text, width_inch, dpi):
+        raw = f"{width_inch:.4f}|{dpi}|{normalize_latex_text(text)}"
+        return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+    def _disk_path(self, key):
+        return os.path.join(self.disk_dir, key[:2], key + ".png")
+    def get(self, key):
+        with self._lock:
+            data = self._items.get(key)
+            if data is not None:
+                self._items.move_to_end(key)
+                self.hits += 1
+                self.saved_seconds += self._cost.get(key, 0.0)
+                return data
+        if self.disk_dir:
+            try:
+                with open(self._disk_path(key), "rb") as f:
+                    data = f.read()
+                with self._lock:
+                    self.disk_hits += 1
+                self._put_memory(key, data)
+                return data
+            except OSError:
+                pass
+        with self._lock:
+            self.misses += 1
+        return None
+    def _put_memory(self, key, data):
+        with self._lock:
+            self._items[key] = data
+            self._items.move_to_end(key)
+            while len(self._items) > self.max_items:
+                old_key, _ = self._items.popitem(last=False)
+                self._cost.pop(old_key, None)
+    def put(self, key, data, cost=0.0):
+        self._put_memory(key, data)
+        with self._lock:
+            self._cost[key] = cost
+        if self.disk_dir:
+            path = self._disk_path(key)
+            try:
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                tmp_path = f"{path}.{os.getpid()}.tmp"
+                with open(tmp_path, "wb") as f:
+                    f.write(data)
+                os.replace(tmp_path, path)
+            except OSError:
+                pass
+    def clear(self):
+        with self._lock:
+            self._items.clear()
+            self._cost.clear()
+            self.hits = self.disk_hits = self.misses = 0
+            self.saved_seconds = 0.0
+    def stats(self):
+        with self._lock:
+            total = self.hits + self.disk_hits + self.misses
+            return {
+                "items": len(self._items), "hits": self.hits, "disk_hits": self.disk_hits,
+                "misses": self.misses, "hit_rate": (self.hits + self.disk_hits) / total if total else 0.0,
+                "saved_seconds": round(self.saved_seconds, 3)
+            }
+@st.cache_resource
+def shared_cache(name, max_items, disk_dir=None):
+    # 이름별 프로세스 전역 캐시: Streamlit 은 재실행마다 이 모듈을 새로 실행하므로 모듈 변수 대신 여기에 둔다
+    return RenderCache(max_items=max_items, disk_dir=disk_dir)
+@st.cache_resource
+def shared_registry(name):
+    # 이름별 프로세스 전역 (lock, dict): 세션/재실행이 함께 쓰는 상태
+    return threading.Lock(), {}
+RENDER_CACHE = shared_cache("render", RENDER_CACHE_SIZE, RENDER_CACHE_DIR or None)
+FORMULA_CACHE = shared_cache("formula", int(os.environ.get("FORMULA_CACHE_SIZE", "2048")))
+FIGURE_CACHE = shared_cache("figure", int(os.environ.get("FIGURE_CACHE_SIZE", "256")))
+WORKBOOK_FRAGMENTS = shared_cache("workbook_fragments", int(os.environ.get("WORKBOOK_FRAGMENT_CACHE_SIZE", "1024")))
+RENDER_WORKERS = int(os.environ.get("RENDER_WORKERS", "0")) or (os.cpu_count() or 1)
+PARALLEL_RENDER_MIN_JOBS = int(os.environ.get("PARALLEL_RENDER_MIN_JOBS", "8"))
+ZIP_SPOOL_MAX_BYTES = int(os.environ.get("ZIP_SPOOL_MAX_BYTES", str(8 * 1024 * 1024)))
+FIGURE_WORKERS = int(os.environ.get("FIGURE_WORKERS", "2"))
+FIGURE_CPU_SECONDS = int(os.environ.get("FIGURE_CPU_SECONDS", "10"))
+FIGURE_MEMORY_MB = int(os.environ.get("FIGURE_MEMORY_MB", "1024"))
+FIGURE_TIMEOUT = float(os.environ.get("FIGURE_TIMEOUT", "20"))
+FIGURE_STARTUP_TIMEOUT = float(os.environ.get("FIGURE_STARTUP_TIMEOUT", "60"))
+# 워커는 spawn 으로 새 인터프리터에서 시작한다: 멀티스레드 서버에서 fork 하면 다른 스레드가 잡고 있던
+# matplotlib 렌더 락 등이 잠긴 채로 복제되어 자식이 멈출 수 있다
+WORKER_START_METHOD = os.environ.get("WORKER_START_METHOD", "spawn")
+def _figure_worker_main(conn, memory_mb, cpu_seconds):
+    # 샌드박스 워커: 앱 모듈을 새로 import 한 뒤 워밍업을 끝내고 ('ready',) 를 보낸다
+    try:
+        import resource
+        base = 0
+        try:
+            with open('/proc/self/statm') as f:
+                base = int(f.read().split()[0]) * os.sysconf('SC_PAGE_SIZE')
+        except:
+            pass
+        limit = base + memory_mb * 1024 * 1024
+        resource.setrlimit(resource.RLIMIT_AS, (limit, resource.getrlimit(resource.RLIMIT_AS)[1]))
+        cpu_hard = resource.getrlimit(resource.RLIMIT_CPU)[1]
+    except:
+        resource = None
+    try:
+        # 폰트/백엔드 초기화를 미리 끝내 첫 작업도 빠르게
+        RenderEngine.figure_to_png(RenderEngine.run_drawing_code("plt.plot([0, 1], [0, 1])"))
+    except:
+        pass
+    try:
+        conn.send(('ready',))
+    except (EOFError, OSError):
+        return
+    while True:
+        try:
+            code = conn.recv()
+        except (EOFError, OSError):
+            break
+        if code is None:
+            break
+        try:
+            if resource is not None:
+                usage = resource.getrusage(resource.RUSAGE_SELF)
+                soft = int(usage.ru_utime + usage.ru_stime) + cpu_seconds
+                if cpu_hard != resource.RLIM_INFINITY:
+                    soft = min(soft, cpu_hard)
+                resource.setrlimit(resource.RLIMIT_CPU, (soft, cpu_hard))
+            fig = RenderEngine.run_drawing_code(code)
+            has_axes = len(fig.get_axes()) > 0
+            reply = ('ok', RenderEngine.figure_to_png(fig), has_axes)
+            del fig
+        except MemoryError:
+            reply = ('error', 'memory limit exceeded')
+        except BaseException as e:
+            reply = ('error', f"{type(e).__name__}: {e}")
+        try:
+            conn.send(reply)
+        except (EOFError, OSError):
+            break
+class FigureSandbox:
+    # drawing_code 전용 프로세스 풀: CPU 시간/주소 공간/벽시계 제한, 시간 초과 시 워커 교체
+    # 같은 코드를 동시에 그리려는 스레드들이 공유하는 진행 중 작업 (코드 해시 -> [Event, 결과])
+    _inflight_lock, _inflight = shared_registry("figure_inflight")
+    def __init__(self, size=FIGURE_WORKERS):
+        self._ctx = multiprocessing.get_context(WORKER_START_METHOD)
+        self._idle = queue.Queue()
+        self._lock = threading.Lock()
+        self._closed = False
+        for _ in range(max(1, size)):
+            self._idle.put(self._spawn())
+    @staticmethod
+    def available():
+        return WORKER_START_METHOD in multiprocessing.get_all_start_methods()
+    @staticmethod
+    def instance():
+        return get_figure_sandbox(os.getpid())
+    def close(self):
+        # 쉬고 있는 워커는 바로, 작업 중인 워커는 돌아오는 즉시 종료
+        with self._lock:
+            self._closed = True
+        while True:
+            try:
+                worker = self._idle.get_nowait()
+            except queue.Empty:
+                break
+            FigureSandbox._kill(worker)
+    def _release(self, worker):
+        with self._lock:
+            if not self._closed:
+                self._idle.put(worker)
+                return
+        FigureSandbox._kill(worker)
+    def _spawn(self):
+        # -> [process, pipe, ready]; 준비 완료 신호는 첫 작업 직전에 확인한다
+        parent_conn, child_conn = self._ctx.Pipe()
+        proc = self._ctx.Process(target=render_worker.figure_worker_main, args=(child_conn, FIGURE_MEMORY_MB, FIGURE_CPU_SECONDS), daemon=True)
+        proc.start()
+        child_conn.close()
+        return [proc, parent_conn, False]
+    @staticmethod
+    def _wait_ready(worker):
+        if not worker[2]:
+            if not worker[1].poll(FIGURE_STARTUP_TIMEOUT):
+                raise OSError("figure worker did not start")
+            worker[1].recv()
+            worker[2] = True
+    @staticmethod
+    def _kill(worker):
+        proc, conn, _ = worker
+        try:
+            proc.kill()
+            proc.join(1)
+        except:
+            pass
+        try:
+            conn.close()
+        except:
+            pass
+    def run(self, code, timeout=FIGURE_TIMEOUT):
+        # -> (status, PNG bytes, has_axes); status: 'ok' / 'error'(사용자 코드 예외) / 'timeout' / 'busy'
+        try:
+            worker = self._idle.get(timeout=timeout)
+        except queue.Empty:
+            return 'busy', None, False
+        reply = None
+        try:
+            FigureSandbox._wait_ready(worker)
+            worker[1].send(code)
+            if worker[1].poll(timeout):
+                reply = worker[1].recv()
+        except (EOFError, OSError):
+            reply = None
+        if reply is None:
+            # 시간 초과 또는 워커 사망(SIGXCPU 등) -> 교체
+            self._kill(worker)
+            worker = None
+            if not self._closed:
+                try:
+                    worker = self._spawn()
+                except:
+                    pass
+        if worker is not None:
+            self._release(worker)
+        if reply is None:
+            return 'timeout', None, False
+        if reply[0] == 'ok':
+            return 'ok', reply[1], reply[2]
+        return 'error', None, False
+    @staticmethod
+    def figure_key(code):
+        return hashlib.sha256(code.encode("utf-8")).hexdigest()
+    @staticmethod
+    def render(code):
+        # 코드 해시 -> (PNG bytes, has_axes); 결정적인 결과(성공, 검증 거부, 사용자 코드 예외)만 캐시
+        if not code or "plt" not in code:
+            return None, False
+        key = FigureSandbox.figure_key(code)
+        while True:
+            cached = FIGURE_CACHE.get(key)
+            if cached is not None:
+                return cached
+            with FigureSandbox._inflight_lock:
+                entry = FigureSandbox._inflight.get(key)
+                owner = entry is None
+                if owner:
+                    entry = FigureSandbox._inflight[key] = [threading.Event(), None]
+            if owner:
+                break
+            # 같은 코드를 그리는 중인 스레드의 결과를 공유 (시간 초과 결과도 재실행하지 않음)
+            if entry[0].wait(FIGURE_TIMEOUT * 2) and entry[1] is not None:
+                return entry[1]
+        result = (None, False)
+        try:
+            started = time.perf_counter()
+            ok, message, safe_code = DrawingCodeValidator.check(code)
+            if ok:
+                status, png, has_axes = FigureSandbox._execute(safe_code)
+                result = (png, has_axes)
+            else:
+                logger.info("Drawing code %s", message)
+                status = 'rejected'
+            if status in ('ok', 'error', 'rejected'):
+                FIGURE_CACHE.put(key, result, time.perf_counter() - started)
+            else:
+                logger.warning("Figure rendering %s; result not cached", status)
+            return result
+        finally:
+            entry[1] = result
+            with FigureSandbox._inflight_lock:
+                FigureSandbox._inflight.pop(key, None)
+            entry[0].set()
+    @staticmethod
+    def _execute(code):
+        # -> (status, PNG bytes, has_axes)
+        if not FigureSandbox.available():
+            try:
+                fig = RenderEngine.run_drawing_code(code)
+                return 'ok', RenderEngine.figure_to_png(fig), len(fig.get_axes()) > 0
+            except:
+                return 'error', None, False
+        try:
+            return FigureSandbox.instance().run(code)
+        except OSError:
+            # 샌드박스 워커 기동 실패
+            return 'unavailable', None, False
+@st.cache_resource(on_release=FigureSandbox.close)
+def get_figure_sandbox(pid):
+    # 프로세스당 하나 (Streamlit 재실행/세션마다 새로 만들지 않음); pid 가 다른(fork 된) 자식은 따로 만든다
+    sandbox = FigureSandbox()
+    atexit.register(sandbox.close)
+    return sandbox
+def _history_pdf_job(job):
+    # 워커 프로세스에서 실행: 그림은 부모가 샌드박스로 미리 그려 PNG bytes 로만 넘긴다
+    idx, item, image_preset, fig_png = job
+    title = f"Problem_{idx+1}_{item.get('grade', '').replace(' ', '_')}"
+    try:
+        fig_img = io.BytesIO(fig_png) if fig_png else None
+        return idx, title, PDFGenerator.create_single_pdf(item['data'], title, fig_img, "Integrated", image_preset=image_preset), None
+    except Exception as e:
+        return idx, title, None, str(e)
+def _render_worker_init():
+    # spawn 된 렌더 워커: 폰트/mathtext 초기화를 미리 끝낸다
+    try:
+        RenderEngine.render_text("warm-up $x^2$")
+    except:
+        pass
+def _render_job(job):
+    # 워커 프로세스에서 실행: 캐시/락을 건드리지 않고 엔진만 사용
+    try:
+        buf = RenderEngine.render_text(job[1], job[2], job[3])
+        return buf.getvalue() if buf else None
+    except:
+        return None
+RENDER_POOL_TIMEOUT = float(os.environ.get("RENDER_POOL_TIMEOUT", "120"))
+@st.cache_resource
+def get_render_pool():
+    if RENDER_WORKERS < 2 or WORKER_START_METHOD not in multiprocessing.get_all_start_methods():
+        return None
+    try:
+        return ProcessPoolExecutor(max_workers=RENDER_WORKERS, mp_context=multiprocessing.get_context(WORKER_START_METHOD), initializer=render_worker.render_worker_init)
+    except:
+        return None
+def _discard_render_pool(pool):
+    # 멈춘 워커가 풀을 계속 점유하지 않도록 프로세스를 정리하고 다음 호출에서 새 풀을 만든다
+    get_render_pool.clear()
+    pool.shutdown(wait=False, cancel_futures=True)
+    for proc in list((getattr(pool, '_processes', None) or {}).values()):
+        try:
+            proc.kill()
+        except:
+            pass
+class RenderPool:
+    @staticmethod
+    def text_job(text, width_inch=8.0, dpi=300):
+        return ('text', text, width_inch, dpi)
+    @staticmethod
+    def figure_job(code):
+        return ('figure', code)
+    @staticmethod
+    @functools.lru_cache(maxsize=1)
+    def placeholder_figure():
+        # 시간 안에 끝나지 않은 그림 자리에 넣는 이미지 (캐시하지 않도록 같은 객체를 돌려준다)
+        buf = RenderEngine.render_text("[Figure unavailable]", 4.0, 150)
+        return buf.getvalue() if buf else None
+    @staticmethod
+    def _render_serial(job):
+        if job[0] == 'text':
+            buf = PDFGenerator.render_text_to_image(job[1], job[2], job[3])
+        else:
+            buf = PDFGenerator._generate_figure_from_code(job[1])
+        return buf.getvalue() if buf else None
+    @staticmethod
+    def render_all(jobs, parallel=None):
+        # 중복 제거 후 렌더링; 결과는 job -> PNG bytes(또는 None)
+        results = {}
+        pending = []
+        for job in dict.fromkeys(jobs):
+            if job[0] == 'text':
+                if not job[1] or not job[1].strip():
+                    results[job] = None
+                    continue
+                cached = RENDER_CACHE.get(RenderCache.make_key(job[1], job[2], job[3]))
+                if cached is not None:
+                    results[job] = cached
+                    continue
+            elif not job[1] or "plt" not in job[1]:
+                results[job] = None
+                continue
+            pending.append(job)
+        # 그림은 샌드박스 워커들이 병렬로 처리, 텍스트만 렌더 풀로 보낸다
+        figures = [job for job in pending if job[0] == 'figure']
+        pending = [job for job in pending if job[0] == 'text']
+        fig_exec = ThreadPoolExecutor(max_workers=max(1, min(FIGURE_WORKERS, len(figures)))) if figures else None
+        fig_futures = {fig_exec.submit(RenderPool._render_serial, job): job for job in figures} if fig_exec else {}
+        if parallel is None:
+            parallel = len(pending) >= PARALLEL_RENDER_MIN_JOBS
+        pool = get_render_pool() if parallel and len(pending) > 1 else None
+        if pool is not None:
+            try:
+                started = time.perf_counter()
+                chunk = max(1, len(pending) // (RENDER_WORKERS * 4))
+                for job, data in zip(pending, pool.map(render_worker.render_job, pending, chunksize=chunk, timeout=RENDER_POOL_TIMEOUT)):
+                    results[job] = data
+                    if data is not None:
+                        RENDER_CACHE.put(RenderCache.make_key(job[1], job[2], job[3]), data, (time.perf_counter() - started) / len(pending))
+            except TimeoutError:
+                logger.warning("Render pool timed out after %.0fs; rendering the rest serially", RENDER_POOL_TIMEOUT)
+                _discard_render_pool(pool)
+            except BrokenProcessPool:
+                get_render_pool.clear()
+            except Exception as e:
+                logger.warning("Render pool failed: %s", e)
+        for job in pending:
+            if job not in results:
+                results[job] = RenderPool._render_serial(job)
+        try:
+            for future in as_completed(fig_futures, timeout=FIGURE_STARTUP_TIMEOUT + FIGURE_TIMEOUT * 2):
+                try:
+                    results[fig_futures[future]] = future.result()
+                except:
+                    results[fig_futures[future]] = None
+        except TimeoutError:
+            logger.warning("Figure rendering timed out; using placeholders")
+        for job in fig_futures.values():
+            results.setdefault(job, RenderPool.placeholder_figure())
+        if fig_exec:
+            fig_exec.shutdown(wait=False, cancel_futures=True)
+        return results
+PDF_DEFLATE_LEVEL = int(os.environ.get("PDF_DEFLATE_LEVEL", "9"))
+fpdf_image_parsing.SETTINGS.compression_level = PDF_DEFLATE_LEVEL
+IMAGE_PRESETS = {
+    # text: 본문 이미지 색 모드, figure: 그림 색 모드 (None = 원본 유지)
+    "screen": {"dpi": 150, "text": "gray16", "figure": "palette"},
+    "print": {"dpi": 300, "text": "gray", "figure": None},
+    "archive": {"dpi": 300, "text": "mono", "figure": "palette"}
+}
+DEFAULT_IMAGE_PRESET = os.environ.get("PDF_IMAGE_PRESET", "print")
+class ImageEncoder:
+    # 렌더링 결과 -> PDF 삽입 전 단계: 해상도 맞춤, 색 양자화, 압축
+    _lock = threading.Lock()
+    _stats = {}
+    _cache = shared_cache("image_encoder", int(os.environ.get("ENCODE_CACHE_SIZE", "512")))
+    @staticmethod
+    def _flatten(img):
+        if img.mode in ("RGBA", "LA") or (img.mode == "P" and "transparency" in img.info):
+            img = img.convert("RGBA")
+            bg = Image.new("RGB", img.size, (255, 255, 255))
+            bg.paste(img, mask=img.getchannel("A"))
+            return bg
+        return img if img.mode in ("RGB", "L") else img.convert("RGB")
+    @staticmethod
+    def _encode_uncached(data_bytes, preset, kind, width_mm):
+        conf = IMAGE_PRESETS[preset]
+        img = ImageEncoder._flatten(Image.open(io.BytesIO(data_bytes)))
+        if width_mm:
+            target_px = int(round(width_mm / 25.4 * conf["dpi"]))
+            if 0 < target_px < img.width:
+                img = img.resize((target_px, max(1, round(img.height * target_px / img.width))), Image.LANCZOS)
+        color = conf.get(kind)
+        if color == "gray":
+            img = img.convert("L")
+        elif color == "gray16":
+            img = img.convert("L").quantize(16)
+        elif color == "mono":
+            img = img.convert("L").point(lambda v: 255 if v > 160 else 0, mode="1")
+        elif color == "palette":
+            img = img.convert("RGB").quantize(256, method=Image.Quantize.MEDIANCUT)
+        buf = io.BytesIO()
+        img.save(buf, format="PNG", optimize=True)
+        return buf.getvalue()
+    @staticmethod
+    def encode(data_bytes, preset=None, kind="text", width_mm=0):
+        if not preset or preset not in IMAGE_PRESETS:
+            return data_bytes
+        key = RenderCache.make_key(f"{preset}:{kind}:{hashlib.sha256(data_bytes).hexdigest()}", width_mm, 0)
+        out = ImageEncoder._cache.get(key)
+        if out is None:
+            try:
+                out = ImageEncoder._encode_uncached(data_bytes, preset, kind, width_mm)
+            except:
+                out = data_bytes
+            if len(out) >= len(data_bytes):
+                out = data_bytes
+            ImageEncoder._cache.put(key, out)
+        with ImageEncoder._lock:
+            st_in, st_out, count = ImageEncoder._stats.get(preset, (0, 0, 0))
+            ImageEncoder._stats[preset] = (st_in + len(data_bytes), st_out + len(out), count + 1)
+        return out
+    @staticmethod
+    def stats():
+        with ImageEncoder._lock:
+            return {
+                preset: {"images": count, "bytes_in": b_in, "bytes_out": b_out, "bytes_saved": b_in - b_out}
+                for preset, (b_in, b_out, count) in ImageEncoder._stats.items()
+            }
+class FontRegistry:
+    # NanumGothic TTF 는 프로세스당 한 번만 읽고 파싱한다. 문서마다 cmap/폭 테이블은 공유하고
+    # 서브셋 상태와 (출력 시 서브셋되며 변경되는) fontTools 객체만 새로 만든다.
+    FAMILY = 'NanumGothic'
+    # 파싱한 템플릿과 글꼴 바이트는 재실행/세션이 공유 (fpdf2 내부 필드에 의존하므로 requirements.txt 에서 버전 고정)
+    _lock, _loaded = shared_registry("font_template")
+    _available = None
+    @staticmethod
+    def available():
+        if FontRegistry._available is None:
+            FontRegistry._available = os.path.exists(FONT_PATH)
+        return FontRegistry._available
+    @staticmethod
+    def _load_template():
+        with FontRegistry._lock:
+            if 'template' not in FontRegistry._loaded:
+                with open(FONT_PATH, "rb") as f:
+                    font_bytes = f.read()
+                loader = FPDF()
+                loader.add_font(FontRegistry.FAMILY, '', FONT_PATH)
+                FontRegistry._loaded['bytes'] = font_bytes
+                FontRegistry._loaded['template'] = loader.fonts[FontRegistry.FAMILY.lower()]
+            return FontRegistry._loaded['template'], FontRegistry._loaded['bytes']
+    @staticmethod
+    def ensure(pdf):
+        fontkey = FontRegistry.FAMILY.lower()
+        if fontkey in pdf.fonts:
+            return True
+        if not FontRegistry.available():
+            return False
+        try:
+            template, font_bytes = FontRegistry._load_template()
+            font = copy.copy(template)
+            font.i = len(pdf.fonts) + 1
+            font.ttfont = ttLib.TTFont(io.BytesIO(font_bytes), recalcTimestamp=False, lazy=True)
+            font.missing_glyphs = []
+            font.biggest_size_pt = 0
+            font._hbfont = None
+            font.subset = SubsetMap(font)
+            pdf.fonts[fontkey] = font
+        except:
+            pdf.add_font(FontRegistry.FAMILY, '', FONT_PATH)
+        return True
+class PDFGenerator:
+    @staticmethod
+    def render_text_to_image(text, width_inch=8.0, dpi=300):
+        if not text or not text.strip():
+            return None
+        key = RenderCache.make_key(text, width_inch, dpi)
+        data = RENDER_CACHE.get(key)
+        if data is None:
+            started = time.perf_counter()
+            buf = RenderEngine.render_text(text, width_inch, dpi)
+            if buf is None:
+                return None
+            data = buf.getvalue()
+            RENDER_CACHE.put(key, data, time.perf_counter() - started)
+        return io.BytesIO(data)
+    @staticmethod
+    def render_formula(tex, fontsize=12, dpi=300):
+        # (PNG bytes, 기준선 아래 깊이 pt); 수식 문법 오류면 (b"", 0)
+        key = RenderCache.make_key(f"formula:{fontsize}:{tex}", 0, dpi)
+        glyph = FORMULA_CACHE.get(key)
+        if glyph is None:
+            started = time.perf_counter()
+            try:
+                glyph = RenderEngine.render_formula(tex, fontsize, dpi)
+            except:
+                glyph = (b"", 0)
+            FORMULA_CACHE.put(key, glyph, time.perf_counter() - started)
+        return glyph
+    @staticmethod
+    def _resolve_text_mode(text_mode):
+        # 네이티브 텍스트는 한글 글꼴(NanumGothic)이 있어야 가능
+        if text_mode == "native" and FontRegistry.available():
+            return "native"
+        return "image"
+    @staticmethod
+    def _write_rich_text(pdf, text, line_h=7, font_size=12, dpi=300):
+        # 일반 텍스트는 PDF 글꼴로 쓰고 $...$ 수식만 이미지로 끼워 넣는다
+        pdf.set_font_size(font_size)
+        pad = pdf.get_string_width(' ') / 3
+        baseline = 0.3 * font_size * 25.4 / 72
+        text = normalize_latex_text(text)
+        for part in re.split(r'(\$.*?\$)', text, flags=re.DOTALL):
+            if not part:
+                continue
+            if len(part) > 2 and part.startswith('$') and part.endswith('$'):
+                data, depth = PDFGenerator.render_formula(part, font_size, dpi)
+                if data:
+                    px_w, px_h = Image.open(io.BytesIO(data)).size
+                    w, h = px_w / dpi * 25.4, px_h / dpi * 25.4
+                    depth = depth * 25.4 / 72
+                    max_w = pdf.w - pdf.l_margin - pdf.r_margin - 2 * pad
+                    if w > max_w:
+                        depth *= max_w / w
+                        w, h = max_w, h * max_w / w
+                    if h > line_h * 1.5:
+                        if pdf.get_x() > pdf.l_margin + 0.01:
+                            pdf.ln(line_h)
+                        y = pdf.get_y()
+                        PDFGenerator._embed_image(pdf, data, x=pdf.l_margin, y=y, w=w, h=h)
+                        pdf.set_y(y + h)
+                        continue
+                    if pdf.get_x() + w + 2 * pad > pdf.w - pdf.r_margin:
+                        pdf.ln(line_h)
+                    x, y = pdf.get_x(), pdf.get_y()
+                    # 수식 기준선을 본문 기준선에 맞춘다
+                    top = y + line_h / 2 + baseline - (h - depth)
+                    PDFGenerator._embed_image(pdf, data, x=x + pad, y=top, w=w, h=h)
+                    pdf.set_xy(x + w + 2 * pad, y)
+                    continue
+                part = part.replace('$', '')
+            pdf.write(line_h, part)
+        pdf.ln(line_h)
+    @staticmethod
+    def _add_text_block(pdf, text, w=180, text_mode="image", image=None):
+        if text_mode == "native":
+            PDFGenerator._write_rich_text(pdf, text)
+            return True
+        img = image if image is not None else PDFGenerator.render_text_to_image(text)
+        if img:
+            PDFGenerator._add_image_to_pdf(pdf, img, w=w)
+            return True
+        return False
     class ExamPDF(FPDF):
         def header(self):
-            if os.path.exists(FONT_PATH):
-                self.add_font('NanumGothic', '', FONT_PATH)
+            if FontRegistry.ensure(self):
                 self.set_font('NanumGothic', '', 10)
             else:
                 self.set_font('helvetica', '', 10)
@@ -548,13 +2010,13 @@ class PDFGenerator:
             self.ln(10)
         def footer(self):
             self.set_y(-15)
-            if os.path.exists(FONT_PATH):
+            if FontRegistry.available():
                 self.set_font('NanumGothic', '', 8)
             else:
                 self.set_font('helvetica', 'I', 8)
             self.cell(0, 10, f'Page {self.page_no()}', align='C')
     @staticmethod
-    def _add_image_to_pdf(pdf_obj, image_data, x=None, w=0):
+    def _add_image_to_pdf(pdf_obj, image_data, x=None, w=0, kind="text"):
         if not image_data:
             return
         data_bytes = None
@@ -566,46 +2028,29 @@ class PDFGenerator:
             data_bytes = buf.getvalue()
         if not data_bytes:
             return
+        data_bytes = ImageEncoder.encode(data_bytes, getattr(pdf_obj, 'image_preset', None), kind, w)
         try:
-            with tempfile.NamedTemporaryFile(delete=False, suffix=".png") as tmp:
-                tmp.write(data_bytes)
-                tmp_path = tmp.name
             if x is not None:
-                pdf_obj.image(tmp_path, x=x, w=w)
+                PDFGenerator._embed_image(pdf_obj, data_bytes, x=x, w=w)
             else:
-                pdf_obj.image(tmp_path, w=w)
+                PDFGenerator._embed_image(pdf_obj, data_bytes, w=w)
         except:
             pass
-        finally:
-            if 'tmp_path' in locals() and os.path.exists(tmp_path):
-                try:
-                    os.unlink(tmp_path)
-                except:
-                    pass
+    @staticmethod
+    def _embed_image(pdf_obj, data_bytes, **kwargs):
+        # 메모리에서 바로 넘긴다; fpdf2 는 문서별 image_cache 에서 바이트 해시로 같은 이미지를 한 번만 임베드하고 재참조한다.
+        pdf_obj.image(io.BytesIO(data_bytes), **kwargs)
     @staticmethod
     def _generate_figure_from_code(code):
-        if not code or "plt" not in code:
-            return None
-        try:
-            code = clean_python_code(code)
-            plt.clf()
-            plt.close('all')
-            fig = plt.figure()
-            local_vars = {'plt': plt, 'np': np}
-            exec(code, local_vars)
-            buf = io.BytesIO()
-            plt.savefig(buf, format='png', bbox_inches='tight')
-            buf.seek(0)
-            plt.close('all')
-            return buf
-        except:
-            return None
+        png, _ = FigureSandbox.render(code)
+        return io.BytesIO(png) if png else None
     @staticmethod
-    def create_single_pdf(data, title, figure_image, export_mode="Integrated"):
+    def create_single_pdf(data, title, figure_image, export_mode="Integrated", text_mode="image", image_preset=DEFAULT_IMAGE_PRESET):
+        text_mode = PDFGenerator._resolve_text_mode(text_mode)
         pdf = PDFGenerator.ExamPDF()
+        pdf.image_preset = image_preset
         pdf.add_page()
-        if os.path.exists(FONT_PATH):
-            pdf.add_font('NanumGothic', '', FONT_PATH)
+        if FontRegistry.ensure(pdf):
             pdf.set_font('NanumGothic', '', 12)
         if export_mode in ["Integrated", "Problem Only"]:
             meta = ""
@@ -623,14 +2068,12 @@ class PDFGenerator:
             pdf.cell(0, 10, title, ln=True)
             pdf.ln(5)
             prob_txt = data.get('problem', '').replace('\n', '\n\n')
-            prob_img = PDFGenerator.render_text_to_image(prob_txt)
-            if prob_img:
-                PDFGenerator._add_image_to_pdf(pdf, prob_img, w=180)
+            if PDFGenerator._add_text_block(pdf, prob_txt, 180, text_mode):
                 pdf.ln(5)
             else:
                 pdf.multi_cell(0, 8, prob_txt.replace('$', ''))
             if figure_image:
-                PDFGenerator._add_image_to_pdf(pdf, figure_image, x=55, w=100)
+                PDFGenerator._add_image_to_pdf(pdf, figure_image, x=55, w=100, kind="figure")
                 pdf.ln(5)
         if export_mode in ["Integrated", "Solution Only"]:
             if export_mode == "Integrated":
@@ -638,30 +2081,89 @@ class PDFGenerator:
             pdf.set_font_size(14)
             pdf.cell(0, 10, "Answer & Solution", ln=True, align='C')
             pdf.ln(10)
-            ans_img = PDFGenerator.render_text_to_image(f"[Answer]\n{data.get('answer', '')}")
-            if ans_img:
-                PDFGenerator._add_image_to_pdf(pdf, ans_img, w=180)
+            if PDFGenerator._add_text_block(pdf, f"[Answer]\n{data.get('answer', '')}", 180, text_mode):
                 pdf.ln(5)
             if data.get('hint'):
-                hint_img = PDFGenerator.render_text_to_image(f"[Hint]\n{data.get('hint', '')}")
-                if hint_img:
-                    PDFGenerator._add_image_to_pdf(pdf, hint_img, w=180)
+                if PDFGenerator._add_text_block(pdf, f"[Hint]\n{data.get('hint', '')}", 180, text_mode):
                     pdf.ln(5)
             sol_txt = f"[Solution]\n{data.get('solution', '')}".replace('\n', '\n\n')
-            chunk_img = PDFGenerator.render_text_to_image(sol_txt)
-            if chunk_img:
-                PDFGenerator._add_image_to_pdf(pdf, chunk_img, w=180)
-            else:
+            if not PDFGenerator._add_text_block(pdf, sol_txt, 180, text_mode):
                 pdf.multi_cell(0, 8, sol_txt.replace('$', ''))
         out = pdf.output(dest='S')
         if isinstance(out, str):
             return out.encode('latin-1')
         return bytes(out)
     @staticmethod
-    def create_workbook_pdf(history_items, title="My Math Workbook", export_mode="Integrated"):
+    def _workbook_texts(data):
+        prob_txt = data.get('problem', '').replace('\n', '\n\n')
+        sol_txt = f"[Answer] {data.get('answer', '')}\n\n[Solution]\n{data.get('solution', '')}".replace('\n', '\n\n')
+        return prob_txt, sol_txt
+    @staticmethod
+    def _fragment_key(item, text_mode, image_preset):
+        data = item.get('data', {})
+        content = {k: data.get(k, '') for k in ('problem', 'answer', 'solution', 'concept', 'achievement_standard', 'drawing_code')}
+        content.update(grade=item.get('grade', ''), difficulty=item.get('difficulty', ''), text_mode=text_mode, preset=image_preset)
+        return hashlib.sha256(json.dumps(content, sort_keys=True, ensure_ascii=False).encode("utf-8")).hexdigest()
+    @staticmethod
+    def build_workbook_fragments(history_items, export_mode="Integrated", parallel=None, text_mode="image", image_preset=DEFAULT_IMAGE_PRESET):
+        # 문항별 조각(문제/그림/해설 이미지, 빠른 정답)을 내용 해시로 캐시: 문항 하나가 추가되면 그 문항만 렌더링
+        want_problem = export_mode in ["Integrated", "Problem Only"]
+        want_solution = export_mode in ["Integrated", "Solution Only"]
+        fragments = []
+        missing = []
+        for item in history_items:
+            key = PDFGenerator._fragment_key(item, text_mode, image_preset)
+            frag = WORKBOOK_FRAGMENTS.get(key)
+            if frag is None:
+                ans = item['data'].get('answer', '').replace('$', '').strip()
+                frag = {'answer_short': (ans[:30] + '..') if len(ans) > 30 else ans}
+            needed = []
+            if want_problem:
+                needed.append('figure')
+                if text_mode == "image":
+                    needed.append('problem')
+            if want_solution and text_mode == "image":
+                needed.append('solution')
+            needed = [part for part in needed if part not in frag]
+            if needed:
+                missing.append((key, item, frag, needed))
+            fragments.append(frag)
+        if missing:
+            jobs = []
+            for _, item, _, needed in missing:
+                prob_txt, sol_txt = PDFGenerator._workbook_texts(item['data'])
+                if 'problem' in needed:
+                    jobs.append(RenderPool.text_job(prob_txt))
+                if 'figure' in needed and item['data'].get('drawing_code', ''):
+                    jobs.append(RenderPool.figure_job(item['data']['drawing_code']))
+                if 'solution' in needed:
+                    jobs.append(RenderPool.text_job(sol_txt))
+            rendered = RenderPool.render_all(jobs, parallel)
+            for key, item, frag, needed in missing:
+                prob_txt, sol_txt = PDFGenerator._workbook_texts(item['data'])
+                sources = {
+                    'problem': (RenderPool.text_job(prob_txt), 'text', 175),
+                    'figure': (RenderPool.figure_job(item['data'].get('drawing_code', '')), 'figure', 100),
+                    'solution': (RenderPool.text_job(sol_txt), 'text', 175)
+                }
+                transient = False
+                for part in needed:
+                    job, kind, width = sources[part]
+                    png = rendered.get(job)
+                    transient = transient or (png is not None and png is RenderPool.placeholder_figure())
+                    frag[part] = ImageEncoder.encode(png, image_preset, kind, width) if png else None
+                if not transient:
+                    WORKBOOK_FRAGMENTS.put(key, frag)
+        return fragments
+    @staticmethod
+    def create_workbook_pdf(history_items, title="My Math Workbook", export_mode="Integrated", parallel=None, text_mode="image", image_preset=DEFAULT_IMAGE_PRESET):
+        text_mode = PDFGenerator._resolve_text_mode(text_mode)
+        fragments = PDFGenerator.build_workbook_fragments(history_items, export_mode, parallel, text_mode, image_preset)
+        def image_for(png):
+            return io.BytesIO(png) if png else None
         pdf = PDFGenerator.ExamPDF()
-        if os.path.exists(FONT_PATH):
-            pdf.add_font('NanumGothic', '', FONT_PATH)
+        pdf.image_preset = None
+        if FontRegistry.ensure(pdf):
             pdf.set_font('NanumGothic', '', 12)
         pdf.add_page()
         pdf.set_font_size(24)
@@ -676,7 +2178,7 @@ class PDFGenerator:
             pdf.set_font_size(18)
             pdf.cell(0, 15, "PART 1. Problems", ln=True, align='C')
             pdf.ln(10)
-            for idx, item in enumerate(history_items):
+            for idx, (item, frag) in enumerate(zip(history_items, fragments)):
                 data = item['data']
                 pdf.set_font_size(10)
                 pdf.set_text_color(100)
@@ -689,35 +2191,29 @@ class PDFGenerator:
                     meta += f"[{data.get('concept')}]"
                 pdf.multi_cell(0, 6, meta)
                 pdf.set_text_color(0)
-                prob_txt = data.get('problem', '').replace('\n', '\n\n')
-                prob_img = PDFGenerator.render_text_to_image(prob_txt)
-                if prob_img:
-                    PDFGenerator._add_image_to_pdf(pdf, prob_img, w=175)
+                prob_txt, _ = PDFGenerator._workbook_texts(data)
+                if PDFGenerator._add_text_block(pdf, prob_txt, 175, text_mode, image_for(frag.get('problem'))):
                     pdf.ln(5)
                 else:
                     pdf.set_font_size(12)
                     pdf.multi_cell(0, 8, prob_txt.replace('$', ''))
-                d_code = data.get('drawing_code', '')
-                if d_code:
-                    fig_data = PDFGenerator._generate_figure_from_code(d_code)
-                    if fig_data:
-                        PDFGenerator._add_image_to_pdf(pdf, fig_data, x=55, w=100)
-                        pdf.ln(5)
+                fig_data = image_for(frag.get('figure'))
+                if fig_data:
+                    PDFGenerator._add_image_to_pdf(pdf, fig_data, x=55, w=100, kind="figure")
+                    pdf.ln(5)
                 pdf.ln(15)
         if export_mode in ["Integrated", "Solution Only"]:
             pdf.add_page()
             pdf.set_font_size(18)
             pdf.cell(0, 15, "PART 2. Solutions", ln=True, align='C')
             pdf.ln(10)
-            for idx, item in enumerate(history_items):
+            for idx, (item, frag) in enumerate(zip(history_items, fragments)):
                 data = item['data']
                 pdf.set_font_size(12)
                 pdf.set_text_color(0, 0, 0)
                 pdf.cell(0, 10, f"Q{idx+1} Solution", ln=True)
-                sol_txt = f"[Answer] {data.get('answer', '')}\n\n[Solution]\n{data.get('solution', '')}".replace('\n', '\n\n')
-                chunk_img = PDFGenerator.render_text_to_image(sol_txt)
-                if chunk_img:
-                    PDFGenerator._add_image_to_pdf(pdf, chunk_img, w=175)
+                _, sol_txt = PDFGenerator._workbook_texts(data)
+                if PDFGenerator._add_text_block(pdf, sol_txt, 175, text_mode, image_for(frag.get('solution'))):
                     pdf.ln(10)
                 else:
                     pdf.multi_cell(0, 8, sol_txt.replace('$', ''))
@@ -730,38 +2226,69 @@ class PDFGenerator:
             pdf.set_font_size(11)
             col_width = 190 / 2
             for i in range(0, len(history_items), 2):
-                item1 = history_items[i]
-                ans1 = item1['data'].get('answer', '').replace('$', '').strip()
-                ans1_short = (ans1[:30] + '..') if len(ans1) > 30 else ans1
-                text1 = f"Q{i+1}: {ans1_short}"
+                text1 = f"Q{i+1}: {fragments[i]['answer_short']}"
                 text2 = ""
                 if i + 1 < len(history_items):
-                    item2 = history_items[i+1]
-                    ans2 = item2['data'].get('answer', '').replace('$', '').strip()
-                    ans2_short = (ans2[:30] + '..') if len(ans2) > 30 else ans2
-                    text2 = f"Q{i+2}: {ans2_short}"
+                    text2 = f"Q{i+2}: {fragments[i+1]['answer_short']}"
                 y_start = pdf.get_y()
                 pdf.cell(col_width, 10, text1, border=1)
                 pdf.cell(col_width, 10, text2, border=1, ln=True)
-        return pdf.output(dest='S').encode('latin-1')
-    @staticmethod
-    def create_history_zip(history_items):
-        zip_buffer = io.BytesIO()
-        with zipfile.ZipFile(zip_buffer, "a", zipfile.ZIP_DEFLATED, False) as zip_file:
-            for idx, item in enumerate(history_items):
-                data = item.get('data')
-                if not data:
-                    continue
-                title = f"Problem_{idx+1}_{item.get('grade', '').replace(' ', '_')}"
-                fig_img = None
-                if data.get('drawing_code'):
-                    fig_img = PDFGenerator._generate_figure_from_code(data['drawing_code'])
-                try:
-                    pdf_bytes = PDFGenerator.create_single_pdf(data, title, fig_img, "Integrated")
+        out = pdf.output(dest='S')
+        if isinstance(out, str):
+            return out.encode('latin-1')
+        return bytes(out)
+    @staticmethod
+    def stream_history_zip(history_items, image_preset=DEFAULT_IMAGE_PRESET, parallel=None):
+        # 문항별 PDF를 워커 풀에서 만들고, 끝나는 순서대로 스풀 임시 파일에 기록 (진행 중인 작업 수만큼만 메모리 사용)
+        # 반환값은 SpooledTemporaryFile 이라 st.download_button 에는 create_history_zip 의 bytes 를 넘긴다
+        items = [(idx, item) for idx, item in enumerate(history_items) if item.get('data')]
+        if parallel is None:
+            parallel = len(items) > 1
+        pool = get_render_pool() if parallel else None
+        def make_job(idx, item):
+            # 그림은 항상 부모 프로세스에서 샌드박스를 거쳐 그린다 (풀 워커 안에서 샌드박스를 띄우지 않음)
+            png, _ = FigureSandbox.render(item['data'].get('drawing_code'))
+            return idx, item, image_preset, png
+        spool = tempfile.SpooledTemporaryFile(max_size=ZIP_SPOOL_MAX_BYTES, suffix=".zip")
+        with zipfile.ZipFile(spool, "w", zipfile.ZIP_DEFLATED, False) as zip_file:
+            done_idx = set()
+            def write_member(result):
+                idx, title, pdf_bytes, err = result
+                done_idx.add(idx)
+                if pdf_bytes:
                     zip_file.writestr(f"{title}.pdf", pdf_bytes)
+                else:
+                    logger.warning("Error zipping item %s: %s", idx, err)
+            if pool is not None:
+                try:
+                    window = max(2, RENDER_WORKERS * 2)
+                    pending = set()
+                    for idx, item in items:
+                        pending.add(pool.submit(render_worker.history_pdf_job, make_job(idx, item)))
+                        if len(pending) >= window:
+                            finished, pending = wait(pending, timeout=RENDER_POOL_TIMEOUT, return_when=FIRST_COMPLETED)
+                            if not finished:
+                                raise TimeoutError
+                            for fut in finished:
+                                write_member(fut.result())
+                    for fut in as_completed(pending, timeout=RENDER_POOL_TIMEOUT):
+                        write_member(fut.result())
+                except TimeoutError:
+                    logger.warning("Parallel zip export timed out after %.0fs; exporting the rest serially", RENDER_POOL_TIMEOUT)
+                    _discard_render_pool(pool)
+                except BrokenProcessPool:
+                    get_render_pool.clear()
                 except Exception as e:
-                    print(f"Error zipping item {idx}: {e}")
-        return zip_buffer.getvalue()
+                    logger.warning("Parallel zip export failed: %s", e)
+            for idx, item in items:
+                if idx not in done_idx:
+                    write_member(_history_pdf_job(make_job(idx, item)))
+        spool.seek(0)
+        return spool
+    @staticmethod
+    def create_history_zip(history_items, image_preset=DEFAULT_IMAGE_PRESET):
+        with PDFGenerator.stream_history_zip(history_items, image_preset) as spool:
+            return spool.read()
     @staticmethod
     def convert_history_to_csv(history):
         output = io.StringIO()
@@ -777,17 +2304,116 @@ class PDFGenerator:
 # =========================================================================
 # 5. API Client & Logic
 # =========================================================================
+GEMINI_API_BASE = os.environ.get("GEMINI_API_BASE", "https://generativelanguage.googleapis.com/v1beta").rstrip("/")
+GEMINI_CA_BUNDLE = os.environ.get("GEMINI_CA_BUNDLE", "")
+HTTP_VERIFY = GEMINI_CA_BUNDLE or True
+HTTP_POOL_SIZE = int(os.environ.get("HTTP_POOL_SIZE", "16"))
+@st.cache_resource
+def get_http_session():
+    # 프로세스 전체가 공유하는 keep-alive 커넥션 풀 (세션/스레드 간 재사용, TLS 검증 활성)
+    session = requests.Session()
+    # 재시도는 GeminiClient.post_with_retry 한 곳에서만 처리한다
+    adapter = HTTPAdapter(pool_connections=4, pool_maxsize=HTTP_POOL_SIZE, max_retries=0)
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    session.headers.update({'Content-Type': 'application/json'})
+    return session
+API_DEADLINE_SECONDS = float(os.environ.get("API_DEADLINE_SECONDS", "240"))
+API_MAX_ATTEMPTS = int(os.environ.get("API_MAX_ATTEMPTS", "6"))
+API_BACKOFF_BASE = float(os.environ.get("API_BACKOFF_BASE", "1.0"))
+API_BACKOFF_MAX = float(os.environ.get("API_BACKOFF_MAX", "30"))
+API_RATE_PER_MINUTE = float(os.environ.get("API_RATE_PER_MINUTE", "60"))
+API_BURST = int(os.environ.get("API_BURST", "10"))
+RETRYABLE_STATUS = {429, 500, 502, 503, 504}
+class TokenBucket:
+    # API 키+모델 별 요청 속도 제한 (모든 세션/스레드 공유)
+    _buckets_lock, _buckets = shared_registry("token_buckets")
+    def __init__(self, rate_per_minute=API_RATE_PER_MINUTE, capacity=API_BURST):
+        self.rate = max(rate_per_minute, 0.001) / 60.0
+        self.capacity = max(1, capacity)
+        self.tokens = float(self.capacity)
+        self.updated = time.monotonic()
+        self.blocked_until = 0.0
+        self._lock = threading.Lock()
+    @staticmethod
+    def for_key(api_key, model):
+        key = (hashlib.sha256(str(api_key).encode("utf-8")).hexdigest()[:16], model)
+        with TokenBucket._buckets_lock:
+            bucket = TokenBucket._buckets.get(key)
+            if bucket is None:
+                bucket = TokenBucket._buckets[key] = TokenBucket()
+            return bucket
+    def acquire(self, deadline):
+        # 토큰을 얻으면 True, deadline 안에 얻을 수 없으면 False
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if now >= self.blocked_until and self.tokens >= 1:
+                    self.tokens -= 1
+                    return True
+                wait = max(self.blocked_until - now, (1 - self.tokens) / self.rate)
+            if time.monotonic() + wait > deadline:
+                return False
+            time.sleep(wait)
+    def penalize(self, seconds):
+        # 429 를 받으면 다른 세션들도 서버가 요구한 시간만큼 기다리게 한다
+        with self._lock:
+            self.blocked_until = max(self.blocked_until, time.monotonic() + seconds)
+            self.tokens = 0.0
+MODEL_DISCOVERY_TTL = float(os.environ.get("MODEL_DISCOVERY_TTL", "3600"))
+MODEL_DISCOVERY_FAILURE_TTL = float(os.environ.get("MODEL_DISCOVERY_FAILURE_TTL", "60"))
+MODEL_PROBE_WORKERS = int(os.environ.get("MODEL_PROBE_WORKERS", "4"))
+MODEL_PROBE_CANDIDATES = int(os.environ.get("MODEL_PROBE_CANDIDATES", "8"))
+class ModelDiscovery:
+    # API 키 지문 -> (모델 이름 또는 None, 만료 시각); 같은 키는 한 번에 한 세션만 탐색
+    _lock, _results = shared_registry("model_discovery")
+    _key_locks = shared_registry("model_discovery_locks")[1]
+    @staticmethod
+    def fingerprint(api_key):
+        return hashlib.sha256(str(api_key).strip().encode("utf-8")).hexdigest()[:16]
+    @staticmethod
+    def resolve(api_key, discover):
+        fp = ModelDiscovery.fingerprint(api_key)
+        with ModelDiscovery._lock:
+            key_lock = ModelDiscovery._key_locks.setdefault(fp, threading.Lock())
+        with key_lock:
+            with ModelDiscovery._lock:
+                cached = ModelDiscovery._results.get(fp)
+            if cached is not None and cached[1] > time.monotonic():
+                return cached[0]
+            m = discover(api_key)
+            with ModelDiscovery._lock:
+                ModelDiscovery._results[fp] = (m, time.monotonic() + (MODEL_DISCOVERY_TTL if m else MODEL_DISCOVERY_FAILURE_TTL))
+            return m
+    @staticmethod
+    def invalidate(api_key):
+        with ModelDiscovery._lock:
+            ModelDiscovery._results.pop(ModelDiscovery.fingerprint(api_key), None)
+HEADLESS_STATE = {}
+def _runtime_state():
+    # Streamlit 스크립트 실행 중이면 세션 상태, 아니면(CLI/벤치마크) 프로세스 전역 dict
+    if get_script_run_ctx(suppress_warning=True) is not None:
+        return st.session_state
+    return HEADLESS_STATE
 class GeminiClient:
     @staticmethod
+    def model_url(model, api_key, method="generateContent"):
+        url = f"{GEMINI_API_BASE}/models/{model}:{method}?key={api_key}"
+        return url + "&alt=sse" if method == "streamGenerateContent" else url
+    @staticmethod
     def get_working_model(api_key):
         key = str(api_key).strip()
-        url = f"https://generativelanguage.googleapis.com/v1beta/models?key={key}"
+        url = f"{GEMINI_API_BASE}/models?key={key}"
         priorities = ['gemini-2.5-flash', 'gemini-1.5-flash', 'gemini-1.5-pro']
-        session = requests.Session()
-        adapter = HTTPAdapter(max_retries=Retry(connect=3, backoff_factor=0.5))
-        session.mount('https://', adapter)
+        bucket = TokenBucket.for_key(key, 'models')
+        if not bucket.acquire(time.monotonic() + 5):
+            return priorities
         try:
-            res = session.get(url, timeout=5, verify=False)
+            res = get_http_session().get(url, timeout=5, verify=HTTP_VERIFY)
+            if res.status_code == 429:
+                bucket.penalize(GeminiClient.retry_delay(res, 0))
             if res.status_code == 200:
                 avail = [m['name'].replace('models/', '') for m in res.json().get('models', []) if 'generateContent' in m.get('supportedGenerationMethods', [])]
                 avail = [m for m in avail if 'gemma' not in m.lower()]
@@ -796,66 +2422,187 @@ class GeminiClient:
             pass
         return priorities
     @staticmethod
-    def test_api_connection(api_key):
-        candidates = GeminiClient.get_working_model(api_key)
-        for m in candidates:
+    def probe_model(api_key, m):
+        # 탐색 요청도 생성 요청과 같은 키+모델 속도 제한을 거친다
+        bucket = TokenBucket.for_key(api_key, m)
+        if not bucket.acquire(time.monotonic() + 5):
+            return False
+        try:
+            res = get_http_session().post(GeminiClient.model_url(m, api_key), json={"contents": [{"parts": [{"text": "Hi"}]}]}, timeout=5, verify=HTTP_VERIFY)
+            if res.status_code == 429:
+                bucket.penalize(GeminiClient.retry_delay(res, 0))
+            return res.status_code == 200
+        except:
+            return False
+    @staticmethod
+    def discover_model(api_key):
+        # 후보 모델들을 동시에 찔러 보고 가장 먼저 성공한 모델 사용
+        candidates = GeminiClient.get_working_model(api_key)[:MODEL_PROBE_CANDIDATES]
+        pool = ThreadPoolExecutor(max_workers=max(1, min(MODEL_PROBE_WORKERS, len(candidates))))
+        try:
+            futures = {pool.submit(GeminiClient.probe_model, api_key, m): m for m in candidates}
+            for fut in as_completed(futures):
+                if fut.result():
+                    return futures[fut]
+            return None
+        finally:
+            pool.shutdown(wait=False, cancel_futures=True)
+    @staticmethod
+    def test_api_connection(api_key, force=False):
+        # 결과는 API 키 지문별로 프로세스 전체에서 TTL 동안 공유 (force=True 면 다시 탐색)
+        if force:
+            ModelDiscovery.invalidate(api_key)
+        m = ModelDiscovery.resolve(api_key, GeminiClient.discover_model)
+        if m:
+            _runtime_state()['valid_model_name'] = m
+            return True, f"Connection Successful! ({m})"
+        return False, "No usable model found."
+    @staticmethod
+    def retry_delay(res, attempt):
+        # Retry-After 헤더 / RetryInfo 가 있으면 따르고, 없으면 지터를 준 지수 백오프
+        if res is not None:
+            header = res.headers.get('Retry-After')
+            if header:
+                try:
+                    return max(0.0, float(header))
+                except ValueError:
+                    try:
+                        return max(0.0, parsedate_to_datetime(header).timestamp() - time.time())
+                    except:
+                        pass
             try:
-                url = f"https://generativelanguage.googleapis.com/v1beta/models/{m}:generateContent?key={api_key}"
-                res = requests.post(url, headers={'Content-Type': 'application/json'}, json={"contents": [{"parts": [{"text": "Hi"}]}]}, timeout=5, verify=False)
-                if res.status_code == 200:
-                    st.session_state['valid_model_name'] = m
-                    return True, f"Connection Successful! ({m})"
+                for detail in res.json().get('error', {}).get('details', []):
+                    if str(detail.get('@type', '')).endswith('RetryInfo') and detail.get('retryDelay'):
+                        return max(0.0, float(str(detail['retryDelay']).rstrip('s')))
             except:
                 pass
-        return False, "No usable model found."
+        return random.uniform(0, min(API_BACKOFF_MAX, API_BACKOFF_BASE * (2 ** attempt)))
+    @staticmethod
+    def post_with_retry(api_key, model, payload, deadline, method="generateContent", stream=False):
+        # -> (성공 또는 재시도 불가 응답, None) / (None, 오류 메시지)
+        bucket = TokenBucket.for_key(api_key, model)
+        error = "⚠️ Deadline Exceeded"
+        for attempt in range(API_MAX_ATTEMPTS):
+            if not bucket.acquire(deadline):
+                return None, "⚠️ Quota Exceeded"
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            res = None
+            try:
+                res = get_http_session().post(GeminiClient.model_url(model, api_key, method), json=payload, timeout=(min(10.0, remaining), remaining), verify=HTTP_VERIFY, stream=stream)
+            except requests.RequestException as e:
+                error = f"Network Error: {str(e)}"
+            else:
+                if res.status_code not in RETRYABLE_STATUS:
+                    return res, None
+                error = "⚠️ Quota Exceeded" if res.status_code == 429 else f"Error {res.status_code}: {res.text}"
+            wait = GeminiClient.retry_delay(res, attempt)
+            if res is not None and res.status_code == 429:
+                bucket.penalize(wait)
+            if attempt == API_MAX_ATTEMPTS - 1 or time.monotonic() + wait >= deadline:
+                break
+            time.sleep(wait)
+        return None, error
     @staticmethod
-    def call_api(api_key, payload, active_model_name=None, retry=0):
-        pref_mode = st.session_state.get('preferred_model_mode', 'Auto')
+    def resolve_model(active_model_name=None):
+        pref_mode = _runtime_state().get('preferred_model_mode', 'Auto')
         if pref_mode != 'Auto':
-            m = pref_mode
-        else:
-            m = active_model_name
-            if not m:
-                cached_m = st.session_state.get('valid_model_name')
-                m = cached_m if cached_m else 'gemini-2.5-flash'
-                st.session_state['valid_model_name'] = m
-        url = f"https://generativelanguage.googleapis.com/v1beta/models/{m}:generateContent?key={api_key}"
-        session = requests.Session()
-        session.mount("https://", HTTPAdapter(max_retries=Retry(total=5, backoff_factor=1, status_forcelist=[429, 500, 502, 503, 504])))
+            return pref_mode
+        m = active_model_name
+        if not m:
+            cached_m = _runtime_state().get('valid_model_name')
+            m = cached_m if cached_m else 'gemini-2.5-flash'
+            _runtime_state()['valid_model_name'] = m
+        return m
+    @staticmethod
+    def read_stream(res, on_text):
+        # SSE(streamGenerateContent?alt=sse) 응답을 읽으며 텍스트 조각마다 on_text 호출
+        # 중간에 끊기면 StreamInterrupted, finishReason 이 STOP 이 아니면 API 오류 문자열 (잘린 텍스트를 성공으로 돌려주지 않는다)
+        chunks = []
+        finish = None
         try:
-            res = session.post(url, headers={'Content-Type': 'application/json'}, json=payload, timeout=600, verify=False)
-            if res.status_code == 200:
+            for raw in res.iter_lines():
+                line = raw.decode('utf-8', 'replace') if isinstance(raw, bytes) else raw
+                if not line.startswith('data:'):
+                    continue
                 try:
-                    return res.json()['candidates'][0]['content']['parts'][0]['text'], m
+                    event = json.loads(line[5:].strip())
                 except:
-                    return "⚠️ Format Error", m
-            elif res.status_code == 429:
-                if retry < 5:
-                    time.sleep(10)
-                    return GeminiClient.call_api(api_key, payload, m, retry+1)
-                return "⚠️ Quota Exceeded", m
-            elif res.status_code == 404:
-                st.session_state['valid_model_name'] = None
-                if retry < 1:
-                    GeminiClient.test_api_connection(api_key)
-                    return GeminiClient.call_api(api_key, payload, None, retry+1)
-                return "⚠️ Model Not Found", m
-            return f"Error {res.status_code}: {res.text}", m
-        except Exception as e:
-            if retry < 5:
-                time.sleep(5)
-                return GeminiClient.call_api(api_key, payload, active_model_name, retry+1)
-            return f"Network Error: {str(e)}", m
-def generate_draft(api_key, image, difficulty, grade, curr_text, instruction, style_img, temperature, p_type, subject=None, lang="Korean"):
+                    continue
+                for cand in event.get('candidates', [])[:1]:
+                    for part in cand.get('content', {}).get('parts', []):
+                        if part.get('text'):
+                            chunks.append(part['text'])
+                            on_text(part['text'])
+                    finish = cand.get('finishReason') or finish
+        except requests.RequestException as e:
+            raise StreamInterrupted(f"stream interrupted after {len(chunks)} chunks: {e}") from e
+        finally:
+            res.close()
+        if finish != "STOP":
+            return GeminiClient.incomplete_error(finish)
+        return "".join(chunks) if chunks else "⚠️ Format Error"
+    @staticmethod
+    def incomplete_error(finish):
+        return f"⚠️ Incomplete response (finishReason={finish or 'missing'})"
+    @staticmethod
+    def call_api(api_key, payload, active_model_name=None, deadline=None, on_text=None):
+        # on_text 가 주어지면 스트리밍 엔드포인트를 사용하고 조각이 도착할 때마다 콜백
+        m = GeminiClient.resolve_model(active_model_name)
+        first_call = deadline is None
+        deadline = deadline if deadline is not None else time.monotonic() + API_DEADLINE_SECONDS
+        method = "streamGenerateContent" if on_text else "generateContent"
+        res, error = GeminiClient.post_with_retry(api_key, m, payload, deadline, method, stream=on_text is not None)
+        if res is None:
+            return error, m
+        if res.status_code == 200:
+            if on_text:
+                try:
+                    return GeminiClient.read_stream(res, on_text), m
+                except StreamInterrupted as e:
+                    return f"Network Error: {e}", m
+            try:
+                cand = res.json()['candidates'][0]
+                text = cand['content']['parts'][0]['text']
+            except:
+                return "⚠️ Format Error", m
+            if cand.get('finishReason', 'STOP') != 'STOP':
+                return GeminiClient.incomplete_error(cand.get('finishReason')), m
+            return text, m
+        elif res.status_code == 404:
+            _runtime_state()['valid_model_name'] = None
+            if first_call:
+                GeminiClient.test_api_connection(api_key, force=True)
+                return GeminiClient.call_api(api_key, payload, None, deadline, on_text)
+            return "⚠️ Model Not Found", m
+        return f"Error {res.status_code}: {res.text}", m
+STYLE_IMAGE_MAX_SIDE = int(os.environ.get("STYLE_IMAGE_MAX_SIDE", "1024"))
+ENCODED_IMAGES = shared_cache("encoded_images", int(os.environ.get("ENCODED_IMAGE_CACHE_SIZE", "32")))
+def prepare_style_image(image):
+    # 스타일 이미지는 업로드할 때 한 번만 축소/RGB 변환
+    img = image.copy()
+    img.thumbnail((STYLE_IMAGE_MAX_SIDE, STYLE_IMAGE_MAX_SIDE))
+    return img if img.mode == 'RGB' else img.convert('RGB')
+def encode_image_part(image):
+    # JPEG+base64 inline_data 파트를 이미지 내용 해시별로 한 번만 만든다 (draft/refine/재생성 공유)
+    digest = image_digest(image)
+    data = ENCODED_IMAGES.get(digest)
+    if data is None:
+        started = time.perf_counter()
+        buf = io.BytesIO()
+        (image if image.mode == 'RGB' else image.convert('RGB')).save(buf, format="JPEG")
+        data = base64.b64encode(buf.getvalue()).decode("utf-8")
+        ENCODED_IMAGES.put(digest, data, time.perf_counter() - started)
+    return {"inline_data": {"mime_type": "image/jpeg", "data": data}}
+def generate_draft(api_key, image, difficulty, grade, curr_text, instruction, style_img, temperature, p_type, subject=None, lang="Korean", on_text=None, use_cache=True, single_call=False):
     opt_img = image.copy()
     opt_img.thumbnail((800, 800))
     if opt_img.mode != 'RGB':
         opt_img = opt_img.convert('RGB')
-    buf = io.BytesIO()
-    opt_img.save(buf, format="JPEG")
-    img_str = base64.b64encode(buf.getvalue()).decode("utf-8")
-    diff_map = {"Maintain": "유지", "Easier": "쉽게", "Harder": "어렵게"}
-    diff_kr = diff_map.get(difficulty, "유지")
+    if style_img is not None and max(style_img.size) > STYLE_IMAGE_MAX_SIDE:
+        style_img = prepare_style_image(style_img)
+    model = GeminiClient.resolve_model()
     grade_map = {
         "Elementary 3": "초등학교 3학년", "Elementary 4": "초등학교 4학년", "Elementary 5": "초등학교 5학년", "Elementary 6": "초등학교 6학년",
         "Middle 1": "중학교 1학년", "Middle 2": "중학교 2학년", "Middle 3": "중학교 3학년",
@@ -868,6 +2615,22 @@ def generate_draft(api_key, image, difficulty, grade, curr_text, instruction, st
         "Differential Geometry": "미분기하학", "Analysis": "해석학", "Abstract Algebra": "현대대수학",
         "Complex Analysis": "복소해석학", "Topology": "위상수학", "Discrete Mathematics": "이산수학"
     }
+    # 자료 전체 대신 학년/과목/요청과 관련된 청크만 프롬프트에 넣는다 (캐시 키도 실제로 보낸 자료 기준)
+    code = GRADE_STANDARD_CODES.get(grade)
+    query = " ".join(v for v in (grade_kr, f"[{code}수학" if code else "", subject_map.get(subject, subject or ""), subject or "", p_type, instruction) if v)
+    curr_context = select_curriculum_context((curr_text, REFERENCE_LIBRARY.load()[0]), query)
+    cache_key = content_digest({
+        "stage": "single" if single_call else "draft", "image": image_digest(opt_img), "grade": grade, "difficulty": difficulty, "type": p_type, "subject": subject,
+        "lang": lang, "curriculum": hashlib.sha256(curr_context.encode("utf-8")).hexdigest(), "instruction": instruction,
+        "style": image_digest(style_img), "model": model, "temperature": temperature
+    })
+    cached = RESPONSE_CACHE.get(cache_key) if use_cache else None
+    if cached is not None:
+        if on_text:
+            on_text(cached)
+        return cached, model
+    diff_map = {"Maintain": "유지", "Easier": "쉽게", "Harder": "어렵게"}
+    diff_kr = diff_map.get(difficulty, "유지")
     subject_prompt = ""
     abstract_subjects = ["Abstract Algebra", "Topology", "Number Theory", "Discrete Mathematics"]
     drawing_constraint = "6. **그림 생성:** 기하학/함수 그래프 등 시각자료가 문제 풀이에 필수적인 경우에만 Python matplotlib 코드를 생성하십시오."
@@ -894,6 +2657,18 @@ def generate_draft(api_key, image, difficulty, grade, curr_text, instruction, st
         lang_line = "1. **Language:** Provide the Problem, Solution, and Explanation in ** English**."
     else:
         lang_line = "1. **언어:** 문제, 풀이, 해설 등 모든 텍스트는 **반드시 한국어(Korean)**로 작성하십시오."
+    verify_block = ""
+    if single_call:
+        # 빠른 모드: refine_final 의 검토 지침을 한 번의 호출에 포함
+        verify_block = f"""
+    [자체 검증 후 최종본 작성]
+    - 만든 문제를 직접 처음부터 끝까지 풀어 정답을 검증하고, 조건이 불충분하거나 모순, 계산 오류가 있으면 수정한 최종본만 출력하십시오.
+    - 풀이는 '1단계', '2단계' 또는 'Step 1', 'Step 2'와 같이 단계별로 서술하고, 수식과 문장 사이에 줄바꿈(`\\n\\n`)을 충분히 사용하십시오.
+    - 수식은 반드시 LaTeX 포맷인 $ ... $ 를 사용하십시오. (\\begin{{cases}} 사용 금지) matplotlib 코드에 plt.show()를 넣지 마십시오.
+    - 성취기준: 해당 문제가 속한 대한민국 교육과정 성취기준 코드(예: [10수학01-01])를 작성하십시오. (대학수학은 관련 전공 주제 명시)
+    [최종 출력 JSON 포맷]
+    {{ "concept": "핵심 개념", "problem": "문제 내용", "hint": "힌트", "answer": "검증된 정답", "solution": "검증된 상세 풀이 (줄바꿈 필수)", "drawing_code": "Python 코드", "achievement_standard": "성취기준" }}
+    """
     parts = [{"text": f"""
     당신은 대한민국 수학 교육 전문가입니다. 입력된 이미지의 문제를 분석하여, 동일한 수학적 개념을 묻는 '{grade_kr}' 수준(난이도:{diff_kr})의 새로운 '쌍둥이 문제'를 만드십시오.
     [필수 지침]
@@ -904,22 +2679,33 @@ def generate_draft(api_key, image, difficulty, grade, curr_text, instruction, st
         - 대학수학일 경우에만 해당 전공 용어를 사용하십시오.
     3. **변형 모드:** {mode_desc}
     4. **문제 유형:** {p_type}. {type_inst}
-    5. **제약 사항:** {grade_kr} 교육과정 범위를 준수하십시오. {curr_text[:10000]}
+    5. **제약 사항:** {grade_kr} 교육과정 범위를 준수하십시오. {curr_context}
     6. **추가 요청:** {instruction}
     {subject_prompt}
     {drawing_constraint}
     7. **절대 금지:** 생성된 그림에 정답, 해설, 힌트 텍스트를 넣지 마십시오. 오직 문제의 초기 상태만 시각화하십시오.
     8. **코드 규칙:** Python 코드 작성 시 줄바꿈 문자(\\)를 절대 사용하지 마십시오.
-    """}, {"inline_data": {"mime_type": "image/jpeg", "data": img_str}}]
+    {verify_block}
+    """}, encode_image_part(opt_img)]
     if style_img:
-        s_buf = io.BytesIO()
-        style_img.save(s_buf, format="JPEG")
-        s_str = base64.b64encode(s_buf.getvalue()).decode("utf-8")
         parts.append({"text": "Style Reference:"})
-        parts.append({"inline_data": {"mime_type": "image/jpeg", "data": s_str}})
+        parts.append(encode_image_part(style_img))
     payload = {"contents": [{"parts": parts}], "safetySettings": [{"category": "HARM_CATEGORY_DANGEROUS_CONTENT", "threshold": "BLOCK_NONE"}], "generationConfig": {"temperature": max(0.8, temperature), "response_mime_type": "application/json"}}
-    return GeminiClient.call_api(api_key, payload)
-def refine_final(api_key, draft, style_img, grade, subject=None, lang="Korean"):
+    text, model = GeminiClient.call_api(api_key, payload, model, on_text=on_text)
+    # 초안은 출력 키가 정해져 있지 않으므로 완결된 JSON 인지만 확인, 빠른 모드 결과는 최종본과 같은 키를 요구
+    if is_complete_response(text, RESPONSE_REQUIRED_KEYS if single_call else ()):
+        RESPONSE_CACHE.put(cache_key, text)
+    return text, model
+def refine_final(api_key, draft, style_img, grade, subject=None, lang="Korean", on_text=None, use_cache=True):
+    if style_img is not None and max(style_img.size) > STYLE_IMAGE_MAX_SIDE:
+        style_img = prepare_style_image(style_img)
+    model = GeminiClient.resolve_model()
+    cache_key = content_digest({"stage": "final", "draft": draft, "style": image_digest(style_img), "grade": grade, "subject": subject, "lang": lang, "model": model})
+    cached = RESPONSE_CACHE.get(cache_key) if use_cache else None
+    if cached is not None:
+        if on_text:
+            on_text(cached)
+        return cached, model
     grade_map = {
         "Elementary 3": "초등학교 3학년", "Elementary 4": "초등학교 4학년", "Elementary 5": "초등학교 5학년", "Elementary 6": "초등학교 6학년",
         "Middle 1": "중학교 1학년", "Middle 2": "중학교 2학년", "Middle 3": "중학교 3학년",
@@ -972,12 +2758,59 @@ def refine_final(api_key, draft, style_img, grade, subject=None, lang="Korean"):
     """
     parts = [{"text": prompt}]
     if style_img:
-        s_buf = io.BytesIO()
-        style_img.save(s_buf, format="JPEG")
-        s_str = base64.b64encode(s_buf.getvalue()).decode("utf-8")
-        parts.append({"inline_data": {"mime_type": "image/jpeg", "data": s_str}})
+        parts.append(encode_image_part(style_img))
     payload = {"contents": [{"parts": parts}], "safetySettings": [{"category": "HARM_CATEGORY_DANGEROUS_CONTENT", "threshold": "BLOCK_NONE"}], "generationConfig": {"temperature": 0.8, "response_mime_type": "application/json"}}
-    return GeminiClient.call_api(api_key, payload)
+    text, model = GeminiClient.call_api(api_key, payload, model, on_text=on_text)
+    if is_complete_response(text):
+        RESPONSE_CACHE.put(cache_key, text)
+    return text, model
+BATCH_MAX_TWINS = int(os.environ.get("BATCH_MAX_TWINS", "10"))
+BATCH_CONCURRENCY = int(os.environ.get("BATCH_CONCURRENCY", "4"))
+def generation_settings():
+    # 작업 스레드가 세션 상태를 직접 읽지 않도록 생성 시점 설정을 복사
+    keys = ('difficulty', 'grade', 'curriculum_text', 'style_img', 'creativity', 'prob_type', 'subject', 'language', 'force_fresh', 'fast_mode')
+    return {k: st.session_state.get(k) for k in keys}
+def run_twin_pipeline(api_key, image, settings, instruction="", on_field=None):
+    # on_field(stage, key, value): 스트리밍 중 필드 값이 완성될 때마다 호출 (stage = "draft" / "final")
+    def stream_to(stage):
+        if on_field is None:
+            return None
+        parser = PartialJSONParser()
+        def on_text(chunk):
+            for key, value in parser.feed(chunk).items():
+                on_field(stage, key, value)
+        return on_text
+    if settings.get('fast_mode'):
+        # 초안+검토를 한 번의 호출로 (지연 시간/토큰 절반)
+        f_res, _ = generate_draft(api_key, image, settings['difficulty'], settings['grade'], settings['curriculum_text'], instruction, settings['style_img'], settings['creativity'], settings['prob_type'], settings['subject'], settings['language'], on_text=stream_to("final"), use_cache=not settings.get('force_fresh'), single_call=True)
+        return parse_gemini_json_response(f_res)
+    d_res, _ = generate_draft(api_key, image, settings['difficulty'], settings['grade'], settings['curriculum_text'], instruction, settings['style_img'], settings['creativity'], settings['prob_type'], settings['subject'], settings['language'], on_text=stream_to("draft"), use_cache=not settings.get('force_fresh'))
+    f_res, _ = refine_final(api_key, d_res, settings['style_img'], settings['grade'], settings['subject'], settings['language'], on_text=stream_to("final"), use_cache=not settings.get('force_fresh'))
+    return parse_gemini_json_response(f_res)
+def twin_instruction(index, count):
+    if count <= 1:
+        return ""
+    return f"변형 {index+1}/{count}: 다른 변형들과 숫자, 상황, 조건이 겹치지 않도록 서로 다른 문제를 만드십시오."
+def generate_twins(api_key, image, settings, count, on_field=None):
+    # draft -> refine 파이프라인 N개를 동시에 실행하고 끝나는 순서대로 결과를 내보낸다 (스트리밍 미리보기는 1개일 때만)
+    count = max(1, min(count, BATCH_MAX_TWINS))
+    if count == 1:
+        yield run_twin_pipeline(api_key, image, settings, on_field=on_field)
+        return
+    ctx = get_script_run_ctx()
+    def attach_ctx():
+        if ctx is not None:
+            add_script_run_ctx(threading.current_thread(), ctx)
+    with ThreadPoolExecutor(max_workers=min(count, BATCH_CONCURRENCY), initializer=attach_ctx) as pool:
+        futures = []
+        for i in range(count):
+            futures.append(pool.submit(run_twin_pipeline, api_key, image, settings, twin_instruction(i, count)))
+        for fut in as_completed(futures):
+            try:
+                yield fut.result()
+            except Exception as e:
+                logger.exception("Twin generation failed: %s", e)
+                yield {}
 # =========================================================================
 # 6. UI Dialogs
 # =========================================================================
@@ -1033,7 +2866,7 @@ def dialog_style():
     s_file = st.file_uploader(T("style_label"), type=['png', 'jpg'], key="style_upload")
     if s_file:
         try:
-            st.session_state['style_img'] = pdf_to_image(s_file) if s_file.type == "application/pdf" else Image.open(s_file)
+            st.session_state['style_img'] = prepare_style_image(pdf_to_image(s_file) if s_file.type == "application/pdf" else Image.open(s_file))
             st.success(T("style_success"))
             st.image(st.session_state['style_img'], caption=T("style_current"), use_container_width=True)
         except:
@@ -1058,6 +2891,7 @@ def dialog_data():
     st.warning(T("data_warn"))
     if st.button(T("data_clear"), type="primary", key="btn_clear_hist"):
         st.session_state['history'] = []
+        bump_history_version()
         st.rerun()
 # =========================================================================
 # 7. Main Application Logic
@@ -1229,7 +3063,7 @@ def main_app_interface():
                 st.session_state['api_key'] = new_key
                 api_key = new_key
             if st.button(T("api_check_btn")):
-                ok, msg = GeminiClient.test_api_connection(api_key)
+                ok, msg = GeminiClient.test_api_connection(api_key, force=True)
                 if ok:
                     st.success(T("api_success"))
                 else:
@@ -1247,12 +3081,14 @@ def main_app_interface():
         if st.button(T("data_btn"), use_container_width=True):
             dialog_data()
         st.divider()
+        render_stats = RENDER_CACHE.stats()
         st.markdown(f"""
         <div class="status-box">
             <div class="status-item"><span class="status-label">Grade</span><span class="status-value">{st.session_state.get('grade')}</span></div>
             <div class="status-item"><span class="status-label">Diff</span><span class="status-value">{st.session_state.get('difficulty')}</span></div>
             <div class="status-item"><span class="status-label">Type</span><span class="status-value">{st.session_state.get('prob_type')}</span></div>
             {f'<div class="status-item"><span class="status-label">Subject</span><span class="status-value">{st.session_state.get("subject")}</span></div>' if st.session_state.get('grade') == 'University Math' else ''}
+            <div class="status-item"><span class="status-label">Render Cache</span><span class="status-value">{render_stats['hits'] + render_stats['disk_hits']}/{render_stats['hits'] + render_stats['disk_hits'] + render_stats['misses']} ({render_stats['saved_seconds']}s)</span></div>
         </div>
         """, unsafe_allow_html=True)
         display_sidebar_ads()
@@ -1265,14 +3101,36 @@ def main_app_interface():
                 if q_file:
                     img = pdf_to_image(q_file) if q_file.type == 'application/pdf' else Image.open(q_file)
                     st.image(img, use_container_width=True)
+                    c_cnt, c_stream = st.columns([1, 1])
+                    twin_count = c_cnt.number_input(T("twin_count"), min_value=1, max_value=BATCH_MAX_TWINS, value=1, step=1)
+                    c_cnt.toggle(T("fast_mode"), value=False, key="fast_mode")
+                    stream_mode = c_stream.toggle(T("stream_mode"), value=True, key="stream_mode")
+                    c_stream.toggle(T("force_fresh"), value=False, key="force_fresh")
                     if st.button(T("generate_btn"), type="primary", disabled=not api_key, use_container_width=True):
-                        with st.status(T("generating_status")):
-                            d_res, _ = generate_draft(api_key, img, st.session_state['difficulty'], st.session_state['grade'], st.session_state['curriculum_text'], "", st.session_state['style_img'], st.session_state['creativity'], st.session_state['prob_type'], st.session_state['subject'], st.session_state['language'])
-                            f_res, _ = refine_final(api_key, d_res, st.session_state['style_img'], st.session_state['grade'], st.session_state['subject'], st.session_state['language'])
-                            st.session_state['generated_data'] = parse_gemini_json_response(f_res)
-                            if st.session_state['generated_data'].get('problem'):
-                                history_item = {"time": datetime.now().strftime("%Y-%m-%d %H:%M"), "data": st.session_state['generated_data'], "grade": st.session_state['grade'], "difficulty": st.session_state['difficulty']}
+                        preview = st.empty()
+                        started = time.perf_counter()
+                        def show_field(stage, key, value):
+                            # 문제 본문이 완성되는 즉시 미리보기 (초안 -> 최종본 순서로 교체)
+                            if key == 'problem' and value:
+                                label = T("stream_draft") if stage == "draft" else T("result_card")
+                                preview.info(f"**{label}** ({time.perf_counter() - started:.1f}s)\n\n{normalize_latex_text(str(value))}")
+                        with st.status(T("generating_status")) as gen_status:
+                            settings = generation_settings()
+                            done = 0
+                            latest = None
+                            for result in generate_twins(api_key, img, settings, int(twin_count), show_field if stream_mode else None):
+                                done += 1
+                                if twin_count > 1:
+                                    gen_status.update(label=f"{T('generating_status')} ({done}/{twin_count})")
+                                if not result.get('problem'):
+                                    continue
+                                latest = result
+                                history_item = {"time": datetime.now().strftime("%Y-%m-%d %H:%M"), "data": result, "grade": settings['grade'], "difficulty": settings['difficulty']}
                                 st.session_state['history'].insert(0, history_item)
+                                bump_history_version()
+                                if twin_count > 1:
+                                    st.write(f"✅ {done}. {str(result.get('problem', ''))[:60]}")
+                            st.session_state['generated_data'] = latest or result
                             st.rerun()
                     if not api_key:
                         st.error(T("api_error"))
@@ -1288,19 +3146,12 @@ def main_app_interface():
                     st.markdown('</div>', unsafe_allow_html=True)
                 d_code = data.get('drawing_code')
                 if d_code and "plt" in d_code:
-                    try:
-                        code = clean_python_code(d_code)
-                        plt.clf()
-                        plt.close('all')
-                        fig = plt.figure()
-                        exec(code, {'plt': plt, 'np': np})
-                        if len(fig.get_axes()) > 0:
-                            st.pyplot(fig)
-                            st.session_state['generated_figure'] = fig
-                        else:
-                            st.session_state['generated_figure'] = None
-                    except:
-                        pass
+                    png, has_axes = FigureSandbox.render(d_code)
+                    if png and has_axes:
+                        st.image(png)
+                        st.session_state['generated_figure'] = png
+                    else:
+                        st.session_state['generated_figure'] = None
                 with st.container(border=True):
                     with st.expander(T("answer_solution")):
                         st.markdown(f"**Ans:** {data.get('answer')}")
@@ -1308,7 +3159,7 @@ def main_app_interface():
                         sol = str(data.get('solution')).replace('\\n', '\n').replace('\n', '\n\n')
                         st.markdown(f"**Solution:**\n\n{normalize_latex_text(sol)}")
                 st.divider()
-                c_tit, c_mode = st.columns([2, 1])
+                c_tit, c_mode, c_q = st.columns([2, 1, 1])
                 title = c_tit.text_input("File Name", value=f"{st.session_state['grade']} Math Twin Problem")
                 export_mode = c_mode.selectbox("Export Mode", [T("export_mode_integrated"), T("export_mode_problem"), T("export_mode_solution")], label_visibility="collapsed")
                 mode_map = {
@@ -1317,15 +3168,19 @@ def main_app_interface():
                     T("export_mode_solution"): "Solution Only"
                 }
                 internal_mode = mode_map.get(export_mode, "Integrated")
-                fig_img = None
-                if st.session_state.get('generated_figure'):
-                    buf = io.BytesIO()
-                    st.session_state['generated_figure'].savefig(buf, format='png', bbox_inches='tight')
-                    buf.seek(0)
-                    fig_img = Image.open(buf)
-                pdf_bytes = PDFGenerator.create_single_pdf(data, title, fig_img, internal_mode)
-                if pdf_bytes:
-                    st.download_button(T("download_pdf"), data=bytes(pdf_bytes), file_name=f"{title}.pdf", mime="application/pdf", use_container_width=True)
+                image_preset = c_q.selectbox("Quality", list(IMAGE_PRESETS), index=list(IMAGE_PRESETS).index(DEFAULT_IMAGE_PRESET), label_visibility="collapsed")
+                text_mode = "native" if st.toggle(T("native_text"), key="native_text_pdf") else "image"
+                generated_figure = st.session_state.get('generated_figure')
+                def build_single_pdf():
+                    fig_img = None
+                    if generated_figure:
+                        fig_img = io.BytesIO(generated_figure)
+                    return bytes(PDFGenerator.create_single_pdf(data, title, fig_img, internal_mode, text_mode, image_preset))
+                pdf_key = (content_digest(data), title, internal_mode, text_mode, image_preset, generated_figure is not None)
+                st.download_button(T("download_pdf"), data=lazy_export('single_pdf', pdf_key, build_single_pdf), file_name=f"{title}.pdf", mime="application/pdf", use_container_width=True)
+                enc_stats = ImageEncoder.stats().get(image_preset)
+                if enc_stats:
+                    st.caption(f"{image_preset}: {enc_stats['images']} images, {enc_stats['bytes_saved'] // 1024} KB saved")
                 st.success("팁: 이 문제가 마음에 드셨나요? 더 많은 자료는 아래 링크를 확인해보세요!")
                 st.markdown("""
                 <a href="https://www.yes24.com" target="_blank">
@@ -1350,9 +3205,12 @@ def main_app_interface():
                         st.markdown(f"**Solution:** {normalize_latex_text(data.get('solution'))}")
                         if st.button(T("delete"), key=f"del_{i}"):
                             del st.session_state['history'][i]
+                            bump_history_version()
                             st.rerun()
-                st.download_button(T("zip_download"), PDFGenerator.create_history_zip(st.session_state['history']), file_name="history.zip", mime="application/zip", use_container_width=True)
-                st.download_button(T("csv_download"), PDFGenerator.convert_history_to_csv(st.session_state['history']), file_name="history.csv", mime="text/csv", use_container_width=True)
+                history_snapshot = list(st.session_state['history'])
+                history_version = st.session_state['history_version']
+                st.download_button(T("zip_download"), lazy_export('history_zip', history_version, lambda: PDFGenerator.create_history_zip(history_snapshot)), file_name="history.zip", mime="application/zip", use_container_width=True)
+                st.download_button(T("csv_download"), lazy_export('history_csv', history_version, lambda: PDFGenerator.convert_history_to_csv(history_snapshot)), file_name="history.csv", mime="text/csv", use_container_width=True)
     display_bottom_ad()
 def main():
     apply_custom_css()
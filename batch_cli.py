@@ -0,0 +1,171 @@
+"""Headless batch generation: a folder of problem images/PDFs -> twin problems -> workbook PDFs.
+
+    GEMINI_API_KEY=... python batch_cli.py exams/ --out batch_out --grade "High 1" --twins 2 --concurrency 4
+
+Every finished generation is appended to <out>/manifest.jsonl; re-running the same
+command skips entries already marked "ok", so an interrupted run resumes without
+calling the API again for them.
+"""
+import argparse
+import json
+import os
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from datetime import datetime
+from PIL import Image
+import fitz
+import app
+IMAGE_EXTS = {".png", ".jpg", ".jpeg"}
+def iter_sources(input_dir, all_pages=False):
+    # (source id, 상대 경로, 페이지, 이미지 로더)
+    for root, _, files in sorted(os.walk(input_dir)):
+        for name in sorted(files):
+            path = os.path.join(root, name)
+            rel = os.path.relpath(path, input_dir)
+            ext = os.path.splitext(name)[1].lower()
+            if ext in IMAGE_EXTS:
+                yield rel, 0, (lambda p=path: Image.open(p).convert("RGB"))
+            elif ext == ".pdf":
+                try:
+                    with fitz.open(path) as doc:
+                        pages = doc.page_count if all_pages else min(1, doc.page_count)
+                except Exception as e:
+                    print(f"skip {rel}: {e}")
+                    continue
+                for page in range(pages):
+                    yield rel, page, (lambda p=path, n=page: render_pdf_page(p, n))
+def render_pdf_page(path, page_no, zoom=2):
+    with fitz.open(path) as doc:
+        pix = doc.load_page(page_no).get_pixmap(matrix=fitz.Matrix(zoom, zoom))
+        return Image.frombytes("RGB", [pix.width, pix.height], pix.samples)
+class Manifest:
+    # JSONL 체크포인트: 한 줄 = 한 생성 결과, 같은 id 는 마지막 줄이 우선
+    def __init__(self, path):
+        self.path = path
+        self.entries = {}
+        self._lock = threading.Lock()
+        if os.path.exists(path):
+            with open(path, encoding="utf-8") as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                        self.entries[entry["id"]] = entry
+                    except (ValueError, KeyError):
+                        continue
+    def done(self, entry_id):
+        return self.entries.get(entry_id, {}).get("status") == "ok"
+    def append(self, entry):
+        with self._lock:
+            self.entries[entry["id"]] = entry
+            with open(self.path, "a", encoding="utf-8") as f:
+                f.write(json.dumps(entry, ensure_ascii=False) + "\n")
+                f.flush()
+                os.fsync(f.fileno())
+def run_job(api_key, job, settings):
+    entry_id, rel, page, twin, count, load_image = job
+    started = time.perf_counter()
+    entry = {"id": entry_id, "source": rel, "page": page, "twin": twin, "time": datetime.now().strftime("%Y-%m-%d %H:%M")}
+    try:
+        data = app.run_twin_pipeline(api_key, load_image(), settings, app.twin_instruction(twin, count))
+        if data.get("problem") and data.get("concept") != "Parsing Error":
+            entry.update(status="ok", data=data)
+        else:
+            entry.update(status="error", error=str(data.get("problem", ""))[:500])
+    except Exception as e:
+        entry.update(status="error", error=f"{type(e).__name__}: {e}")
+    entry["seconds"] = round(time.perf_counter() - started, 2)
+    return entry
+def write_workbooks(manifest, order, args):
+    items = []
+    for entry_id in order:
+        entry = manifest.entries.get(entry_id)
+        if entry and entry.get("status") == "ok":
+            items.append({"time": entry.get("time", ""), "data": entry["data"], "grade": args.grade, "difficulty": args.difficulty})
+    paths = []
+    for start in range(0, len(items), args.workbook_size):
+        chunk = items[start:start + args.workbook_size]
+        suffix = f"_{start // args.workbook_size + 1:02d}" if len(items) > args.workbook_size else ""
+        path = os.path.join(args.out, f"{args.title.replace(' ', '_')}{suffix}.pdf")
+        with open(path, "wb") as f:
+            f.write(app.PDFGenerator.create_workbook_pdf(chunk, args.title, args.export_mode, image_preset=args.quality))
+        paths.append((path, len(chunk)))
+    return paths
+def positive_int(value):
+    number = int(value)
+    if number < 1:
+        raise argparse.ArgumentTypeError(f"must be a positive integer, got {value}")
+    return number
+def build_parser():
+    parser = argparse.ArgumentParser(description="Generate twin problems for a folder of images/PDFs and build workbooks.")
+    parser.add_argument("input_dir")
+    parser.add_argument("--out", default="batch_out")
+    parser.add_argument("--api-key", default=os.environ.get("GEMINI_API_KEY"))
+    parser.add_argument("--grade", default="Middle 1")
+    parser.add_argument("--difficulty", default="Maintain", choices=["Maintain", "Easier", "Harder"])
+    parser.add_argument("--type", default="Any", choices=["Any", "Multiple Choice", "Essay"])
+    parser.add_argument("--subject")
+    parser.add_argument("--language", default="Korean", choices=["Korean", "English"])
+    parser.add_argument("--creativity", type=float, default=0.5)
+    parser.add_argument("--curriculum", help="text file with curriculum notes")
+    parser.add_argument("--model", help="skip model discovery and use this model")
+    parser.add_argument("--twins", type=positive_int, default=1, help="twin problems per source")
+    parser.add_argument("--concurrency", type=positive_int, default=app.BATCH_CONCURRENCY)
+    parser.add_argument("--fast", action="store_true", help="single-call generation")
+    parser.add_argument("--force-fresh", action="store_true", help="bypass the response cache")
+    parser.add_argument("--all-pages", action="store_true", help="use every PDF page, not only the first")
+    parser.add_argument("--title", default="Math Twin Workbook")
+    parser.add_argument("--export-mode", default="Integrated", choices=["Integrated", "Problem Only", "Solution Only"])
+    parser.add_argument("--quality", default=app.DEFAULT_IMAGE_PRESET, choices=list(app.IMAGE_PRESETS))
+    parser.add_argument("--workbook-size", type=positive_int, default=50, help="problems per workbook PDF")
+    parser.add_argument("--no-workbook", action="store_true")
+    return parser
+def main(argv=None):
+    args = build_parser().parse_args(argv)
+    if not args.api_key:
+        sys.exit("GEMINI_API_KEY (or --api-key) is required")
+    os.makedirs(args.out, exist_ok=True)
+    state = app._runtime_state()
+    if args.model:
+        state["preferred_model_mode"] = args.model
+    else:
+        ok, msg = app.GeminiClient.test_api_connection(args.api_key)
+        print(msg)
+        if not ok:
+            sys.exit(1)
+    curriculum = ""
+    if args.curriculum:
+        with open(args.curriculum, encoding="utf-8") as f:
+            curriculum = f.read()
+    settings = {
+        "difficulty": args.difficulty, "grade": args.grade, "curriculum_text": curriculum, "style_img": None,
+        "creativity": args.creativity, "prob_type": args.type, "subject": args.subject, "language": args.language,
+        "force_fresh": args.force_fresh, "fast_mode": args.fast
+    }
+    manifest = Manifest(os.path.join(args.out, "manifest.jsonl"))
+    order, jobs = [], []
+    for rel, page, load_image in iter_sources(args.input_dir, args.all_pages):
+        for twin in range(args.twins):
+            entry_id = f"{rel}#p{page + 1}#t{twin + 1}"
+            order.append(entry_id)
+            if not manifest.done(entry_id):
+                jobs.append((entry_id, rel, page, twin, args.twins, load_image))
+    print(f"{len(order)} generations, {len(order) - len(jobs)} already done, {len(jobs)} to run")
+    started = time.perf_counter()
+    failed = 0
+    with ThreadPoolExecutor(max_workers=max(1, args.concurrency)) as pool:
+        futures = [pool.submit(run_job, args.api_key, job, settings) for job in jobs]
+        for n, fut in enumerate(as_completed(futures), 1):
+            entry = fut.result()
+            manifest.append(entry)
+            failed += entry["status"] != "ok"
+            print(f"[{n}/{len(jobs)}] {entry['id']} {entry['status']} ({entry['seconds']}s)" + (f" - {entry['error'][:120]}" if entry["status"] != "ok" else ""))
+    print(f"generation finished in {time.perf_counter() - started:.1f}s, {failed} failed")
+    if not args.no_workbook:
+        for path, count in write_workbooks(manifest, order, args):
+            print(f"wrote {path} ({count} problems)")
+    if failed:
+        sys.exit(2)
+if __name__ == "__main__":
+    main()
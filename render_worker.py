@@ -0,0 +1,26 @@
+"""Picklable entry points for the spawn worker processes started by app.py.
+
+Streamlit runs app.py as a fresh ``__main__`` module on every rerun, so a
+function defined there can fail pickle's identity check when another
+session's rerun has replaced ``sys.modules['__main__']``. The pools and the
+figure sandbox therefore reference these stable module-level functions; each
+one only forwards to the implementation in app.py inside the worker.
+"""
+import os
+import sys
+APP_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "app.py")
+def load_app():
+    # spawn 된 자식은 부모의 __main__(app.py) 을 __mp_main__ 으로 이미 실행했으므로 그 모듈을 그대로 쓴다
+    main = sys.modules.get("__mp_main__")
+    if main is not None and os.path.abspath(getattr(main, "__file__", "") or "") == APP_PATH:
+        return main
+    import app
+    return app
+def figure_worker_main(conn, memory_mb, cpu_seconds):
+    load_app()._figure_worker_main(conn, memory_mb, cpu_seconds)
+def render_worker_init():
+    load_app()._render_worker_init()
+def render_job(job):
+    return load_app()._render_job(job)
+def history_pdf_job(job):
+    return load_app()._history_pdf_job(job)
@@ -0,0 +1,16 @@
+import os
+import runpy
+import sys
+import warnings
+import pytest
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.join(ROOT, "tools"))
+# app 은 import 시점에 캐시 경로를 읽으므로 테스트가 사용자 캐시를 건드리지 않도록 먼저 끈다
+os.environ.setdefault("RESPONSE_CACHE_PATH", "")
+os.environ.setdefault("REF_INDEX_PATH", "")
+warnings.filterwarnings("ignore")
+@pytest.fixture(scope="session")
+def reruns():
+    # Streamlit 재실행처럼 app.py 를 같은 이름의 새 모듈로 두 번 실행한 전역 변수들
+    return [runpy.run_path(os.path.join(ROOT, "app.py"), run_name="__rerun__") for _ in range(2)]
@@ -0,0 +1,64 @@
+import json
+import pytest
+from PIL import Image
+import app
+import batch_cli
+def make_inputs(tmp_path, n=2):
+    src = tmp_path / "src"
+    src.mkdir()
+    for i in range(n):
+        Image.new("RGB", (8, 8), "white").save(src / f"q{i}.png")
+    return src
+@pytest.fixture
+def pipeline(monkeypatch):
+    calls = []
+    def fake_pipeline(api_key, image, settings, instruction):
+        calls.append(instruction)
+        return {"concept": "c", "problem": f"p{len(calls)}", "answer": "a", "solution": "s", "hint": "", "drawing_code": ""}
+    monkeypatch.setattr(app, "run_twin_pipeline", fake_pipeline)
+    monkeypatch.setattr(app, "_runtime_state", lambda: {})
+    return calls
+def test_manifest_last_entry_wins_and_skips_bad_lines(tmp_path):
+    path = tmp_path / "manifest.jsonl"
+    path.write_text("\n".join([
+        json.dumps({"id": "a", "status": "error"}),
+        json.dumps({"id": "a", "status": "ok"}),
+        json.dumps({"id": "b", "status": "ok"}),
+        json.dumps({"id": "b", "status": "error"}),
+        json.dumps({"status": "ok"}),
+        '{"id": "c", "status": "o',
+    ]) + "\n", encoding="utf-8")
+    manifest = batch_cli.Manifest(str(path))
+    assert manifest.done("a") and not manifest.done("b") and not manifest.done("c")
+def test_manifest_append_is_reloaded(tmp_path):
+    path = str(tmp_path / "manifest.jsonl")
+    batch_cli.Manifest(path).append({"id": "x", "status": "ok", "data": {"problem": "문제"}})
+    reloaded = batch_cli.Manifest(path)
+    assert reloaded.done("x") and reloaded.entries["x"]["data"]["problem"] == "문제"
+def test_rerun_resumes_without_calling_api(tmp_path, pipeline):
+    src = make_inputs(tmp_path)
+    argv = [str(src), "--out", str(tmp_path / "out"), "--api-key", "k", "--model", "m", "--twins", "2", "--no-workbook"]
+    batch_cli.main(argv)
+    assert len(pipeline) == 4
+    batch_cli.main(argv)
+    assert len(pipeline) == 4
+    manifest = batch_cli.Manifest(str(tmp_path / "out" / "manifest.jsonl"))
+    assert sorted(manifest.entries) == [f"q{i}.png#p1#t{t}" for i in range(2) for t in (1, 2)]
+def test_failed_entries_are_retried(tmp_path, pipeline):
+    src = make_inputs(tmp_path, 1)
+    out = tmp_path / "out"
+    out.mkdir()
+    (out / "manifest.jsonl").write_text(json.dumps({"id": "q0.png#p1#t1", "status": "error", "error": "quota"}) + "\n", encoding="utf-8")
+    batch_cli.main([str(src), "--out", str(out), "--api-key", "k", "--model", "m", "--no-workbook"])
+    assert len(pipeline) == 1
+    assert batch_cli.Manifest(str(out / "manifest.jsonl")).done("q0.png#p1#t1")
+@pytest.mark.parametrize("flag", ["--workbook-size", "--twins", "--concurrency"])
+@pytest.mark.parametrize("value", ["0", "-3", "x"])
+def test_rejects_non_positive_counts(flag, value, capsys):
+    with pytest.raises(SystemExit) as exc:
+        batch_cli.build_parser().parse_args(["in", flag, value])
+    assert exc.value.code == 2
+    assert flag in capsys.readouterr().err
+def test_accepts_positive_counts():
+    args = batch_cli.build_parser().parse_args(["in", "--workbook-size", "3", "--twins", "2", "--concurrency", "1"])
+    assert (args.workbook_size, args.twins, args.concurrency) == (3, 2, 1)
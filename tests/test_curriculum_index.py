@@ -0,0 +1,46 @@
+import app
+CURRICULUM = "\n".join([
+    "[4수학01-01] 네 자리 이하의 수를 읽고 쓸 수 있다.",
+    "[6수학02-03] 직육면체와 정육면체의 겉넓이를 구할 수 있다.",
+    "[9수학02-04] 일차함수의 그래프를 그리고 기울기를 이해한다.",
+    "[9수학03-01] 피타고라스 정리를 이해하고 활용할 수 있다.",
+    "[10수학01-02] 이차방정식의 근과 계수의 관계를 이해한다.",
+    "[12수학02-01] 함수의 극한과 연속을 이해한다.",
+])
+def test_split_respects_chunk_size():
+    chunks = app.CurriculumIndex.split("a" * 25 + "\n\nbb\ncc\n" + "d" * 5, 10)
+    assert chunks[:2] == ["a" * 10, "a" * 10]
+    assert all(len(c) <= 10 for c in chunks)
+    assert "".join(chunks).replace("\n", "") == "a" * 25 + "bbcc" + "d" * 5
+def test_tokenize_codes_words_and_bigrams():
+    tokens = app.CurriculumIndex.tokenize("[9수학02-04] 일차함수 y=2x")
+    assert "code:9" in tokens
+    assert {"일차함수", "일차", "차함", "함수", "y", "2", "x"} <= set(tokens)
+def test_select_prefers_matching_grade_and_topic():
+    index = app.CurriculumIndex([CURRICULUM], chunk_chars=40)
+    picked = index.select("중학교 2학년 [9수학 일차함수 그래프", token_budget=30)
+    assert "[9수학02-04]" in picked
+    assert "[4수학01-01]" not in picked
+def test_select_stays_within_budget_and_keeps_order():
+    index = app.CurriculumIndex([CURRICULUM], chunk_chars=40)
+    picked = index.select("함수", token_budget=60)
+    assert app.estimate_tokens(picked.replace("\n...\n", "")) <= 60
+    parts = picked.split("\n...\n")
+    assert parts == sorted(parts, key=index.chunks.index)
+def test_select_without_match_falls_back_to_leading_chunks():
+    index = app.CurriculumIndex([CURRICULUM], chunk_chars=40)
+    assert index.select("zzz", token_budget=30) == index.chunks[0]
+def test_empty_index():
+    assert app.CurriculumIndex([""]).select("함수") == ""
+def test_small_texts_pass_through_unchanged():
+    assert app.select_curriculum_context((" short ", "", None), "함수") == "short"
+    assert app.select_curriculum_context(("", None), "함수") == ""
+def test_large_texts_are_trimmed_to_budget():
+    text = "\n".join(f"[9수학0{i % 5}-0{i % 9}] 주제 {i} 설명 문장입니다." for i in range(400))
+    picked = app.select_curriculum_context((text,), "주제 17", token_budget=1000)
+    assert picked and len(picked) < len(text)
+    assert "주제 17 " in picked
+    assert app.estimate_tokens(picked) <= 1000 + 10
+def test_index_is_shared_across_reruns(reruns):
+    first, second = (ns["curriculum_index"](CURRICULUM, "rerun") for ns in reruns)
+    assert first is second
@@ -0,0 +1,71 @@
+import os
+import pytest
+import app
+check = app.DrawingCodeValidator.check
+def run(code):
+    ok, message, safe_code = check(code)
+    assert ok, message
+    fig = app.RenderEngine.run_drawing_code(safe_code)
+    return app.RenderEngine.figure_to_png(fig)
+@pytest.mark.parametrize("code", [
+    "if False:\n    open = 1\nopen('/etc/hostname').read()",
+    "def f(open):\n    return open\nprint(open)",
+    "import numpy as open\nx = open('/etc/hostname')",
+    "for eval in [1]:\n    pass\neval('1')",
+    "fig = plt.gcf()\nfig.savefig('/tmp/x.png')",
+    "plt.gcf().canvas.print_png('/tmp/x.png')",
+    "x = np.arange(3)\nx.tofile('/tmp/x.bin')",
+    "from matplotlib import image\nimage.imsave('/tmp/x.png', np.zeros((2, 2)))",
+    "import matplotlib.image as mimg",
+    "np.lib.format.open_memmap('/tmp/x.npy', mode='w+', shape=(2,))",
+    "import os",
+    "x = ().__class__",
+    "np = 1",
+    "getattr(plt, 'savefig')('/tmp/x.png')",
+])
+def test_rejects_unsafe_code(code):
+    ok, message, _ = check(code)
+    assert not ok, message
+def test_bypass_does_not_touch_filesystem(tmp_path):
+    target = tmp_path / "x.png"
+    ok, _, _ = check(f"fig = plt.gcf()\nfig.savefig({str(target)!r})")
+    assert not ok and not os.path.exists(target)
+def test_restricted_builtins_at_runtime():
+    with pytest.raises(NameError):
+        app.RenderEngine.run_drawing_code("open('/etc/hostname')")
+    with pytest.raises(ImportError):
+        app.RenderEngine.run_drawing_code("import subprocess")
+def test_unbounded_while_is_stopped(monkeypatch):
+    monkeypatch.setattr(app, "FIGURE_MAX_LOOP_ITERATIONS", 10000)
+    ok, _, safe_code = check("i = 0\nwhile i >= 0:\n    i += 1\nplt.plot([0, 1])")
+    assert ok and app.DrawingCodeValidator.LOOP_GUARD in safe_code
+    with pytest.raises(RuntimeError):
+        app.RenderEngine.run_drawing_code(safe_code)
+def test_unknown_iterable_is_guarded(monkeypatch):
+    monkeypatch.setattr(app, "FIGURE_MAX_LOOP_ITERATIONS", 10000)
+    ok, _, safe_code = check("import itertools\nfor i in itertools.count():\n    pass")
+    assert ok
+    with pytest.raises(RuntimeError):
+        app.RenderEngine.run_drawing_code(safe_code)
+def test_cost_limits():
+    ok, message, safe_code = check("x = np.linspace(0, 1, 10**9)\nplt.plot(x, x)")
+    assert ok and message.startswith("Clamped") and str(app.FIGURE_MAX_LINSPACE) in safe_code
+    assert not check("x = np.arange(0, 1e9, 1)")[0]
+    assert not check("for i in range(10**5):\n    for j in range(10**5):\n        pass")[0]
+@pytest.mark.parametrize("code", [
+    "import numpy as np\nimport matplotlib.pyplot as plt\nx = np.linspace(-3, 3, 200)\nfig, ax = plt.subplots(figsize=(5, 4))\n"
+    "ax.plot(x, x ** 2, label='y=x^2')\nax.fill_between(x, 0, x ** 2, alpha=0.2)\nax.axhline(0, color='k')\nax.legend()\n"
+    "ax.spines['top'].set_visible(False)\nax.set_aspect('equal')\nax.grid(True)\nplt.savefig('out.png')",
+    "import matplotlib.patches as patches\nfig, ax = plt.subplots()\nax.add_patch(patches.Circle((0, 0), 1, fill=False))\n"
+    "ax.annotate('A', xy=(1, 0), xytext=(1.2, 0.2), arrowprops=dict(arrowstyle='->'))\nax.set_xlim(-2, 2)\nax.set_ylim(-2, 2)\nax.axis('off')",
+    "from matplotlib import ticker\nfig, ax = plt.subplots()\nbars = ax.bar(['a', 'b'], [3, 5])\nfor b in bars:\n    ax.text(b.get_x(), b.get_height(), str(b.get_height()))\n"
+    "ax.yaxis.set_major_locator(ticker.MaxNLocator(integer=True))",
+    "fig = plt.figure()\nax = fig.add_subplot(projection='3d')\nX, Y = np.meshgrid(np.linspace(-1, 1, 20), np.linspace(-1, 1, 20))\n"
+    "ax.plot_surface(X, Y, X * Y)\nax.view_init(30, 45)",
+    "class P:\n    def __init__(self, x):\n        self.x = x\npts = [P(i) for i in range(5)]\nplt.scatter([p.x for p in pts], [p.x ** 2 for p in pts])\n"
+    "try:\n    v = 1 / 0\nexcept ZeroDivisionError:\n    v = 0\nplt.title(f'v={v:.1f}')",
+    "rng = np.random.default_rng(0)\nplt.hist(rng.normal(size=100), bins=10)\nplt.xlabel('{:.1f}'.format(1.0))",
+    "i = 0\nys = []\nwhile i < 10:\n    ys.append(i * i)\n    i += 1\nplt.plot(ys)",
+])
+def test_common_drawing_code_runs(code):
+    assert run(code).startswith(b"\x89PNG")
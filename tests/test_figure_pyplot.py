@@ -0,0 +1,33 @@
+import matplotlib
+import pytest
+import app
+def draw(code):
+    ok, message, safe_code = app.DrawingCodeValidator.check(code)
+    assert ok, message
+    return app.RenderEngine.run_drawing_code(safe_code)
+@pytest.mark.parametrize("code", [
+    "plt.style.use('default')\nplt.plot([0, 1], [0, 1])",
+    "plt.style.use('seaborn-v0_8')\nplt.rc('font', size=12)\nplt.rcdefaults()\nplt.plot([0, 1])",
+    "with plt.style.context('ggplot'):\n    plt.plot([0, 1])",
+    "with plt.rc_context({'lines.linewidth': 3}):\n    plt.plot([0, 1])",
+    "import matplotlib\nmatplotlib.style.use('classic')\nplt.plot([0, 1])",
+    "print(len(list(plt.style.available)))\nplt.plot([0, 1])",
+    "lines = plt.plot([0, 1], [1, 0])\nplt.setp(lines, color='r', linewidth=2)",
+    "plt.plot([0, 1])\nplt.setp(plt.gca().get_xticklabels(), rotation=45)",
+    "plt.plot([0, 1])\nplt.box(False)",
+    "plt.plot([0, 1])\nplt.grid(True)\nplt.legend(['a'])\nplt.axis('equal')\nplt.minorticks_on()",
+    "plt.plot([0, 1])\nplt.draw_if_interactive()\nplt.tight_layout()",
+])
+def test_generated_code_idioms(code):
+    fig = draw(code)
+    assert fig.get_axes()
+    assert app.RenderEngine.figure_to_png(fig).startswith(b"\x89PNG")
+def test_style_calls_do_not_touch_global_state():
+    before = dict(matplotlib.rcParams)
+    draw("plt.style.use('dark_background')\nplt.rc('lines', linewidth=9)\nplt.plot([0, 1])")
+    assert dict(matplotlib.rcParams) == before
+def test_setp_and_box_apply_to_current_axes():
+    fig = draw("lines = plt.plot([0, 1])\nplt.setp(lines, linewidth=4)\nplt.box(False)")
+    ax = fig.get_axes()[0]
+    assert ax.get_lines()[0].get_linewidth() == 4
+    assert not ax.get_frame_on()
@@ -0,0 +1,73 @@
+import threading
+import time
+import pytest
+import app
+pytestmark = pytest.mark.skipif(not app.FigureSandbox.available(), reason="worker start method unavailable")
+PLOT = "import numpy as np\nx = np.linspace(0, 1, 50)\nplt.plot(x, x ** 2)"
+def test_worker_starts_while_another_thread_renders():
+    # 다른 스레드가 렌더 락을 잡고 있는 동안 워커를 띄워도 멈추지 않아야 한다
+    stop = threading.Event()
+    def render_loop():
+        while not stop.is_set():
+            app.RenderEngine.figure_to_png(app.RenderEngine.run_drawing_code(PLOT))
+    threads = [threading.Thread(target=render_loop, daemon=True) for _ in range(2)]
+    for t in threads:
+        t.start()
+    try:
+        sandbox = app.FigureSandbox(size=2)
+        started = time.perf_counter()
+        results = [sandbox.run(PLOT, timeout=30) for _ in range(4)]
+        assert time.perf_counter() - started < 60
+    finally:
+        stop.set()
+        for t in threads:
+            t.join(10)
+    for status, png, has_axes in results:
+        assert status == 'ok'
+        assert png and png.startswith(b"\x89PNG")
+        assert has_axes
+def test_timed_out_worker_is_replaced():
+    sandbox = app.FigureSandbox(size=1)
+    assert sandbox.run("while True:\n    pass", timeout=3) == ('timeout', None, False)
+    status, png, has_axes = sandbox.run(PLOT, timeout=30)
+    assert status == 'ok' and png and has_axes
+def test_user_code_error_is_reported():
+    sandbox = app.FigureSandbox(size=1)
+    assert sandbox.run("plt.plot([1, 2])\n1 / 0", timeout=30) == ('error', None, False)
+@pytest.mark.parametrize("status, cached", [('ok', True), ('error', True), ('timeout', False), ('busy', False), ('unavailable', False)])
+def test_render_caches_only_deterministic_outcomes(monkeypatch, status, cached):
+    code = f"plt.plot([1, 2])  # {status}"
+    calls = []
+    def fake_execute(safe_code):
+        calls.append(safe_code)
+        return (status, b"png", True) if status == 'ok' else (status, None, False)
+    monkeypatch.setattr(app.FigureSandbox, "_execute", staticmethod(fake_execute))
+    first = app.FigureSandbox.render(code)
+    assert app.FigureSandbox.render(code) == first
+    assert len(calls) == (1 if cached else 2)
+    assert (app.FIGURE_CACHE.get(app.FigureSandbox.figure_key(code)) is not None) == cached
+def test_render_caches_validator_rejection(monkeypatch):
+    code = "plt.plot([1, 2])\nopen('x')"
+    monkeypatch.setattr(app.FigureSandbox, "_execute", staticmethod(lambda safe_code: pytest.fail("rejected code executed")))
+    assert app.FigureSandbox.render(code) == (None, False)
+    assert app.FIGURE_CACHE.get(app.FigureSandbox.figure_key(code)) == (None, False)
+def test_sandbox_is_shared_across_reruns_and_closed_on_release(reruns):
+    first, second = (ns["FigureSandbox"].instance() for ns in reruns)
+    assert first is second
+    procs = [worker[0] for worker in list(first._idle.queue)]
+    assert procs
+    reruns[1]["get_figure_sandbox"].clear()
+    for proc in procs:
+        proc.join(5)
+        assert not proc.is_alive()
+    assert reruns[0]["FigureSandbox"].instance() is not first
+    reruns[0]["get_figure_sandbox"].clear()
+def test_figure_runs_once_across_reruns(reruns, monkeypatch):
+    first, second = reruns
+    assert first["FIGURE_CACHE"] is second["FIGURE_CACHE"]
+    assert first["FigureSandbox"]._inflight is second["FigureSandbox"]._inflight
+    code = "plt.plot([0, 1], [2, 3])  # rerun"
+    monkeypatch.setattr(first["FigureSandbox"], "_execute", staticmethod(lambda safe_code: ('ok', b"png", True)))
+    monkeypatch.setattr(second["FigureSandbox"], "_execute", staticmethod(lambda safe_code: pytest.fail("figure executed again")))
+    assert first["FigureSandbox"].render(code) == (b"png", True)
+    assert second["FigureSandbox"].render(code) == (b"png", True)
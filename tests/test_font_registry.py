@@ -0,0 +1,34 @@
+import os
+import matplotlib
+import pytest
+from fpdf import FPDF
+import app
+FONT = os.path.join(os.path.dirname(matplotlib.__file__), "mpl-data", "fonts", "ttf", "DejaVuSans.ttf")
+@pytest.fixture
+def registry(monkeypatch):
+    monkeypatch.setattr(app, "FONT_PATH", FONT)
+    monkeypatch.setattr(app.FontRegistry, "_available", None)
+    monkeypatch.setattr(app.FontRegistry, "_loaded", {})
+    return app.FontRegistry
+def test_fpdf2_font_internals_are_unchanged():
+    # FontRegistry.ensure 는 fpdf2 TTFFont 의 내부 필드를 직접 설정한다: fpdf2 를 올릴 때 이 테스트가 먼저 깨져야 한다
+    pdf = FPDF()
+    pdf.add_font("Probe", "", FONT)
+    font = pdf.fonts["probe"]
+    for field in ("i", "ttfont", "missing_glyphs", "biggest_size_pt", "_hbfont", "subset", "cw"):
+        assert hasattr(font, field), field
+    assert isinstance(app.SubsetMap(font), type(font.subset))
+def test_ensure_shares_parsed_template(registry):
+    first, second = app.PDFGenerator.ExamPDF(), app.PDFGenerator.ExamPDF()
+    assert registry.ensure(first) and registry.ensure(second)
+    a, b = first.fonts["nanumgothic"], second.fonts["nanumgothic"]
+    assert a.cw is b.cw
+    assert a.subset is not b.subset and a.ttfont is not b.ttfont
+    for pdf, text in ((first, "alpha"), (second, "beta")):
+        pdf.set_font("NanumGothic", "", 12)
+        pdf.add_page()
+        pdf.cell(0, 10, text)
+        assert bytes(pdf.output()).startswith(b"%PDF")
+def test_template_is_shared_across_reruns(reruns):
+    first, second = reruns
+    assert first["FontRegistry"]._loaded is second["FontRegistry"]._loaded
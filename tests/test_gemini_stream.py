@@ -0,0 +1,58 @@
+import json
+import pytest
+import requests
+import app
+import gemini_standin
+class FakeResponse:
+    def __init__(self, events, error=None):
+        self.lines = [f"data: {json.dumps(e)}".encode("utf-8") for e in events]
+        self.error = error
+        self.closed = False
+    def iter_lines(self):
+        for line in self.lines:
+            yield line
+            yield b""
+        if self.error:
+            raise self.error
+    def close(self):
+        self.closed = True
+def event(text, finish=None):
+    cand = {"content": {"parts": [{"text": text}], "role": "model"}}
+    if finish:
+        cand["finishReason"] = finish
+    return {"candidates": [cand]}
+def test_complete_stream_returns_text():
+    seen = []
+    res = FakeResponse([event('{"problem": '), event('"x"}', "STOP")])
+    assert app.GeminiClient.read_stream(res, seen.append) == '{"problem": "x"}'
+    assert seen == ['{"problem": ', '"x"}'] and res.closed
+def test_stream_without_stop_is_an_error():
+    text = app.GeminiClient.read_stream(FakeResponse([event('{"concept": "x", "problem": "truncated pro')]), lambda _: None)
+    assert app.is_api_error(text)
+    text = app.GeminiClient.read_stream(FakeResponse([event('{"problem": "x"', "MAX_TOKENS")]), lambda _: None)
+    assert app.is_api_error(text) and "MAX_TOKENS" in text
+def test_mid_stream_failure_raises():
+    res = FakeResponse([event('{"concept": "x", "problem": "trunc')], requests.ConnectionError("reset"))
+    with pytest.raises(app.StreamInterrupted):
+        app.GeminiClient.read_stream(res, lambda _: None)
+    assert res.closed
+def test_call_api_streams_from_standin(monkeypatch):
+    _, base = gemini_standin.start_standin(gemini_standin.StandinConfig(latency=0.05))
+    monkeypatch.setattr(app, "GEMINI_API_BASE", base)
+    chunks = []
+    text, model = app.GeminiClient.call_api("test-key", {"contents": [{"parts": [{"text": "hi"}]}]}, "gemini-2.5-flash", on_text=chunks.append)
+    assert not app.is_api_error(text) and len(chunks) > 1
+    assert json.loads(text)["problem"] == gemini_standin.SYNTHETIC_RESPONSE["problem"]
+def test_partial_json_parser_emits_completed_fields():
+    source = json.dumps({"concept": "일차방정식", "problem": "풀어라 \"x\"\n", "nested": {"problem": "inner"}, "answer": "5"}, ensure_ascii=False)
+    parser = app.PartialJSONParser()
+    completed = {}
+    for i in range(0, len(source), 7):
+        for key, value in parser.feed(source[i:i + 7]).items():
+            assert key not in completed
+            completed[key] = value
+    assert completed == {"concept": "일차방정식", "problem": "풀어라 \"x\"\n", "answer": "5"}
+def test_partial_json_parser_holds_incomplete_string():
+    parser = app.PartialJSONParser()
+    assert parser.feed('{"problem": "half') == {}
+    assert parser.feed(' done"') == {"problem": "half done"}
@@ -0,0 +1,39 @@
+import io
+import zipfile
+import pytest
+import app
+import render_worker
+def history(n):
+    items = []
+    for i in range(n):
+        data = {"problem": f"Find $x^{i}$.", "answer": str(i), "solution": "Solution", "hint": "", "concept": "Exponents"}
+        if i % 2 == 0:
+            data["drawing_code"] = f"plt.plot([0, {i + 1}], [0, 1])"
+        items.append({"grade": "Middle 1", "data": data})
+    return items
+@pytest.mark.parametrize("parallel", [False, True])
+def test_figures_are_rendered_in_parent(monkeypatch, parallel):
+    monkeypatch.setattr(app, "RENDER_WORKERS", 2)
+    app.get_render_pool.clear()
+    render = app.FigureSandbox.render
+    calls = []
+    def counting_render(code):
+        calls.append(code)
+        return render(code)
+    monkeypatch.setattr(app.FigureSandbox, "render", staticmethod(counting_render))
+    items = history(3)
+    with app.PDFGenerator.stream_history_zip(items, parallel=parallel) as spool:
+        names = zipfile.ZipFile(io.BytesIO(spool.read())).namelist()
+    assert sorted(names) == [f"Problem_{i + 1}_Middle_1.pdf" for i in range(3)]
+    assert [c for c in calls if c] == [items[0]["data"]["drawing_code"], items[2]["data"]["drawing_code"]]
+def test_pdf_job_uses_given_png_only(monkeypatch):
+    monkeypatch.setattr(app.FigureSandbox, "render", staticmethod(lambda code: pytest.fail("render called in PDF job")))
+    item = history(1)[0]
+    idx, title, pdf_bytes, err = render_worker.history_pdf_job((0, item, app.DEFAULT_IMAGE_PRESET, None))
+    assert err is None and pdf_bytes.startswith(b"%PDF")
+def test_zip_is_accepted_by_download_button():
+    from streamlit.elements.widgets.button import marshall_file
+    from streamlit.proto.DownloadButton_pb2 import DownloadButton
+    data = app.PDFGenerator.create_history_zip(history(2))
+    marshall_file("history", data, DownloadButton(), "application/zip", "history.zip")
+    assert len(zipfile.ZipFile(io.BytesIO(data)).namelist()) == 2
@@ -0,0 +1,46 @@
+import app
+import gemini_standin
+def test_session_is_shared_and_pooled():
+    session = app.get_http_session()
+    assert app.get_http_session() is session
+    adapter = session.get_adapter("https://generativelanguage.googleapis.com")
+    assert adapter is session.get_adapter("http://127.0.0.1")
+    assert adapter._pool_maxsize == app.HTTP_POOL_SIZE
+    assert adapter.max_retries.total == 0
+    assert session.headers["Content-Type"] == "application/json"
+def test_requests_verify_tls(monkeypatch):
+    seen = []
+    class Session:
+        def post(self, url, **kwargs):
+            seen.append(kwargs["verify"])
+            raise app.requests.ConnectionError("offline")
+        get = post
+    monkeypatch.setattr(app, "get_http_session", lambda: Session())
+    monkeypatch.setattr(app, "HTTP_VERIFY", "/etc/ssl/ca.pem")
+    monkeypatch.setattr(app, "API_MAX_ATTEMPTS", 1)
+    monkeypatch.setattr(app.TokenBucket, "_buckets", {})
+    app.GeminiClient.post_with_retry("key", "m", {}, app.time.monotonic() + 5)
+    app.GeminiClient.get_working_model("key")
+    app.GeminiClient.probe_model("key", "m")
+    assert seen == ["/etc/ssl/ca.pem"] * 3
+def test_model_url():
+    url = app.GeminiClient.model_url("gemini-2.5-flash", "k")
+    assert url == f"{app.GEMINI_API_BASE}/models/gemini-2.5-flash:generateContent?key=k"
+    assert app.GeminiClient.model_url("m", "k", "streamGenerateContent").endswith(":streamGenerateContent?key=k&alt=sse")
+def test_connections_are_reused(monkeypatch):
+    server, base = gemini_standin.start_standin(gemini_standin.StandinConfig(latency=0))
+    peers = []
+    handler = server.RequestHandlerClass
+    def setup(self):
+        peers.append(self.client_address)
+        handler.setup(self)
+    server.RequestHandlerClass = type("CountingHandler", (handler,), {"setup": setup})
+    monkeypatch.setattr(app, "GEMINI_API_BASE", base)
+    monkeypatch.setattr(app.TokenBucket, "_buckets", {})
+    try:
+        assert app.GeminiClient.get_working_model("key")[0] == "gemini-2.5-flash"
+        for _ in range(3):
+            assert app.GeminiClient.probe_model("key", "gemini-2.5-flash")
+    finally:
+        server.shutdown()
+    assert len(peers) == 1
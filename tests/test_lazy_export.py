@@ -0,0 +1,28 @@
+import tempfile
+import pytest
+from streamlit.errors import StreamlitAPIException
+from streamlit.runtime.download_data_util import convert_data_to_bytes_and_infer_mime
+import app
+@pytest.fixture
+def export_cache(monkeypatch):
+    state = {'export_cache': {}}
+    monkeypatch.setattr(app.st, "session_state", state)
+    return state['export_cache']
+def spooled(data):
+    spool = tempfile.SpooledTemporaryFile(max_size=4)
+    spool.write(data)
+    return spool
+def test_file_result_is_memoized_as_bytes(export_cache):
+    calls = []
+    def builder():
+        calls.append(1)
+        return spooled(b"PK archive")
+    produce = app.lazy_export('history_zip', 1, builder)
+    assert produce() == b"PK archive"
+    assert produce() == b"PK archive"
+    assert len(calls) == 1
+    assert convert_data_to_bytes_and_infer_mime(produce(), StreamlitAPIException("unsupported"))[0] == b"PK archive"
+def test_new_key_rebuilds(export_cache):
+    assert app.lazy_export('history_csv', 1, lambda: b"v1")() == b"v1"
+    assert app.lazy_export('history_csv', 1, lambda: b"v2")() == b"v1"
+    assert app.lazy_export('history_csv', 2, lambda: b"v2")() == b"v2"
@@ -0,0 +1,25 @@
+import app
+def test_result_is_cached_per_key(monkeypatch):
+    calls = []
+    def discover(api_key):
+        calls.append(api_key)
+        return "gemini-2.5-flash"
+    assert app.ModelDiscovery.resolve("discovery-key", discover) == "gemini-2.5-flash"
+    assert app.ModelDiscovery.resolve(" discovery-key ", discover) == "gemini-2.5-flash"
+    assert calls == ["discovery-key"]
+    app.ModelDiscovery.invalidate("discovery-key")
+    app.ModelDiscovery.resolve("discovery-key", discover)
+    assert len(calls) == 2
+def test_failure_uses_short_ttl(monkeypatch):
+    monkeypatch.setattr(app, "MODEL_DISCOVERY_FAILURE_TTL", 0)
+    calls = []
+    def discover(api_key):
+        calls.append(api_key)
+        return None
+    assert app.ModelDiscovery.resolve("failing-key", discover) is None
+    assert app.ModelDiscovery.resolve("failing-key", discover) is None
+    assert len(calls) == 2
+def test_results_are_shared_across_reruns(reruns):
+    first, second = reruns
+    assert first["ModelDiscovery"].resolve("rerun-key", lambda api_key: "gemini-1.5-pro") == "gemini-1.5-pro"
+    assert second["ModelDiscovery"].resolve("rerun-key", lambda api_key: "probed again") == "gemini-1.5-pro"
@@ -0,0 +1,44 @@
+import os
+import app
+def make_library(tmp_path, monkeypatch):
+    ref_dir = tmp_path / "refs"
+    ref_dir.mkdir()
+    (ref_dir / "a.txt").write_text("alpha", encoding="utf-8")
+    (ref_dir / "b.txt").write_text("beta", encoding="utf-8")
+    extracted = []
+    extract = app._extract_reference_file
+    def counting_extract(path):
+        extracted.append(os.path.basename(path))
+        return extract(path)
+    monkeypatch.setattr(app, "_extract_reference_file", counting_extract)
+    return app.ReferenceLibrary(str(ref_dir), str(tmp_path / "index.json")), ref_dir, extracted
+def test_unchanged_directory_skips_extraction(tmp_path, monkeypatch):
+    library, _, extracted = make_library(tmp_path, monkeypatch)
+    text, count = library.load()
+    assert (text, count) == ("alpha\nbeta\n", 2)
+    assert sorted(extracted) == ["a.txt", "b.txt"]
+    again, _ = library.load()
+    assert again is text
+    assert len(extracted) == 2
+def test_only_changed_files_are_extracted(tmp_path, monkeypatch):
+    library, ref_dir, extracted = make_library(tmp_path, monkeypatch)
+    library.load()
+    (ref_dir / "b.txt").write_text("gamma!", encoding="utf-8")
+    (ref_dir / "a.txt").unlink()
+    assert library.load() == ("gamma!\n", 1)
+    assert extracted[2:] == ["b.txt"]
+def test_index_is_reused_across_instances(tmp_path, monkeypatch):
+    library, ref_dir, extracted = make_library(tmp_path, monkeypatch)
+    library.load()
+    fresh = app.ReferenceLibrary(library.ref_dir, library.index_path)
+    assert fresh.load() == ("alpha\nbeta\n", 2)
+    assert len(extracted) == 2
+def test_parallel_extraction_keeps_file_order(tmp_path, monkeypatch):
+    monkeypatch.setattr(app, "REF_EXTRACT_WORKERS", 4)
+    library, ref_dir, extracted = make_library(tmp_path, monkeypatch)
+    for name in ("c", "d", "e"):
+        (ref_dir / f"{name}.txt").write_text(name * 3, encoding="utf-8")
+    assert library.load() == ("alpha\nbeta\nccc\nddd\neee\n", 5)
+    assert sorted(extracted) == ["a.txt", "b.txt", "c.txt", "d.txt", "e.txt"]
+def test_library_is_shared_across_reruns(reruns):
+    assert reruns[0]["REFERENCE_LIBRARY"] is reruns[1]["REFERENCE_LIBRARY"]
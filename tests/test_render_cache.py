@@ -0,0 +1,51 @@
+import pytest
+import app
+def test_lru_eviction():
+    cache = app.RenderCache(max_items=2, disk_dir=None)
+    cache.put("a", b"1")
+    cache.put("b", b"2")
+    assert cache.get("a") == b"1"
+    cache.put("c", b"3")
+    assert cache.get("b") is None
+    assert cache.get("a") == b"1" and cache.get("c") == b"3"
+def test_disk_tier_survives_new_instance(tmp_path):
+    app.RenderCache(max_items=1, disk_dir=str(tmp_path)).put("k" * 64, b"png")
+    cache = app.RenderCache(max_items=1, disk_dir=str(tmp_path))
+    assert cache.get("k" * 64) == b"png"
+    assert cache.stats()["disk_hits"] == 1
+def test_make_key_includes_size_and_dpi():
+    assert app.RenderCache.make_key("$x$", 8.0, 300) != app.RenderCache.make_key("$x$", 8.0, 200)
+def test_text_render_is_reused_across_reruns(reruns, monkeypatch):
+    first, second = reruns
+    assert first["RENDER_CACHE"] is second["RENDER_CACHE"]
+    text = "Rerun cache $z^3$"
+    assert first["PDFGenerator"].render_text_to_image(text)
+    monkeypatch.setattr(second["RenderEngine"], "render_text", staticmethod(lambda *args: pytest.fail("rendered again")))
+    assert second["PDFGenerator"].render_text_to_image(text).getvalue().startswith(b"\x89PNG")
+def test_formula_render_is_reused_across_reruns(reruns, monkeypatch):
+    first, second = reruns
+    assert first["FORMULA_CACHE"] is second["FORMULA_CACHE"]
+    png, _ = first["PDFGenerator"].render_formula(r"\frac{a}{b}")
+    monkeypatch.setattr(second["RenderEngine"], "render_formula", staticmethod(lambda *args: pytest.fail("rendered again")))
+    assert second["PDFGenerator"].render_formula(r"\frac{a}{b}")[0] == png
+def test_workbook_fragments_are_reused_across_reruns(reruns, monkeypatch):
+    first, second = reruns
+    assert first["WORKBOOK_FRAGMENTS"] is second["WORKBOOK_FRAGMENTS"]
+    items = [{"data": {"problem": "Rerun fragment $x+1$", "answer": "2", "solution": "$x=1$"}}]
+    built = first["PDFGenerator"].build_workbook_fragments(items, parallel=False)
+    monkeypatch.setattr(second["RenderPool"], "render_all", staticmethod(lambda *args: pytest.fail("rendered again")))
+    assert second["PDFGenerator"].build_workbook_fragments(items, parallel=False) == built
+def test_encoded_images_are_reused_across_reruns(reruns):
+    from PIL import Image
+    first, second = reruns
+    assert first["ENCODED_IMAGES"] is second["ENCODED_IMAGES"]
+    image = Image.new("RGB", (8, 8), (12, 34, 56))
+    part = first["encode_image_part"](image)
+    assert second["encode_image_part"](image)["inline_data"]["data"] is part["inline_data"]["data"]
+def test_encoded_pdf_images_are_reused_across_reruns(reruns, monkeypatch):
+    first, second = reruns
+    assert first["ImageEncoder"]._cache is second["ImageEncoder"]._cache
+    png = first["PDFGenerator"].render_text_to_image("Encoder rerun $y$").getvalue()
+    out = first["ImageEncoder"].encode(png, "print", "text", 175)
+    monkeypatch.setattr(second["ImageEncoder"], "_encode_uncached", staticmethod(lambda *args: pytest.fail("encoded again")))
+    assert second["ImageEncoder"].encode(png, "print", "text", 175) == out
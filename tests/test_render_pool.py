@@ -0,0 +1,48 @@
+import os
+import runpy
+import time
+import app
+def text_jobs(n):
+    return [app.RenderPool.text_job(f"Line {i}: $x^{i}$") for i in range(n)]
+def test_parallel_text_rendering(monkeypatch):
+    monkeypatch.setattr(app, "RENDER_WORKERS", 2)
+    app.get_render_pool.clear()
+    app.RENDER_CACHE.clear()
+    jobs = text_jobs(4)
+    results = app.RenderPool.render_all(jobs, parallel=True)
+    assert all(results[job] and results[job].startswith(b"\x89PNG") for job in jobs)
+def test_pool_timeout_falls_back_to_serial(monkeypatch):
+    monkeypatch.setattr(app, "RENDER_WORKERS", 2)
+    monkeypatch.setattr(app, "RENDER_POOL_TIMEOUT", 0.01)
+    app.get_render_pool.clear()
+    app.RENDER_CACHE.clear()
+    jobs = text_jobs(3)
+    results = app.RenderPool.render_all(jobs, parallel=True)
+    assert all(results[job] for job in jobs)
+def test_hung_figure_gets_placeholder(monkeypatch):
+    monkeypatch.setattr(app, "FIGURE_STARTUP_TIMEOUT", 0.5)
+    monkeypatch.setattr(app, "FIGURE_TIMEOUT", 0.5)
+    serial = app.RenderPool._render_serial
+    def slow(job):
+        if job[0] == 'figure':
+            time.sleep(5)
+        return serial(job)
+    monkeypatch.setattr(app.RenderPool, "_render_serial", staticmethod(slow))
+    job = app.RenderPool.figure_job("plt.plot([0, 1], [1, 0])")
+    started = time.perf_counter()
+    results = app.RenderPool.render_all([job])
+    assert time.perf_counter() - started < 4
+    assert results[job] is app.RenderPool.placeholder_figure()
+def test_pool_works_for_a_rerun_module(monkeypatch):
+    # Streamlit 재실행처럼 sys.modules 에 없는 모듈에서 만든 작업도 워커로 보낼 수 있어야 한다
+    monkeypatch.setenv("RENDER_WORKERS", "2")
+    ns = runpy.run_path(os.path.join(os.path.dirname(app.__file__), "app.py"), run_name="__rerun__")
+    def serial(job):
+        raise AssertionError("fell back to serial rendering")
+    monkeypatch.setattr(ns["RenderPool"], "_render_serial", staticmethod(serial))
+    jobs = [ns["RenderPool"].text_job(f"Rerun {i}: $y^{i}$") for i in range(3)]
+    try:
+        results = ns["RenderPool"].render_all(jobs, parallel=True)
+    finally:
+        ns["get_render_pool"]().shutdown()
+    assert all(results[job].startswith(b"\x89PNG") for job in jobs)
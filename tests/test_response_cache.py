@@ -0,0 +1,59 @@
+import json
+import time
+import pytest
+from PIL import Image
+import app
+COMPLETE = json.dumps({k: "x" for k in app.RESPONSE_REQUIRED_KEYS})
+TRUNCATED = '{"concept": "x", "problem": "truncated pro'
+@pytest.fixture
+def cache(tmp_path, monkeypatch):
+    cache = app.ResponseCache(str(tmp_path / "responses.sqlite3"), ttl=3600, max_bytes=10_000)
+    monkeypatch.setattr(app, "RESPONSE_CACHE", cache)
+    monkeypatch.setattr(app.REFERENCE_LIBRARY, "ref_dir", str(tmp_path / "references"))
+    return cache
+def test_round_trip_and_stats(cache):
+    assert cache.get("k") is None
+    cache.put("k", "value")
+    assert cache.get("k") == "value"
+    assert cache.stats()["hits"] == 1 and cache.stats()["misses"] == 1
+def test_ttl_expiry(tmp_path):
+    cache = app.ResponseCache(str(tmp_path / "ttl.sqlite3"), ttl=0.05)
+    cache.put("k", "value")
+    time.sleep(0.1)
+    assert cache.get("k") is None
+def test_size_limit_evicts_least_recently_used(tmp_path):
+    cache = app.ResponseCache(str(tmp_path / "lru.sqlite3"), max_bytes=250)
+    cache.put("a", "a" * 100)
+    cache.put("b", "b" * 100)
+    assert cache.get("a")
+    cache.put("c", "c" * 100)
+    assert cache.get("b") is None
+    assert cache.get("a") and cache.get("c")
+def test_disabled_cache_is_a_no_op():
+    cache = app.ResponseCache("")
+    cache.put("k", "value")
+    assert cache.get("k") is None
+def test_is_complete_response():
+    assert app.is_complete_response(COMPLETE)
+    assert app.is_complete_response("```json\n" + COMPLETE + "\n```")
+    assert not app.is_complete_response(TRUNCATED)
+    assert not app.is_complete_response('{"problem": "x"}')
+    assert app.is_complete_response('{"problem": "x"}', ())
+    assert not app.is_complete_response(json.dumps({**json.loads(COMPLETE), "problem": ""}))
+    assert not app.is_complete_response("⚠️ Incomplete response (finishReason=MAX_TOKENS)", ())
+def fake_call(text):
+    calls = []
+    def call_api(api_key, payload, active_model_name=None, deadline=None, on_text=None):
+        calls.append(payload)
+        return text, "test-model"
+    return calls, call_api
+@pytest.mark.parametrize("text, cached", [(TRUNCATED, False), ("⚠️ Incomplete response (finishReason=missing)", False), (COMPLETE, True)])
+def test_generation_caches_only_complete_responses(cache, monkeypatch, text, cached):
+    calls, call_api = fake_call(text)
+    monkeypatch.setattr(app.GeminiClient, "call_api", staticmethod(call_api))
+    monkeypatch.setattr(app.GeminiClient, "resolve_model", staticmethod(lambda name=None: "test-model"))
+    image = Image.new("RGB", (64, 64), "white")
+    for _ in range(2):
+        app.generate_draft("k", image, "Maintain", "Middle 1", "", "", None, 0.5, "Any")
+        app.refine_final("k", "draft", None, "Middle 1")
+    assert len(calls) == (2 if cached else 4)
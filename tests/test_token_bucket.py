@@ -0,0 +1,77 @@
+import time
+import pytest
+import app
+class FakeResponse:
+    def __init__(self, status_code, headers=None):
+        self.status_code = status_code
+        self.headers = headers or {}
+        self.text = ""
+    def json(self):
+        return {"models": [{"name": "models/gemini-2.5-flash", "supportedGenerationMethods": ["generateContent"]}]}
+class FakeSession:
+    def __init__(self, status_code=200, headers=None):
+        self.status_code = status_code
+        self.headers = headers
+        self.calls = []
+    def post(self, url, **kwargs):
+        self.calls.append(url)
+        return FakeResponse(self.status_code, self.headers)
+    def get(self, url, **kwargs):
+        self.calls.append(url)
+        return FakeResponse(self.status_code, self.headers)
+@pytest.fixture
+def session(monkeypatch):
+    monkeypatch.setattr(app.TokenBucket, "_buckets", {})
+    fake = FakeSession()
+    monkeypatch.setattr(app, "get_http_session", lambda: fake)
+    return fake
+def test_burst_then_deadline():
+    bucket = app.TokenBucket(rate_per_minute=60, capacity=3)
+    deadline = time.monotonic() + 0.1
+    assert [bucket.acquire(deadline) for _ in range(3)] == [True, True, True]
+    assert not bucket.acquire(deadline)
+def test_refill_rate():
+    bucket = app.TokenBucket(rate_per_minute=600, capacity=1)
+    assert bucket.acquire(time.monotonic())
+    started = time.monotonic()
+    assert bucket.acquire(started + 1)
+    assert 0.05 <= time.monotonic() - started < 0.5
+def test_penalize_blocks_until_retry_after():
+    bucket = app.TokenBucket(rate_per_minute=6000, capacity=5)
+    bucket.penalize(0.2)
+    assert not bucket.acquire(time.monotonic() + 0.1)
+    assert bucket.acquire(time.monotonic() + 1)
+def test_for_key_shares_bucket_per_key_and_model(session):
+    assert app.TokenBucket.for_key("k", "m") is app.TokenBucket.for_key("k", "m")
+    assert app.TokenBucket.for_key("k", "m") is not app.TokenBucket.for_key("k", "other")
+def test_no_backoff_sleep_after_final_attempt(monkeypatch, session):
+    session.status_code = 503
+    monkeypatch.setattr(app, "API_MAX_ATTEMPTS", 3)
+    monkeypatch.setattr(app.GeminiClient, "retry_delay", staticmethod(lambda res, attempt: 0.01))
+    sleeps = []
+    monkeypatch.setattr(app.time, "sleep", sleeps.append)
+    res, error = app.GeminiClient.post_with_retry("key", "m", {}, time.monotonic() + 60)
+    assert res is None and error.startswith("Error 503")
+    assert len(session.calls) == 3
+    assert sleeps == [0.01, 0.01]
+def test_probe_goes_through_bucket(session):
+    bucket = app.TokenBucket.for_key("key", "gemini-2.5-flash")
+    bucket.penalize(60)
+    assert not app.GeminiClient.probe_model("key", "gemini-2.5-flash")
+    assert session.calls == []
+    assert app.GeminiClient.probe_model("key", "gemini-1.5-flash")
+    assert len(session.calls) == 1
+def test_probe_429_penalizes_bucket(session):
+    session.status_code = 429
+    session.headers = {"Retry-After": "30"}
+    assert not app.GeminiClient.probe_model("key", "m")
+    assert not app.GeminiClient.probe_model("key", "m")
+    assert len(session.calls) == 1
+def test_model_list_goes_through_bucket(session):
+    assert app.GeminiClient.get_working_model("key")[0] == "gemini-2.5-flash"
+    app.TokenBucket.for_key("key", "models").penalize(60)
+    assert app.GeminiClient.get_working_model("key") == ['gemini-2.5-flash', 'gemini-1.5-flash', 'gemini-1.5-pro']
+    assert len(session.calls) == 1
+def test_buckets_are_shared_across_reruns(reruns):
+    first, second = (ns["TokenBucket"].for_key("rerun-key", "m") for ns in reruns)
+    assert first is second
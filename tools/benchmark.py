@@ -0,0 +1,123 @@
+"""End-to-end generation benchmark against the local Gemini stand-in.
+
+Drives upload -> generate_draft -> refine_final -> parse_gemini_json_response ->
+create_single_pdf and reports p50/p95/p99 per stage.
+
+    python tools/benchmark.py --iterations 50 --concurrency 4 --latency 0.8 --rate-429 0.05
+    python tools/benchmark.py --base http://127.0.0.1:8765/v1beta problem.png   # external stand-in
+"""
+import argparse
+import io
+import json
+import os
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+from PIL import Image
+TOOLS_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(TOOLS_DIR))
+sys.path.insert(0, TOOLS_DIR)
+import gemini_standin
+STAGES = ["upload", "draft", "refine", "parse", "pdf", "total"]
+def sample_images(paths):
+    if paths:
+        blobs = []
+        for path in paths:
+            with open(path, "rb") as f:
+                blobs.append(f.read())
+        return blobs
+    img = Image.new("RGB", (1200, 900), "white")
+    buf = io.BytesIO()
+    img.save(buf, format="PNG")
+    return [buf.getvalue()]
+def run_once(app, api_key, blob, settings, stream):
+    timings = {}
+    first = {}
+    started = time.perf_counter()
+    def on_text(stage):
+        def mark(_chunk):
+            first.setdefault(stage, time.perf_counter() - started)
+        return mark if stream else None
+    t = time.perf_counter()
+    image = Image.open(io.BytesIO(blob))
+    image.load()
+    timings["upload"] = time.perf_counter() - t
+    t = time.perf_counter()
+    draft, _ = app.generate_draft(api_key, image, settings["difficulty"], settings["grade"], "", "", None, settings["creativity"], settings["prob_type"], None, settings["language"], on_text=on_text("draft"), use_cache=False)
+    timings["draft"] = time.perf_counter() - t
+    t = time.perf_counter()
+    final, _ = app.refine_final(api_key, draft, None, settings["grade"], None, settings["language"], on_text=on_text("refine"), use_cache=False)
+    timings["refine"] = time.perf_counter() - t
+    t = time.perf_counter()
+    data = app.parse_gemini_json_response(final)
+    timings["parse"] = time.perf_counter() - t
+    t = time.perf_counter()
+    fig = app.PDFGenerator._generate_figure_from_code(data.get("drawing_code"))
+    app.PDFGenerator.create_single_pdf(data, "Benchmark", fig)
+    timings["pdf"] = time.perf_counter() - t
+    timings["total"] = time.perf_counter() - started
+    if stream:
+        timings["first_content"] = first.get("draft", timings["total"])
+    return timings, bool(data.get("problem")) and not app.is_api_error(final)
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("images", nargs="*")
+    parser.add_argument("--iterations", type=int, default=20)
+    parser.add_argument("--concurrency", type=int, default=1)
+    parser.add_argument("--base", help="use an already running stand-in instead of starting one")
+    parser.add_argument("--cassette")
+    parser.add_argument("--latency", type=float, default=0.5)
+    parser.add_argument("--jitter", type=float, default=0.1)
+    parser.add_argument("--rate-429", type=float, default=0.0)
+    parser.add_argument("--rate-5xx", type=float, default=0.0)
+    parser.add_argument("--retry-after", type=float, default=0.5)
+    parser.add_argument("--api-rpm", type=float, help="override the client-side rate limit (API_RATE_PER_MINUTE)")
+    parser.add_argument("--stream", action="store_true", help="use streamGenerateContent and report time to first content")
+    parser.add_argument("--json", help="write raw timings to this file")
+    args = parser.parse_args()
+    config = None
+    if args.base:
+        base = args.base
+    else:
+        config = gemini_standin.StandinConfig(args.latency, args.jitter, args.rate_429, args.rate_5xx, args.retry_after,
+                                              cassette=gemini_standin.Cassette(args.cassette), seed=0)
+        _, base = gemini_standin.start_standin(config)
+    # app 은 import 시점에 API 주소와 응답 캐시 경로를 읽는다
+    os.environ["GEMINI_API_BASE"] = base
+    os.environ["RESPONSE_CACHE_PATH"] = ""
+    if args.api_rpm:
+        os.environ["API_RATE_PER_MINUTE"] = str(args.api_rpm)
+        os.environ["API_BURST"] = str(max(1, int(args.api_rpm / 6)))
+    import app
+    api_key = os.environ.get("GEMINI_API_KEY", "benchmark")
+    app._runtime_state()["preferred_model_mode"] = os.environ.get("BENCHMARK_MODEL", "gemini-2.5-flash")
+    settings = {"difficulty": "Maintain", "grade": "Middle 1", "creativity": 0.5, "prob_type": "Any", "language": "Korean"}
+    blobs = sample_images(args.images)
+    results, failures = [], [0]
+    lock = threading.Lock()
+    def job(i):
+        timings, ok = run_once(app, api_key, blobs[i % len(blobs)], settings, args.stream)
+        with lock:
+            results.append(timings)
+            failures[0] += not ok
+    run_once(app, api_key, blobs[0], settings, args.stream)
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=max(1, args.concurrency)) as pool:
+        list(pool.map(job, range(args.iterations)))
+    wall = time.perf_counter() - started
+    stages = STAGES + (["first_content"] if args.stream else [])
+    print(f"{args.iterations} iterations, concurrency {args.concurrency}, {wall:.2f}s wall, {args.iterations / wall:.2f} pipelines/s, {failures[0]} failed")
+    if config is not None:
+        print("stand-in:", json.dumps(config.counts))
+    print(f"{'stage':<14} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9} {'max ms':>9}")
+    for stage in stages:
+        values = np.array([r[stage] for r in results]) * 1000
+        p50, p95, p99 = np.percentile(values, [50, 95, 99])
+        print(f"{stage:<14} {p50:>9.1f} {p95:>9.1f} {p99:>9.1f} {values.max():>9.1f}")
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(results, f)
+if __name__ == "__main__":
+    main()
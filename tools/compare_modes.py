@@ -0,0 +1,95 @@
+"""Compare the two-call (draft -> refine) pipeline with the single-call fast mode.
+
+    GEMINI_API_KEY=... python tools/compare_modes.py problem1.png problem2.jpg --runs 3 --judge
+
+Reports latency, request size and simple quality checks per mode; --judge asks the
+model to re-solve each generated problem and checks the answer agrees.
+"""
+import argparse
+import json
+import os
+import re
+import statistics
+import sys
+import time
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import app
+from PIL import Image
+MODES = {"two-call": False, "fast": True}
+STEP_PATTERN = re.compile(r"(\d+\s*단계|Step\s*\d+)", re.IGNORECASE)
+def normalize_answer(text):
+    return re.sub(r"[\s$\\{}(),.]", "", str(text)).lower()
+def judge_answer(api_key, data):
+    prompt = f"다음 수학 문제를 풀고 최종 답만 JSON {{\"answer\": \"...\"}} 으로 출력하십시오.\n\n{data.get('problem', '')}"
+    payload = {"contents": [{"parts": [{"text": prompt}]}], "generationConfig": {"temperature": 0.0, "response_mime_type": "application/json"}}
+    text, _ = app.GeminiClient.call_api(api_key, payload)
+    try:
+        solved = json.loads(re.search(r"\{.*\}", text, re.DOTALL).group(0)).get("answer", "")
+    except Exception:
+        return None
+    a, b = normalize_answer(solved), normalize_answer(data.get("answer", ""))
+    return bool(a) and (a == b or a in b or b in a)
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("images", nargs="+")
+    parser.add_argument("--runs", type=int, default=2)
+    parser.add_argument("--grade", default="Middle 1")
+    parser.add_argument("--difficulty", default="Maintain")
+    parser.add_argument("--type", default="Any")
+    parser.add_argument("--language", default="Korean")
+    parser.add_argument("--creativity", type=float, default=0.5)
+    parser.add_argument("--judge", action="store_true")
+    parser.add_argument("--out", help="write one JSON line per run")
+    args = parser.parse_args()
+    api_key = os.environ.get("GEMINI_API_KEY")
+    if not api_key:
+        sys.exit("GEMINI_API_KEY is not set")
+    sent = {"bytes": 0, "calls": 0}
+    session = app.get_http_session()
+    real_post = session.post
+    def counting_post(url, json=None, **kwargs):
+        sent["calls"] += 1
+        sent["bytes"] += len(app.json.dumps(json or {}))
+        return real_post(url, json=json, **kwargs)
+    session.post = counting_post
+    app.GeminiClient.test_api_connection(api_key)
+    rows = []
+    for path in args.images:
+        image = Image.open(path)
+        for run in range(args.runs):
+            for mode, fast in MODES.items():
+                settings = {
+                    "difficulty": args.difficulty, "grade": args.grade, "curriculum_text": "", "style_img": None,
+                    "creativity": args.creativity, "prob_type": args.type, "subject": None, "language": args.language,
+                    "force_fresh": True, "fast_mode": fast
+                }
+                sent.update(bytes=0, calls=0)
+                started = time.perf_counter()
+                data = app.run_twin_pipeline(api_key, image, settings)
+                latency = time.perf_counter() - started
+                row = {
+                    "image": path, "run": run, "mode": mode, "latency": round(latency, 3), "calls": sent["calls"], "request_kb": round(sent["bytes"] / 1024, 1),
+                    "complete": all(str(data.get(k, "")).strip() for k in ("problem", "answer", "solution")),
+                    "steps": len(STEP_PATTERN.findall(str(data.get("solution", "")))),
+                    "drawing_ok": app.DrawingCodeValidator.check(data["drawing_code"])[0] if data.get("drawing_code") else None,
+                }
+                if args.judge and row["complete"]:
+                    row["judge_agree"] = judge_answer(api_key, data)
+                rows.append(row)
+                print(json.dumps(row, ensure_ascii=False))
+    if args.out:
+        with open(args.out, "w", encoding="utf-8") as f:
+            for row in rows:
+                f.write(json.dumps(row, ensure_ascii=False) + "\n")
+    print()
+    print(f"{'mode':<10} {'n':>3} {'p50 s':>7} {'mean s':>7} {'req KB':>7} {'complete':>9} {'steps':>6} {'judge':>6}")
+    for mode in MODES:
+        sub = [r for r in rows if r["mode"] == mode]
+        if not sub:
+            continue
+        judged = [r["judge_agree"] for r in sub if r.get("judge_agree") is not None]
+        print(f"{mode:<10} {len(sub):>3} {statistics.median(r['latency'] for r in sub):>7.2f} {statistics.mean(r['latency'] for r in sub):>7.2f} "
+              f"{statistics.mean(r['request_kb'] for r in sub):>7.1f} {sum(r['complete'] for r in sub) / len(sub):>9.0%} "
+              f"{statistics.mean(r['steps'] for r in sub):>6.1f} {(sum(judged) / len(judged) if judged else float('nan')):>6.0%}")
+if __name__ == "__main__":
+    main()
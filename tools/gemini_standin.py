@@ -0,0 +1,213 @@
+"""Local stand-in for the Gemini REST endpoints used by GeminiClient.
+
+Serves GET /v1beta/models, POST .../models/<m>:generateContent and
+POST .../models/<m>:streamGenerateContent?alt=sse.
+
+    # replay a cassette with 0.8 s latency and 10% 429s
+    python tools/gemini_standin.py --cassette cassette.jsonl --latency 0.8 --rate-429 0.1
+    # record real responses into a cassette
+    python tools/gemini_standin.py --record https://generativelanguage.googleapis.com/v1beta --cassette cassette.jsonl
+
+Point the app at it with GEMINI_API_BASE=http://127.0.0.1:8765/v1beta (plus
+GEMINI_CA_BUNDLE=<cert> when --tls-cert is used).
+"""
+import argparse
+import hashlib
+import json
+import random
+import ssl
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import requests
+DEFAULT_MODELS = ["gemini-2.5-flash", "gemini-1.5-flash", "gemini-1.5-pro"]
+SYNTHETIC_RESPONSE = {
+    "concept": "일차방정식", "problem": "방정식 $3x + 5 = 20$ 을 만족하는 $x$ 의 값을 구하시오.", "hint": "양변에서 5를 빼 보세요.",
+    "answer": "$x = 5$", "solution": "1단계: 양변에서 5를 빼면 $3x = 15$\\n\\n2단계: 양변을 3으로 나누면 $x = 5$",
+    "drawing_code": "import numpy as np\nx = np.linspace(0, 10, 100)\nplt.plot(x, 3 * x + 5)\nplt.axhline(20, color='gray', linestyle='--')",
+    "achievement_standard": "[9수학02-04]"
+}
+def request_digest(model, method, payload):
+    # API 키/쿼리와 무관하게 모델+메서드+본문으로 응답을 찾는다
+    return hashlib.sha256(json.dumps([model, method, payload], sort_keys=True, ensure_ascii=False).encode("utf-8")).hexdigest()
+class Cassette:
+    def __init__(self, path=None):
+        self.path = path
+        self.entries = {}
+        self._lock = threading.Lock()
+        if path:
+            try:
+                with open(path, encoding="utf-8") as f:
+                    for line in f:
+                        entry = json.loads(line)
+                        self.entries[entry["digest"]] = entry["text"]
+            except FileNotFoundError:
+                pass
+    def get(self, digest):
+        return self.entries.get(digest)
+    def record(self, digest, model, method, text):
+        with self._lock:
+            self.entries[digest] = text
+            if self.path:
+                with open(self.path, "a", encoding="utf-8") as f:
+                    f.write(json.dumps({"digest": digest, "model": model, "method": method, "text": text}, ensure_ascii=False) + "\n")
+class StandinConfig:
+    def __init__(self, latency=0.5, jitter=0.0, rate_429=0.0, rate_5xx=0.0, retry_after=1.0, stream_chunks=12,
+                 models=None, cassette=None, record=None, strict=False, seed=None):
+        self.latency = latency
+        self.jitter = jitter
+        self.rate_429 = rate_429
+        self.rate_5xx = rate_5xx
+        self.retry_after = retry_after
+        self.stream_chunks = max(1, stream_chunks)
+        self.models = models or DEFAULT_MODELS
+        self.cassette = cassette or Cassette()
+        self.record = record.rstrip("/") if record else None
+        self.strict = strict
+        self.random = random.Random(seed)
+        self.counts = {"requests": 0, "429": 0, "5xx": 0, "replayed": 0, "synthetic": 0, "recorded": 0}
+        self._lock = threading.Lock()
+    def count(self, key):
+        with self._lock:
+            self.counts[key] += 1
+    def delay(self):
+        with self._lock:
+            return max(0.0, self.latency + self.random.uniform(-self.jitter, self.jitter))
+    def roll(self):
+        with self._lock:
+            r = self.random.random()
+        if r < self.rate_429:
+            return 429
+        if r < self.rate_429 + self.rate_5xx:
+            return 503
+        return 200
+class StandinHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    config = None
+    def log_message(self, *args):
+        pass
+    def send_json(self, status, obj, headers=None):
+        body = json.dumps(obj, ensure_ascii=False).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        for k, v in (headers or {}).items():
+            self.send_header(k, v)
+        self.end_headers()
+        self.wfile.write(body)
+    def do_GET(self):
+        path = self.path.split("?")[0].rstrip("/")
+        if not path.endswith("/models"):
+            return self.send_json(404, {"error": {"code": 404, "message": "not found"}})
+        models = [{"name": f"models/{m}", "supportedGenerationMethods": ["generateContent", "streamGenerateContent"]} for m in self.config.models]
+        self.send_json(200, {"models": models})
+    def do_POST(self):
+        cfg = self.config
+        cfg.count("requests")
+        payload = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+        path, _, query = self.path.partition("?")
+        try:
+            model, method = path.rsplit("/models/", 1)[1].split(":", 1)
+        except (IndexError, ValueError):
+            return self.send_json(404, {"error": {"code": 404, "message": "bad path"}})
+        if model not in cfg.models or method not in ("generateContent", "streamGenerateContent"):
+            return self.send_json(404, {"error": {"code": 404, "message": f"models/{model} is not found"}})
+        status = cfg.roll()
+        if status == 429:
+            cfg.count("429")
+            return self.send_json(429, {"error": {"code": 429, "status": "RESOURCE_EXHAUSTED", "details": [
+                {"@type": "type.googleapis.com/google.rpc.RetryInfo", "retryDelay": f"{cfg.retry_after:g}s"}]}},
+                {"Retry-After": f"{cfg.retry_after:g}"})
+        if status != 200:
+            cfg.count("5xx")
+            time.sleep(cfg.delay() / 4)
+            return self.send_json(status, {"error": {"code": status, "status": "UNAVAILABLE"}})
+        text = self.response_text(model, method, payload, query)
+        if text is None:
+            return self.send_json(500, {"error": {"code": 500, "message": "no recorded response"}})
+        if method == "streamGenerateContent":
+            return self.stream(text)
+        time.sleep(cfg.delay())
+        self.send_json(200, {"candidates": [{"content": {"parts": [{"text": text}], "role": "model"}, "finishReason": "STOP"}],
+                             "usageMetadata": {"promptTokenCount": len(json.dumps(payload)) // 4, "candidatesTokenCount": len(text) // 4}})
+    def response_text(self, model, method, payload, query):
+        cfg = self.config
+        digest = request_digest(model, "generateContent", payload)
+        text = cfg.cassette.get(digest)
+        if text is not None:
+            cfg.count("replayed")
+            return text
+        if cfg.record:
+            # 실제 API 로 전달해 응답을 기록 (스트리밍 요청도 일반 호출로 기록 후 잘라서 재생)
+            key = dict(p.split("=", 1) for p in query.split("&") if "=" in p).get("key", "")
+            res = requests.post(f"{cfg.record}/models/{model}:generateContent?key={key}", json=payload, timeout=600)
+            if res.status_code == 200:
+                text = res.json()["candidates"][0]["content"]["parts"][0]["text"]
+                cfg.cassette.record(digest, model, method, text)
+                cfg.count("recorded")
+                return text
+            return None
+        if cfg.strict:
+            return None
+        cfg.count("synthetic")
+        return json.dumps(SYNTHETIC_RESPONSE, ensure_ascii=False)
+    def stream(self, text):
+        cfg = self.config
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Connection", "close")
+        self.end_headers()
+        step = len(text) // cfg.stream_chunks + 1
+        pause = cfg.delay() / cfg.stream_chunks
+        for i in range(0, len(text), step):
+            time.sleep(pause)
+            event = {"candidates": [{"content": {"parts": [{"text": text[i:i + step]}], "role": "model"}}]}
+            if i + step >= len(text):
+                event["candidates"][0]["finishReason"] = "STOP"
+            self.wfile.write(f"data: {json.dumps(event, ensure_ascii=False)}\r\n\r\n".encode("utf-8"))
+            self.wfile.flush()
+        self.close_connection = True
+def start_standin(config=None, host="127.0.0.1", port=0, tls_cert=None, tls_key=None):
+    # -> (server, base_url); 서버는 데몬 스레드에서 동작
+    handler = type("Handler", (StandinHandler,), {"config": config or StandinConfig()})
+    server = ThreadingHTTPServer((host, port), handler)
+    server.daemon_threads = True
+    scheme = "http"
+    if tls_cert:
+        ctx = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+        ctx.load_cert_chain(tls_cert, tls_key)
+        server.socket = ctx.wrap_socket(server.socket, server_side=True)
+        scheme = "https"
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    name = "localhost" if tls_cert else host
+    return server, f"{scheme}://{name}:{server.server_address[1]}/v1beta"
+def main():
+    parser = argparse.ArgumentParser(description="Gemini API stand-in with record/replay, latency and error injection.")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--cassette", help="JSONL file of recorded responses")
+    parser.add_argument("--record", metavar="UPSTREAM", help="forward cache misses to this API base and record them")
+    parser.add_argument("--strict", action="store_true", help="fail cassette misses instead of returning a synthetic problem")
+    parser.add_argument("--latency", type=float, default=0.5)
+    parser.add_argument("--jitter", type=float, default=0.0)
+    parser.add_argument("--rate-429", type=float, default=0.0)
+    parser.add_argument("--rate-5xx", type=float, default=0.0)
+    parser.add_argument("--retry-after", type=float, default=1.0)
+    parser.add_argument("--stream-chunks", type=int, default=12)
+    parser.add_argument("--models", nargs="+")
+    parser.add_argument("--tls-cert")
+    parser.add_argument("--tls-key")
+    parser.add_argument("--seed", type=int)
+    args = parser.parse_args()
+    config = StandinConfig(args.latency, args.jitter, args.rate_429, args.rate_5xx, args.retry_after, args.stream_chunks,
+                           args.models, Cassette(args.cassette), args.record, args.strict, args.seed)
+    server, base = start_standin(config, args.host, args.port, args.tls_cert, args.tls_key)
+    print(f"Gemini stand-in on {base} (GEMINI_API_BASE={base})")
+    try:
+        while True:
+            time.sleep(60)
+            print(json.dumps(config.counts))
+    except KeyboardInterrupt:
+        server.shutdown()
+if __name__ == "__main__":
+    main()